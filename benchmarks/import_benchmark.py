@@ -0,0 +1,77 @@
+import json
+import subprocess
+import sys
+
+
+class ImportBenchmark:
+    u"""
+    tmllibのimport時間と、読み込まれる重い依存モジュールの計測
+    計測ごとに新しいpythonプロセスを起動するので、実行中のプロセスのimport状態に影響されない
+    check()は `import tmllib` やLIGHT_TARGETSのimportで重い依存が読み込まれた場合や、
+    `import tmllib` がmax_secondsを超えた場合にエラーにする
+    パッケージには含めない。リポジトリのルートで実行する(回帰テストは tests/test_lazy_import.py)
+
+    ex)
+        python benchmarks/import_benchmark.py  # CIなど。計測結果を表示し、check()が失敗すると終了コードが1になる
+    """
+
+    HEAVY_MODULES = [
+        'pandas', 'numpy', 'sklearn', 'boto3', 'botocore', 'sqlalchemy', 'google.cloud.bigquery',
+        'redis', 'pydantic', 'requests', 'pyarrow',
+    ]
+    # 重い依存を読み込まないクラス
+    LIGHT_TARGETS = ['StopWatch', 'EtlHelper', 'Kintone']
+    DEFAULT_TARGETS = ['StopWatch', 'Kintone', 'Redis', 'AWSTool', 'Aurora', 'BigQuery', 'EtlHelper']
+
+    def __init__(self, targets=None, repeat=3, max_seconds=0.5):
+        self.targets = targets if targets is not None else self.DEFAULT_TARGETS
+        self.repeat = repeat
+        self.max_seconds = max_seconds
+
+    def run(self):
+        import pandas as pd
+
+        rows = [self.measure('import tmllib')]
+        rows += [self.measure(f'from tmllib import {x}') for x in self.targets]
+        return pd.DataFrame(rows).set_index('statement')
+
+    def measure(self, statement):
+        """statementを実行する新しいプロセスを起動し、最短の所要時間と読み込まれた重い依存を返す"""
+        results = [self._run(statement) for _ in range(self.repeat)]
+        return {
+            'statement': statement,
+            'seconds': min(x['seconds'] for x in results),
+            'heavy_modules': ', '.join(results[0]['modules']),
+        }
+
+    def check(self):
+        result = self.measure('import tmllib')
+        if result['heavy_modules'] != '':
+            raise RuntimeError(f"import tmllib loads heavy modules: {result['heavy_modules']}")
+        if result['seconds'] > self.max_seconds:
+            raise RuntimeError(f"import tmllib took {result['seconds']:.3f}s (max {self.max_seconds}s)")
+        for x in self.LIGHT_TARGETS:
+            modules = self.measure(f'from tmllib import {x}')['heavy_modules']
+            # KintoneはHTTPクライアントとしてrequestsを使う
+            modules = ', '.join(m for m in modules.split(', ') if m and not (x == 'Kintone' and m == 'requests'))
+            if modules != '':
+                raise RuntimeError(f"from tmllib import {x} loads heavy modules: {modules}")
+        return result
+
+    def _run(self, statement):
+        code = (
+            'import json, sys, time\n'
+            't = time.perf_counter()\n'
+            f'{statement}\n'
+            'seconds = time.perf_counter() - t\n'
+            f'modules = [x for x in {self.HEAVY_MODULES!r} if x in sys.modules]\n'
+            'print(json.dumps({"seconds": seconds, "modules": modules}))\n'
+        )
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    benchmark = ImportBenchmark()
+    print(benchmark.run())
+    benchmark.check()
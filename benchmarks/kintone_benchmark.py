@@ -0,0 +1,111 @@
+import time
+
+import pandas as pd
+
+from tmllib.bq_kintone import BQKintone
+from tmllib.config_abc import BaseConfig
+from tmllib.kintone import Kintone
+from tmllib.kintone_stub import KintoneStub
+
+
+class KintoneBenchmark:
+    u"""
+    KintoneStubを使ったkintone連携のスループット計測
+    fetch(select_all), update, etl(BQKintone.etl。BigQueryへの書き込みは記録のみ)の
+    records/secとAPI呼び出し回数を計測する
+
+    パッケージには含めない。リポジトリのルートで実行する
+
+    ex)
+        python benchmarks/kintone_benchmark.py
+    """
+
+    def __init__(self, n=10000, interval=0.0, workers=4, **stub_kwargs):
+        self.n = n
+        self.interval = interval
+        self.workers = workers
+        self.stub_kwargs = stub_kwargs
+
+    def run(self):
+        return pd.DataFrame([self.fetch(), self.update(), self.etl()]).set_index('name')
+
+    def fetch(self):
+        with KintoneStub(**self.stub_kwargs).populate(self.n) as stub:
+            app = self._kintone(stub)
+            return self._measure('fetch', stub, lambda: len(app.select_all()))
+
+    def update(self):
+        with KintoneStub(**self.stub_kwargs).populate(self.n) as stub:
+            app = self._kintone(stub)
+            records = [{'id': i, 'score': {'value': i % 7}} for i in stub.records]
+            return self._measure('update', stub, lambda: app.update(records, workers=self.workers)['success'])
+
+    def etl(self):
+        with KintoneStub(**self.stub_kwargs).populate(self.n) as stub:
+            conf = BaseConfig(
+                account_type='env', json_key='', project_id='benchmark', is_debug=False,
+                aws_region=None, aws_profile=None, gbq_location=None, app_list=None)
+            apps = {'stub': {'api_token': 'stub', 'sub_domain': self._domain(stub),
+                             'app_id': stub.app, 'base_url': stub.base_url}}
+            bq = BQKintone(conf, {'stub': 'benchmark.stub'}, apps=apps)
+            bq.db = _RecordingBigQuery()
+            # BQKintone内で生成されるKintoneにも同じレート制限を適用する
+            Kintone._get_limiter(self._domain(stub), self.interval, self.workers)
+
+            def etl():
+                bq.etl('benchmark.stub', 'stub', '$id > 0')
+                return bq.db.rows
+
+            result = self._measure('etl', stub, etl)
+            result['bigquery_calls'] = bq.db.calls
+            return result
+
+    def _measure(self, name, stub, method):
+        stub.reset_calls()
+        start = time.perf_counter()
+        records = method()
+        elapse = time.perf_counter() - start
+        return {
+            'name': name,
+            'records': records,
+            'seconds': elapse,
+            'records_per_sec': records / elapse if elapse > 0 else float('inf'),
+            'api_calls': sum(stub.calls.values()),
+        }
+
+    def _kintone(self, stub):
+        return Kintone('stub', self._domain(stub), stub.app, interval=self.interval,
+                       concurrency=self.workers, base_url=stub.base_url)
+
+    @staticmethod
+    def _domain(stub):
+        # レート制限はドメイン単位で共有されるので、スタブごとに別ドメインとして扱う
+        return 'stub-{}'.format(stub.base_url.split(':')[2].split('/')[0])
+
+
+class _RecordingBigQuery:
+    """KintoneBenchmark.etl用。BigQueryへの操作を実行せずに記録する"""
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+
+    def write_gbq(self, df, tablename, table_schema=None, location=None, if_exists='replace'):
+        self.calls += 1
+        self.rows += len(df)
+        return df
+
+    def query_with_noreturn(self, sql):
+        self.calls += 1
+
+    def read_gbq(self, query, args={}):
+        self.calls += 1
+        return pd.DataFrame({'column_name': pd.Series(dtype=str), 'data_type': pd.Series(dtype=str)})
+
+    def query(self, sql):
+        self.calls += 1
+        return pd.DataFrame()
+
+
+if __name__ == '__main__':
+    print(KintoneBenchmark().run())
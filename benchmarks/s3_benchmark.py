@@ -0,0 +1,114 @@
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+import pandas as pd
+
+from tmllib.awstool import AWSTool
+from tmllib.client_pool import ClientPool
+
+
+class S3Benchmark:
+    u"""
+    ローカルのS3互換サーバ(moto)を使ったAWSToolの転送速度の計測(motoが必要)
+    get: 従来の1回のGET(.read())とRange GET並列の比較
+    prefetch: 小さいオブジェクトを順番に取得する場合と並列に取得する場合の比較
+    sync: オブジェクトごとのcpとsync(並列)の比較
+    motoはネットワークの遅延がないため、実際のS3より並列化の効果は小さく出る
+    パッケージには含めない。リポジトリのルートで実行する
+
+    ex)
+        python benchmarks/s3_benchmark.py
+    """
+
+    bucket = 'benchmark'
+
+    def __init__(self, size=64 * 1024 ** 2, n_objects=200, object_size=64 * 1024, chunk_size=8 * 1024 ** 2,
+                 workers=16):
+        self.size = size
+        self.n_objects = n_objects
+        self.object_size = object_size
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def run(self):
+        from moto.server import ThreadedMotoServer
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        port = self._free_port()
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+        server.start()
+        # motoはダミーの認証情報で動く
+        env = {k: os.environ.get(k) for k in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY')}
+        os.environ.update({'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark'})
+        workdir = tempfile.mkdtemp()
+        try:
+            aws = AWSTool(chunk_size=self.chunk_size, workers=self.workers,
+                          endpoint_url=f'http://127.0.0.1:{port}').init_s3('us-east-1')
+            self._populate(aws)
+            return pd.DataFrame(self.get(aws) + self.prefetch(aws) + self.sync(aws, workdir)).set_index('name')
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+            server.stop()
+            ClientPool.clear()
+            for k, v in env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+    def get(self, aws):
+        url = f's3://{self.bucket}/large.bin'
+        return [
+            self._measure('get(single)', self.size, lambda: aws.s3.Bucket(self.bucket).Object('large.bin').get()['Body'].read()),
+            self._measure('get(ranged)', self.size, lambda: aws.get_from_s3url(url)),
+        ]
+
+    def prefetch(self, aws):
+        urls = [f's3://{self.bucket}/small/{i:05d}.bin' for i in range(self.n_objects)]
+        total = self.n_objects * self.object_size
+        single = AWSTool(workers=1, endpoint_url=aws.endpoint_url).init_s3(aws.region_name)
+        return [
+            self._measure('prefetch(sequential)', total, lambda: single.prefetch(urls)),
+            self._measure('prefetch(parallel)', total, lambda: aws.prefetch(urls)),
+        ]
+
+    def sync(self, aws, workdir):
+        src = f's3://{self.bucket}/small/'
+        total = self.n_objects * self.object_size
+
+        def cp():
+            for x in aws._list(src):
+                aws.cp(src + x, os.path.join(workdir, 'cp', x))
+
+        return [
+            self._measure('cp(each)', total, cp),
+            self._measure('sync', total, lambda: aws.sync(src, os.path.join(workdir, 'sync'))),
+        ]
+
+    def _populate(self, aws):
+        aws.client.create_bucket(Bucket=self.bucket)
+        aws.client.put_object(Bucket=self.bucket, Key='large.bin', Body=os.urandom(self.size))
+        body = os.urandom(self.object_size)
+        for i in range(self.n_objects):
+            aws.client.put_object(Bucket=self.bucket, Key=f'small/{i:05d}.bin', Body=body)
+
+    @staticmethod
+    def _measure(name, size, method):
+        start = time.perf_counter()
+        method()
+        elapse = time.perf_counter() - start
+        return {'name': name, 'bytes': size, 'seconds': elapse, 'mb_per_sec': size / 1024 ** 2 / elapse}
+
+    @staticmethod
+    def _free_port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+
+if __name__ == '__main__':
+    print(S3Benchmark().run())
@@ -43,6 +43,11 @@ setup(
 
     install_requires=_requirements(),
     tests_require=_test_requirements(),
+    # 一部の機能だけで使う依存 ex) pip install tmllib[arrow]
+    extras_require={
+        'msgpack': ['msgpack'],  # elasticcache.MsgpackCodec
+        'arrow': ['pyarrow'],  # elasticcache.ArrowCodec, BigQuery.load_gbq/read_storage, Aurora.read_parquet
+    },
 
     author=author,
     author_email=author_email,
@@ -0,0 +1,21 @@
+import pandas as pd
+import pytest
+
+from tmllib.aurora import Aurora
+
+
+@pytest.mark.parametrize('kwargs', [{'batch_size': 100}, {'workers': 4}])
+def test_upsert_load_rejects_insert_options(kwargs):
+    # 接続前に検証する
+    with pytest.raises(ValueError):
+        Aurora().upsert(pd.DataFrame({'id': [1]}), 't', method='load', **kwargs)
+
+
+def test_upsert_unknown_method():
+    with pytest.raises(ValueError):
+        Aurora().upsert(pd.DataFrame({'id': [1]}), 't', method='replace')
+
+
+def test_options_are_keyword_only():
+    with pytest.raises(TypeError):
+        Aurora(False, 'production')
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+from moto import mock_aws
+
+from tmllib.awstool import AWSTool
+from tmllib.client_pool import ClientPool
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    # motoはダミーの認証情報で動く
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+    with mock_aws():
+        ClientPool.clear()
+        aws = AWSTool(chunk_size=1000, workers=4).init_s3('us-east-1')
+        aws.client.create_bucket(Bucket='bucket')
+        yield aws
+    ClientPool.clear()
+
+
+def put(aws, key, body):
+    aws.client.put_object(Bucket='bucket', Key=key, Body=body)
+    return f's3://bucket/{key}'
+
+
+@pytest.mark.parametrize('size', [0, 10, 1000, 4500])
+def test_download_bytes(aws, size):
+    data = os.urandom(size)
+    assert aws.download_bytes(put(aws, 'k', data)) == data
+
+
+def test_download_file(aws, tmp_path):
+    data = os.urandom(4500)
+    url = put(aws, 'dir/k', data)
+    filename = aws.download_file(url, str(tmp_path / 'out' / 'k'))
+    with open(filename, 'rb') as f:
+        assert f.read() == data
+    assert os.path.getmtime(filename) == aws.head(url)['LastModified'].timestamp()
+    assert os.listdir(tmp_path / 'out') == ['k']
+
+
+def test_sync(aws, tmp_path):
+    put(aws, 'src/a.bin', b'a' * 2500)
+    put(aws, 'src/sub/b.bin', b'b')
+    dest = str(tmp_path / 'dest')
+    assert aws.sync('s3://bucket/src/', dest) == ['a.bin', 'sub/b.bin']
+    assert aws.sync('s3://bucket/src/', dest) == []
+
+    put(aws, 'src/sub/b.bin', b'bb')
+    open(os.path.join(dest, 'extra.bin'), 'wb').close()
+    assert aws.sync('s3://bucket/src/', dest, delete=True) == ['sub/b.bin']
+    assert sorted(os.listdir(dest)) == ['a.bin', 'sub']
+    with open(os.path.join(dest, 'sub', 'b.bin'), 'rb') as f:
+        assert f.read() == b'bb'
+
+    # ローカルからS3
+    assert aws.sync(dest, 's3://bucket/copy/') == ['a.bin', 'sub/b.bin']
+    assert aws.download_bytes('s3://bucket/copy/a.bin') == b'a' * 2500
@@ -0,0 +1,147 @@
+from types import SimpleNamespace
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from tmllib.bigquery import BigQuery
+from tmllib.config_abc import BaseConfig
+
+
+class FakeJob:
+    def __init__(self, fn=None):
+        self.fn = fn
+
+    def result(self):
+        if self.fn is not None:
+            self.fn()
+        return self
+
+
+class FakeClient:
+    """query/load/copy/deleteだけを持つbigquery.Clientの代わり。テーブルは{名前: DataFrame}で持つ"""
+
+    def __init__(self, tables=None):
+        self.tables = dict(tables or {})
+        self.queries = []
+
+    def query(self, sql, job_config=None):
+        self.queries.append(sql)
+        job = FakeJob()
+        job.job_id, job.started, job.ended = f'job{len(self.queries)}', None, None
+        job.destination = SimpleNamespace(project='p', dataset_id='_tmp', table_id='anon')
+        return job
+
+    def load_table_from_file(self, buf, tablename, job_config=None, location=None):
+        df = pq.read_table(buf).to_pandas()
+        if job_config.write_disposition == 'WRITE_APPEND' and tablename in self.tables:
+            df = pd.concat([self.tables[tablename], df], ignore_index=True)
+        self.tables[tablename] = df
+        return FakeJob()
+
+    def copy_table(self, source, destination, job_config=None, location=None):
+        def run():
+            df = self.tables[source]
+            if job_config.write_disposition == 'WRITE_APPEND' and destination in self.tables:
+                df = pd.concat([self.tables[destination], df], ignore_index=True)
+            self.tables[destination] = df
+        return FakeJob(run)
+
+    def delete_table(self, tablename, not_found_ok=False):
+        self.tables.pop(tablename, None)
+
+
+class FakeReadClient:
+    """BigQueryReadClientの代わり。ストリームごとにRecordBatchのlistを返す"""
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.sessions = []
+
+    def create_read_session(self, parent, read_session, max_stream_count):
+        self.sessions.append((read_session.table, max_stream_count))
+        schema = self.streams[0][0].schema
+        return SimpleNamespace(arrow_schema=SimpleNamespace(serialized_schema=schema.serialize().to_pybytes()),
+                               streams=[SimpleNamespace(name=str(i)) for i in range(len(self.streams))])
+
+    def read_rows(self, name):
+        pages = [SimpleNamespace(to_arrow=lambda x=x: x) for x in self.streams[int(name)]]
+        return SimpleNamespace(rows=lambda session: SimpleNamespace(pages=pages))
+
+
+def make_bq(client=None, bqstorage_client=None):
+    conf = BaseConfig(account_type='env', json_key='', project_id='p', is_debug=False, aws_region=None,
+                      aws_profile=None, gbq_location=None, app_list=None)
+    return BigQuery(conf, client=client, bqstorage_client=bqstorage_client)
+
+
+def test_chunk_schema_matches_single_frame():
+    bq = make_bq()
+    chunks = [pd.DataFrame({'a': [1, 2], 'b': [None, None], 'c': [1.0, None]}),
+              pd.DataFrame({'a': [1.5, None], 'b': ['x', 'y'], 'c': [2.0, 3.0]})]
+    schema, _ = bq._chunk_schema(chunks, [], 4)
+    assert {x['name']: x['type'] for x in schema} == {'a': 'FLOAT', 'b': 'STRING', 'c': 'FLOAT'}
+    # 欠損値を含むfloat列は1つのDataFrameの場合と同じくFLOAT
+    assert bq._load_schema(chunks[0])[2]['type'] == 'FLOAT'
+
+
+def test_chunked_load_failure_keeps_destination():
+    client = FakeClient({'ds.t': pd.DataFrame({'a': [100]})})
+    bq = make_bq(client)
+    # 先読みの範囲ではINTEGER、3チャンク目で変換できない値が出る
+    chunks = [pd.DataFrame({'a': [1]}), pd.DataFrame({'a': [2]}), pd.DataFrame({'a': [1.5]})]
+    with pytest.raises(ValueError):
+        bq.load_gbq(iter(chunks), 'ds.t', if_exists='replace', schema_chunks=2)
+    assert list(client.tables) == ['ds.t']
+    assert client.tables['ds.t']['a'].tolist() == [100]
+
+
+def test_chunked_load_replaces_destination():
+    client = FakeClient({'ds.t': pd.DataFrame({'a': [100]})})
+    bq = make_bq(client)
+    stats = bq.load_gbq(iter([pd.DataFrame({'a': [1, 2]}), pd.DataFrame({'a': [3]})]), 'ds.t')
+    assert stats['rows'] == 3
+    assert list(client.tables) == ['ds.t']
+    assert client.tables['ds.t']['a'].tolist() == [1, 2, 3]
+
+
+def make_streams():
+    def batch(values):
+        return pa.RecordBatch.from_pydict({'a': values, 's': [str(x) for x in values]})
+    return [[batch([1, 2]), batch([3])], [batch([4, 5])]]
+
+
+@pytest.mark.parametrize('output', ['dataframe', 'arrow', 'chunks'])
+def test_read_storage(output):
+    client, reader = FakeClient(), FakeReadClient(make_streams())
+    bq = make_bq(client, reader)
+    result = bq.read_storage('select {col} from ds.t', args={'col': 'a, s'}, output=output, max_streams=2)
+    if output == 'arrow':
+        result = result.to_pandas()
+    elif output == 'chunks':
+        result = pd.concat(list(result), ignore_index=True)
+    assert sorted(result['a']) == [1, 2, 3, 4, 5]
+    assert list(result.columns) == ['a', 's']
+    assert client.queries == ['select a, s from ds.t']
+    assert reader.sessions == [('projects/p/datasets/_tmp/tables/anon', 2)]
+
+
+def test_read_storage_from_query_formats_once():
+    client = FakeClient()
+    bq = make_bq(client, FakeReadClient(make_streams()))
+    bq.use_storage = True
+    df = bq.read_gbq("select '{{x}}' as a from ds.t", args={})
+    assert len(df) == 5
+    assert client.queries == ["select '{x}' as a from ds.t"]
+
+
+def test_job_stats_are_bounded():
+    conf = BaseConfig(account_type='env', json_key='', project_id='p', is_debug=False, aws_region=None,
+                      aws_profile=None, gbq_location=None, app_list=None)
+    client = FakeClient()
+    bq = BigQuery(conf, client=client, max_job_stats=3)
+    bq.wait(bq.submit_all([f'select {i}' for i in range(5)]))
+    assert [x['job_id'] for x in bq.job_stats] == ['job3', 'job4', 'job5']
+    bq.clear_stats()
+    assert len(bq.job_stats) == 0
@@ -0,0 +1,37 @@
+import fakeredis
+import numpy as np
+import pandas as pd
+import pytest
+
+from tmllib.elasticcache import CODECS, ArrowCodec, Redis
+
+
+def make_redis():
+    r = Redis('localhost')
+    # 接続プールの代わりにfakeredisの接続を使う
+    r._Redis__conn = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    return r
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_write_and_read_frame(codec):
+    r = make_redis()
+    df = pd.DataFrame({'id': [1, 2, 3], 'x': [1.5, 2.5, np.nan], 'name': ['a', 'b', 'c']})
+    assert r.write_frame(df, 'id', prefix='f:', codec=codec) == 3
+    out = r.read_frame([3, 9, 1], prefix='f:', codec=codec)
+    assert out['id'].tolist() == [3, 9, 1]
+    assert out['name'].tolist()[::2] == ['c', 'a']
+    assert out['x'].isna().tolist() == [True, True, False]
+
+
+def test_arrow_codec_shares_one_conversion():
+    codec = ArrowCodec()
+    df = pd.DataFrame({'a': range(100), 't': pd.date_range('2024-01-01', periods=100, tz='UTC')})
+    values = codec.encode_rows(df)
+    assert len(values) == 100
+    out = codec.decode_rows(values[10:12])
+    assert out['a'].tolist() == [10, 11]
+    assert out['t'].dtype == df['t'].dtype
+    # 書き込み時期によってスキーマが違う行も読める
+    mixed = codec.decode_rows(values[:1] + codec.encode_rows(pd.DataFrame({'a': [0.5]})))
+    assert mixed['a'].tolist() == [0.0, 0.5]
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from tmllib.encoder import CategoryEncoder, FrameAligner
+from tmllib.etltool import EtlHelper
+
+
+def test_category_encoder_unknown_and_nan():
+    encoder = CategoryEncoder().fit(pd.Series(['b', 'a', None, 'b']))
+    assert encoder.categories == ['a', 'b']
+    ids = encoder.transform(pd.Series(['a', 'c', None, np.nan, 'b'], index=[5, 6, 7, 8, 9]))
+    assert ids.tolist() == [0, 2, 2, 2, 1]
+    assert ids.index.tolist() == [5, 6, 7, 8, 9]
+    assert encoder.inverse_transform(ids).tolist() == ['a', None, None, None, 'b']
+
+    encoder = CategoryEncoder(unknown_id=-1).fit(['x'])
+    assert encoder.transform(['x', 'y']).tolist() == [0, -1]
+
+
+def test_category_encoder_save_load(tmp_path):
+    encoder = CategoryEncoder().fit(['x', 'y'])
+    encoder.save(str(tmp_path / 'e.pkl'))
+    assert CategoryEncoder.load(str(tmp_path / 'e.pkl')).transform(['y', 'z']).tolist() == [1, 2]
+
+
+def make_frame():
+    return pd.DataFrame({'n': pd.Series(dtype='int64'), 'flag': pd.Series(dtype='bool'),
+                         'x': pd.Series(dtype='float64')})
+
+
+def test_frame_aligner_zero_fills_int_and_bool():
+    df = pd.DataFrame({'extra': ['e'], 'x': [1]})
+    result = FrameAligner(make_frame()).transform(df)
+    assert list(result.columns) == ['n', 'flag', 'x']
+    assert result.dtypes.tolist() == [np.dtype('int64'), np.dtype('bool'), np.dtype('float64')]
+    assert result.iloc[0].tolist() == [0, False, 1.0]
+    # 元のdataframeは変更しない
+    assert list(df.columns) == ['extra', 'x']
+
+
+def test_adjust_frame_updates_in_place():
+    df = pd.DataFrame({'extra': ['e'], 'x': [1]})
+    result = EtlHelper().adjust_frame(df, make_frame())
+    assert result is df
+    assert list(df.columns) == ['x', 'n', 'flag']
+    assert df.iloc[0].tolist() == [1.0, 0, False]
+    assert df['flag'].dtype == bool
+
+    df = pd.DataFrame({'extra': ['e'], 'x': [1]})
+    result = EtlHelper().adjust_frame(df, make_frame(), drop=False, inplace=False)
+    assert list(result.columns) == ['extra', 'x', 'n', 'flag']
+    assert list(df.columns) == ['extra', 'x']
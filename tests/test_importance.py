@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+from sklearn.tree import DecisionTreeClassifier
+
+from tmllib import importance
+from tmllib.importance import PermutationImportance
+
+
+def make_data():
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(size=(300, 5)), columns=list('abcde'))
+    y = (X['a'] + X['b'] > 0).astype(int).to_numpy()
+    model = DecisionTreeClassifier(random_state=0).fit(X, y)
+    return model, X, y
+
+
+def test_batched_matches_unbatched():
+    model, X, y = make_data()
+    single = PermutationImportance(n_repeats=3, batch_size=1).fit(model, X, y)
+    batched = PermutationImportance(n_repeats=3, batch_size=3).fit(model, X, y)
+    pd.testing.assert_frame_equal(single, batched)
+    assert single.loc['a', 'importance'] > single.loc['e', 'importance']
+
+
+def test_batch_size_is_capped_by_memory():
+    _, X, _ = make_data()
+    pi = PermutationImportance(batch_size=5, max_batch_bytes=int(X.memory_usage(index=False).sum()) * 2)
+    assert pi._batch_size(X) == 2
+
+
+def test_fit_keeps_no_module_state():
+    model, X, y = make_data()
+    PermutationImportance(n_repeats=1).fit(model, X, y)
+    assert importance._state == {}
@@ -0,0 +1,48 @@
+import pytest
+
+from tmllib.kintone import Kintone, RecordHashStore
+from tmllib.kintone_stub import KintoneStub
+
+
+@pytest.fixture
+def stub():
+    with KintoneStub().populate(5) as stub:
+        yield stub
+
+
+def make_kintone(stub):
+    return Kintone('stub', f'stub-{stub.base_url}', stub.app, interval=0, base_url=stub.base_url)
+
+
+def test_update_skips_unchanged_missing_and_conflicting(stub):
+    app = make_kintone(stub)
+    store = RecordHashStore()
+    app.select_all(store=store)
+    # 他でid=2が更新された
+    stub.handle('PUT', '/k/v1/records.json', {'records': [{'id': 2, 'record': {'name': {'value': 'other'}}}]})
+
+    records = [
+        {'id': 1, 'name': {'value': 'new1'}},
+        {'id': 2, 'name': {'value': 'new2'}},
+        {'id': 3, 'name': {'value': 'new3'}},
+        {'id': 4, 'name': {'value': 'name4'}},
+        {'id': 99, 'name': {'value': 'missing'}},
+    ]
+    result = app.update(records, store=store)
+    assert result == {'success': 2, 'skipped': 1, 'unchanged': 1, 'conflicts': [2]}
+    assert [stub.records[i]['name']['value'] for i in (1, 2, 3)] == ['new1', 'other', 'new3']
+    assert store.records[1]['revision'] == 2
+    assert store.records[2] == {'revision': 2, 'fields': {}}
+
+    # 最新のrevisionで記録し直したので、次回は送信される
+    result = app.update([{'id': 2, 'name': {'value': 'new2'}}, {'id': 1, 'name': {'value': 'new1'}}], store=store)
+    assert result == {'success': 1, 'skipped': 0, 'unchanged': 1, 'conflicts': []}
+    assert stub.records[2]['name']['value'] == 'new2'
+
+
+def test_update_without_store_overwrites(stub):
+    app = make_kintone(stub)
+    result = app.update([{'id': i, 'score': {'value': i * 10}} for i in range(1, 6)], validate=False)
+    assert result['success'] == 5
+    assert [stub.records[i]['score']['value'] for i in range(1, 6)] == ['10', '20', '30', '40', '50']
+    assert stub.calls[('POST', 'bulkRequest.json')] == 1
@@ -0,0 +1,35 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['pandas', 'numpy', 'sklearn', 'boto3', 'google.cloud.bigquery', 'sqlalchemy', 'pyarrow']
+
+
+def loaded_modules(statement):
+    """statementを新しいプロセスで実行し、読み込まれた重い依存を返す"""
+    code = (
+        'import json, sys\n'
+        f'{statement}\n'
+        f'print(json.dumps([x for x in {HEAVY_MODULES!r} if x in sys.modules]))\n'
+    )
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                         cwd=ROOT)
+    return set(json.loads(out.stdout.strip().splitlines()[-1]))
+
+
+@pytest.mark.parametrize('statement', [
+    'import tmllib',
+    'from tmllib import StopWatch',
+    'from tmllib import EtlHelper',
+    'from tmllib import Kintone',
+])
+def test_import_loads_no_heavy_modules(statement):
+    assert loaded_modules(statement) == set()
+
+
+def test_submodule_attribute():
+    assert loaded_modules('import tmllib; tmllib.etltool') == set()
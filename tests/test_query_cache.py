@@ -0,0 +1,34 @@
+import pandas as pd
+import pytest
+
+from tmllib.query_cache import QueryCache
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ("select extract(year from ts) from ds.t where s = 'from a'", ['ds.t']),
+    ("select substring(s from 2 for 3), trim(both ' ' from s) from ds.t -- from c", ['ds.t']),
+    ('select * from ds.t /* join ds.x */ where s = "join b"', ['ds.t']),
+    ('select * from (select a from x.y) t join `p.d.z` using (id)', ['p.d.z', 'x.y']),
+    ('with a as (select * from ds.s), b as (select * from a) '
+     'select * from b cross join unnest(arr) left join ds.u using (id)', ['ds.s', 'ds.u']),
+    ('select * from ds.t where id in (select id from ds.v) and x = array(select y from ds.z)',
+     ['ds.t', 'ds.v', 'ds.z']),
+])
+def test_tables(sql, expected):
+    assert QueryCache.tables(sql) == expected
+
+
+def test_fetch_validates_with_tables(tmp_path):
+    cache = QueryCache(str(tmp_path), validate=True)
+    checked = []
+
+    def last_modified(tables):
+        checked.append(tables)
+        return None
+
+    sql = "select extract(year from ts) as y from ds.t where s = 'from a'"
+    df = pd.DataFrame({'y': [2024]})
+    assert cache.fetch(sql, lambda: df, last_modified=last_modified).equals(df)
+    assert cache.fetch(sql, lambda: None, last_modified=last_modified).equals(df)
+    assert checked == [['ds.t']]
+    assert cache.stats['hits'] == 1
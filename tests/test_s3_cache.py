@@ -0,0 +1,66 @@
+import os
+
+import pytest
+from moto import mock_aws
+
+from tmllib.awstool import AWSTool
+from tmllib.client_pool import ClientPool
+from tmllib.s3_cache import S3Cache
+
+
+@pytest.fixture
+def aws(monkeypatch, tmp_path):
+    # motoはダミーの認証情報で動く
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'test')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'test')
+    with mock_aws():
+        ClientPool.clear()
+        cache = S3Cache(str(tmp_path / 'cache'), max_bytes=5000)
+        aws = AWSTool(chunk_size=1000, workers=4, cache=cache).init_s3('us-east-1')
+        aws.client.create_bucket(Bucket='bucket')
+        yield aws
+    ClientPool.clear()
+
+
+def put(aws, key, body):
+    aws.client.put_object(Bucket='bucket', Key=key, Body=body)
+    return f's3://bucket/{key}'
+
+
+def test_hit(aws):
+    url = put(aws, 'a', b'a' * 1500)
+    assert aws.get_from_s3url(url) == b'a' * 1500
+    assert aws.get_from_s3url(url) == b'a' * 1500
+    with aws.open_mmap(url) as m:
+        assert m[:3] == b'aaa'
+    assert aws.cache.stats == {'hits': 2, 'misses': 1, 'revalidated': 0}
+
+
+def test_evict_removes_metadata_and_lock(aws):
+    urls = [put(aws, f'k{i}', bytes([i]) * 2000) for i in range(4)]
+    for url in urls:
+        aws.get_from_s3url(url)
+    files = os.listdir(aws.cache.cache_dir)
+    bins = [x for x in files if x.endswith('.bin')]
+    # 新しい2つだけが残り、削除したキーのメタデータとロックファイルも残らない
+    assert len(bins) == 2
+    bases = {x.split('.')[0] for x in bins}
+    assert {x.split('.')[0] for x in files if not x.startswith('.')} == bases
+    assert aws.get_from_s3url(urls[-1]) == bytes([3]) * 2000
+    assert aws.cache.stats['hits'] == 1
+
+    aws.cache.clear()
+    assert [x for x in os.listdir(aws.cache.cache_dir) if not x.startswith('.')] == []
+
+
+def test_revalidate(aws):
+    aws.cache.revalidate = 0
+    url = put(aws, 'a', b'old')
+    assert aws.get_from_s3url(url) == b'old'
+    assert aws.get_from_s3url(url) == b'old'
+    assert aws.cache.stats['revalidated'] == 1
+
+    put(aws, 'a', b'new!')
+    assert aws.get_from_s3url(url) == b'new!'
+    assert aws.cache.stats['misses'] == 2
+    assert len([x for x in os.listdir(aws.cache.cache_dir) if x.endswith('.bin')]) == 1
@@ -0,0 +1,70 @@
+import time
+
+import fakeredis
+import pytest
+
+from tmllib.elasticcache import Redis, TieredCache
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_redis(server):
+    r = Redis('localhost')
+    # 接続プールの代わりにfakeredisの接続を使う
+    r._Redis__conn = fakeredis.FakeRedis(server=server)
+    return r
+
+
+def wait_until(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def test_read_through_and_single_loader_call(server):
+    calls = []
+
+    def loader(keys):
+        calls.append(list(keys))
+        return {k: k * 10 for k in keys}
+
+    cache = TieredCache(make_redis(server), loader=loader, prefix='t:')
+    assert cache.get_many([1, 2]) == {1: 10, 2: 20}
+    assert cache.get_many([1, 2]) == {1: 10, 2: 20}
+    assert calls == [[1, 2]]
+    assert cache.stats['local']['hits'] == 2
+
+
+def test_invalidation_by_other_writer(server):
+    cache = TieredCache(make_redis(server), prefix='t:', invalidation=True)
+    other = TieredCache(make_redis(server), prefix='t:')
+    try:
+        cache.set('a', 1)
+        other.set('a', 2)
+        assert wait_until(lambda: not cache.local.get('a')[0])
+        assert cache.get('a') == 2
+    finally:
+        cache.stop_invalidation()
+
+
+def test_own_write_does_not_evict_local_entry(server):
+    cache = TieredCache(make_redis(server), prefix='t:', redis_ttl=60, invalidation=True)
+    try:
+        cache.set('a', 1)
+        cache.set_many({'b': 2, 'c': 3})
+        # 自分の書き込みの通知が処理されるのを待つ
+        time.sleep(0.5)
+        assert [cache.local.get(k) for k in ('a', 'b', 'c')] == [(True, 1), (True, 2), (True, 3)]
+        cache.delete('b')
+        # 他のプロセスが別の値を書き込んだ
+        make_redis(server).conn.set('t:c', b'other')
+        assert wait_until(lambda: not cache.local.get('c')[0])
+        assert cache.local.get('a') == (True, 1)
+    finally:
+        cache.stop_invalidation()
@@ -1,13 +1,69 @@
-from .aurora import *
-from .awstool import *
-from .bigquery import *
-from .bq_kintone import *
-from .config_abc import *
-from .elasticcache import *
-from .etltool import *
-from .evaluator import *
-from .kintone import *
-from .parallelget import *
+import importlib
+
+# 公開クラスと定義しているモジュール。属性に最初にアクセスしたときにモジュールをimportする(PEP 562)
+# pandas, sklearn, boto3, google-cloud-bigquery などの重い依存は、使うクラスの分だけ読み込まれる
+_LAZY = {
+    'Aurora': 'aurora',
+    'AWSTool': 'awstool',
+    'BigQuery': 'bigquery',
+    'BQKintone': 'bq_kintone',
+    'ClientPool': 'client_pool',
+    'AccountType': 'config_abc',
+    'BaseConfig': 'config_abc',
+    'PickleCodec': 'elasticcache',
+    'JsonCodec': 'elasticcache',
+    'MsgpackCodec': 'elasticcache',
+    'ArrowCodec': 'elasticcache',
+    'Redis': 'elasticcache',
+    'AsyncRedis': 'elasticcache',
+    'LRUCache': 'elasticcache',
+    'TieredCache': 'elasticcache',
+    'CategoryEncoder': 'encoder',
+    'FrameAligner': 'encoder',
+    'EtlHelper': 'etltool',
+    'Pipeline': 'etltool',
+    'StopWatch': 'etltool',
+    'Evaluator': 'evaluator',
+    'RateLimiter': 'kintone',
+    'PropertyCache': 'kintone',
+    'Kintone': 'kintone',
+    'RecordHashStore': 'kintone',
+    'KintoneStub': 'kintone_stub',
+    'PermutationImportance': 'importance',
+    'Downloader': 'parallelget',
+    'CalibrationAccumulator': 'metrics',
+    'ConfusionAccumulator': 'metrics',
+    'CurveAccumulator': 'metrics',
+    'EvaluationResult': 'metrics',
+    'LogLossAccumulator': 'metrics',
+    'MetricsEngine': 'metrics',
+    'StreamingEvaluator': 'metrics',
+    'QueryCache': 'query_cache',
+    'S3Cache': 's3_cache',
+    'HashSampler': 'sampling',
+}
+
+__all__ = sorted(_LAZY)
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        # tmllib.etltool のようなサブモジュールの参照
+        try:
+            return importlib.import_module(f'.{name}', __name__)
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                raise
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{_LAZY[name]}', __name__), name)
+    # 2回目以降は__getattr__を通らないようにモジュールの属性として保持する
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
 
 __copyright__ = 'Copyright (C) 2023 Takemi Ohama'
 __VERSION__ = '0.2.1'
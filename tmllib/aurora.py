@@ -1,10 +1,17 @@
+import csv
 import os
 import pdb
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import boto3
 import pandas as pd
 import pandas.io.sql as psql
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+
+from .sampling import HashSampler
 
 
 class Aurora:
@@ -12,89 +19,293 @@ class Aurora:
     postgresql/redshift接続クラス
     """
 
-    def __init__(self, is_debug=False, target='staging'):
+    def __init__(self, is_debug=False, *, cache=None,
+                 pool_size=5, max_overflow=10, pool_recycle=3600, pool_pre_ping=True, pool_timeout=30):
+        """
+        cache: QueryCacheを指定するとreadの結果をキャッシュする
+        pool_size, max_overflow, pool_recycle, pool_pre_ping, pool_timeout: コネクションプールの設定(create_engine参照)
+        """
         self.db = None
-        self.target = target
+        self._reader = None
+        self._params = None
         self.is_debug = is_debug
+        self.cache = cache
+        self.pool = {
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'pool_recycle': pool_recycle,
+            'pool_pre_ping': pool_pre_ping,
+            'pool_timeout': pool_timeout,
+        }
 
     def con(self):
-        if self.target == 'production':
-            if self.is_debug: print('connect production')
-            self.connect_db()
-        elif self.target == 'staging':
-            if self.is_debug: print('connect staging')
-            self.connect_staging()
-        else:
-            pass
+        if self.is_debug: print(f"connect {self._params['host'] if self._params else None}")
+        if self._params is None:
+            raise ValueError('接続情報がありません。先にconnect_db()を呼び出してください')
+        self.connect_db(**self._params)
 
-    def connect_db(self, host, user, passwd, schema):
+    def connect_db(self, host, user, passwd, schema, local_infile=False, reader_host=None):
+        """
+        host: writer(クラスタ)エンドポイント。execute/update/upsertはこちらに送る
+        reader_host: readerエンドポイント。指定するとread系(read, read_chunks, read_parquet)はこちらに送る
+        local_infile: upsert(method='load')でLOAD DATA LOCAL INFILEを使う場合はTrue
+        """
         if self.db is not None:
             return self
+        self._params = {'host': host, 'user': user, 'passwd': passwd, 'schema': schema,
+                        'local_infile': local_infile, 'reader_host': reader_host}
+        self.db = self._create_engine(host, user, passwd, schema, local_infile)
+        if reader_host is not None:
+            self._reader = self._create_engine(reader_host, user, passwd, schema, False)
+        return self
+
+    def _create_engine(self, host, user, passwd, schema, local_infile):
         connector_str = 'mysql+pymysql://{}:{}@{}/{}?charset=utf8'.format(
             user, passwd, host, schema)
-        self.db = create_engine(connector_str)
-        return self
+        return create_engine(connector_str, connect_args={'local_infile': True} if local_infile else {}, **self.pool)
 
-    def read(self, query):
+    @property
+    def reader(self):
+        """readerエンドポイントのengine(未指定の場合はwriterと同じ)"""
         if self.db is None:
             self.con()
+        return self._reader if self._reader is not None else self.db
+
+    @contextmanager
+    def connection(self, readonly=False):
+        """
+        engineのプールからコネクションを借り、ブロックを抜けるとcommit(例外時はrollback)してプールに返す
+        DBへの接続はプールで再利用される(pool_recycle, pool_pre_pingもプールが処理する)ので、
+        操作ごとに借りても再接続は起きず、executorのworkerスレッドから使ってもコネクションが残らない
+        readonly: Trueの場合はreaderエンドポイントを使う
+        """
+        engine = self.reader if readonly else self.db
+        with engine.connect() as con:
+            try:
+                yield con
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+
+    def close(self):
+        """engineを破棄する(プールのコネクションを閉じる)"""
+        for engine in (self._reader, self.db):
+            if engine is not None:
+                engine.dispose()
+        self.db = None
+        self._reader = None
+
+    def read(self, query):
+        if self.cache is not None:
+            identity = ('aurora', self.reader.url.render_as_string(hide_password=True))
+            return self.cache.fetch(query, lambda: self._read(query), identity=identity,
+                                    last_modified=self.last_modified)
+        return self._read(query)
+
+    def _read(self, query):
         if self.is_debug: print(query)
-        df = psql.read_sql(query, self.db)
+        with self.connection(readonly=True) as con:
+            df = psql.read_sql(query, con)
         return df
 
+    def read_chunks(self, query, chunksize=100000, dtype=None):
+        """
+        サーバサイドカーソル(unbuffered)でクエリ結果をchunksize行ずつDataFrameで返すgenerator
+        全件をクライアント側にバッファしないので、メモリに載らないテーブルも読める
+        dtype: 列ごとの型指定(read_sqlのdtype)。各チャンクに適用する
+        """
+        if self.is_debug: print(query)
+        with self.reader.connect() as con:
+            con = con.execution_options(stream_results=True, max_row_buffer=chunksize)
+            for df in psql.read_sql(query, con, chunksize=chunksize, dtype=dtype):
+                yield df
+
+    def read_parquet(self, query, filename, chunksize=100000, dtype=None):
+        """
+        read_chunksで読んだチャンクを順次parquetファイルに書き込む。書き込んだ行数を返す
+        スキーマは最初のチャンクで決まるので、nullが多い列などはdtypeで型を指定すること
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        rows = 0
+        try:
+            for df in self.read_chunks(query, chunksize, dtype):
+                schema = writer.schema if writer is not None else None
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(filename, table.schema)
+                writer.write_table(table)
+                rows += len(df)
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    def last_modified(self, tables):
+        """
+        information_schemaからテーブルの最終更新日時(epoch秒)の最大値を返す
+        update_timeが取れない(InnoDBの再起動後など)場合はNone
+        """
+        if len(tables) == 0:
+            return None
+        names = [x.split('.')[-1] for x in tables]
+        params = {f't{i}': x for i, x in enumerate(names)}
+        query = text(
+            "select max(unix_timestamp(update_time)) from information_schema.tables "
+            "where table_schema = database() and table_name in ({})".format(', '.join(f':{k}' for k in params)))
+        with self.connection(readonly=True) as con:
+            value = con.execute(query, params).scalar()
+        return float(value) if value is not None else None
+
     def execute(self, query):
         if self.db is None:
             self.con()
         if self.is_debug: print(query)
         try:
-            with self.db.connect() as con:
-                con.execute(query)
+            with self.connection() as con:
+                con.execute(text(query))
         except Exception as e:
             return str(e)
         return "success"
 
     def update(self, df, target_table, tmp_table):
+        if self.db is None:
+            self.con()
         df.to_sql(tmp_table, self.db, if_exists='replace', chunksize=10000)
-        col = ' '.join(['a.{0} = b.{0}'.format(x) for x in df.columns if x != 'id'])
+        col = ', '.join(['a.{0} = b.{0}'.format(x) for x in df.columns if x != 'id'])
         query = "update {} a inner join {} b on a.id = b.id set {}".format(target_table, tmp_table, col)
         if self.is_debug: print(query)
-        with self.db.connect() as con:
-            con.execute(query)
+        with self.db.begin() as con:
+            con.execute(text(query))
+
+    def upsert(self, df, target_table, *, update_columns=None, batch_size=None, workers=None, method='insert'):
+        """
+        dataframeをtarget_tableに一括upsertする(主キー/ユニークキーが一致する行は更新、ない行は追加)
+        method: 'insert': batch_size行ずつ複数行VALUESの insert ... on duplicate key update で送信
+                'load': csvを load data local infile で一時テーブルに読み込み、
+                        insert ... select ... on duplicate key update で反映(connect_db(local_infile=True)が必要)
+        update_columns: 更新する列(省略時はdfの全列)。dfにない列は変更しない
+        batch_size: method='insert'の1回のexecutemanyの行数(省略時は5000)
+        workers: method='insert'の並列数(省略時は1)。1の場合は全バッチを1トランザクションで実行する。
+                 2以上の場合はバッチごとに別コネクション・別トランザクションで並列に実行する
+        method='load'は1回のload dataで送るので、batch_size, workersは指定できない(ValueError)
+        戻り値: 送信した行数
+        """
+        if method not in ('insert', 'load'):
+            raise ValueError(f'unknown method: {method}')
+        if method == 'load' and (batch_size is not None or workers is not None):
+            raise ValueError("batch_size and workers apply only to method='insert'")
+        batch_size = batch_size if batch_size is not None else 5000
+        workers = workers if workers is not None else 1
+        if self.db is None:
+            self.con()
+        if len(df) == 0:
+            return 0
+        update_columns = update_columns if update_columns is not None else df.columns
+        updates = ', '.join(f'`{x}` = values(`{x}`)' for x in update_columns)
+        if method == 'load':
+            return self._upsert_load(df, target_table, updates)
+
+        columns = ', '.join(f'`{x}`' for x in df.columns)
+        values = ', '.join(['%s'] * len(df.columns))
+        # pymysqlのexecutemanyは insert ... values (...) on duplicate key update を複数行VALUESにまとめて送信する
+        query = f"insert into {target_table} ({columns}) values ({values}) on duplicate key update {updates}"
+        if self.is_debug: print(query)
+
+        rows = list(df.astype(object).where(df.notna(), None).itertuples(index=False, name=None))
+        batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+        if workers == 1:
+            self._execute_batches(query, batches)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as exe:
+                list(exe.map(lambda x: self._execute_batches(query, [x]), batches))
+        return len(rows)
+
+    def _execute_batches(self, query, batches):
+        """1コネクション・1トランザクションでバッチを順に実行する"""
+        con = self.db.raw_connection()
+        try:
+            cur = con.cursor()
+            for batch in batches:
+                cur.executemany(query, batch)
+            cur.close()
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    def _upsert_load(self, df, target_table, updates):
+        """
+        load data ... replace は一致する行を削除して追加し直す(dfにない列が初期化され、外部キーのon deleteも動く)ので、
+        dfの列だけを持つ一時テーブルに読み込んでから insert ... select ... on duplicate key update で反映する
+        """
+        df = df.copy()
+        for x in df.columns:
+            if df[x].dtype == bool:
+                df[x] = df[x].astype(int)
+        columns = ', '.join(f'`{x}`' for x in df.columns)
+        staging = f'_upsert_{uuid.uuid4().hex}'
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, encoding='utf-8') as f:
+            df.to_csv(f, index=False, header=False, na_rep='NULL', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+            filename = f.name
+        # 一時テーブルはコネクションごとなので、同じコネクション(トランザクション)で続けて実行する
+        queries = [
+            # 列の型だけをコピーする(キー・制約はコピーされない)
+            f"create temporary table {staging} as select {columns} from {target_table} limit 0",
+            # escaped byを空にすると、引用符なしのNULLがNULLとして読まれる
+            f"load data local infile '{filename}' into table {staging} character set utf8mb4 "
+            f"fields terminated by ',' optionally enclosed by '\"' escaped by '' "
+            f"lines terminated by '\\n' ({columns})",
+            f"insert into {target_table} ({columns}) select {columns} from {staging} "
+            f"on duplicate key update {updates}",
+        ]
+        try:
+            with self.db.begin() as con:
+                try:
+                    for query in queries:
+                        if self.is_debug: print(query)
+                        con.exec_driver_sql(query)
+                finally:
+                    con.exec_driver_sql(f"drop temporary table if exists {staging}")
+        finally:
+            os.remove(filename)
+        return len(df)
 
     def undersampling(self, base_query, pos, neg, unique_key, *, ratio=1.0, limit=-1, salt='saltydog', sample_id='sample_id', args={}):
         """
         DBレベルでの不均衡データアンダーサンプリング。
         posiviteデータのratio倍のnegativeデータをランダムに抽出する。
+        件数の集計1回と、sha2のハッシュバケットで絞り込んだ取得1回で行う(HashSampler参照)
 
         base_query: SQL文字列でwhere句に{separater}変数を、order by句の位置に{orderby}変数を指定すること
         ex) pos = "status = 'win'"
             neg = "status = 'lose'"
             unique_key = "users.id"
             base_query = "select * from users where deleted_at is null and {separator} {orderby}"
-        結果)
-         ->(ok) select * from users where deleted_at is null and status = 'win'
-         ->(ng) select * from users where deleted_at is null and status = 'lose' order by farm_fingerprint(users.id) limit 2000
-        """
-        # positiveを取得
-        orderby = "order by sha2(concat({},'{}'),224) limit {}".format(
-            unique_key, salt, str(limit)) if limit > 0 else ''
-        query = base_query.format(separater=pos, orderby=orderby, **args)
-        positive = self.read(query)
-        pos_num = len(positive)
-        if self.is_debug:
-            print('positive num:', pos_num)
-
-        # negativeをpositiveのrate倍取得
-        limit = round(pos_num * ratio)
-        orderby = "order by sha2(concat({},'{}'),224) limit {}".format(unique_key, salt, str(limit))
-        query = base_query.format(separater=neg, orderby=orderby, **args)
-        negative = self.read(query)
-        print('negative num:', str(len(negative)))
-
-        df = pd.concat([negative, positive], ignore_index=True)
+        limit: posの最大件数(-1は全件)
+        """
+        sizes = {'pos': limit} if limit > 0 else {}
+        df = self.sampling(base_query, {'neg': neg, 'pos': pos}, unique_key, salt=salt,
+                           sizes=sizes, ratios={'neg': ratio}, base='pos', args=args)
+        print('num:', str(len(df)))
+        df = df.reset_index(drop=True)
         df[sample_id] = df.index
         return df
 
+    def sampling(self, base_query, classes, unique_key, salt='saltydog', **kwargs):
+        """
+        ハッシュバケットによる層別サンプリング(多クラス対応)
+        classes: {ラベル: 条件式}
+        kwargs: sizes, ratios, base, label_column, args (HashSampler.sample参照)
+        """
+        sampler = HashSampler('mysql', salt=salt)
+        return sampler.sample(self.read, base_query, classes, unique_key, is_debug=self.is_debug, **kwargs)
+
     def nosampling(self, base_query, condition=' 1=1 '):
         query = base_query.format(separater=condition, orderby='')
         df = self.read(query)
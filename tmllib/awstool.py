@@ -1,16 +1,291 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 
+from .client_pool import ClientPool
+
+
 class AWSTool:
-    def __init__(self):
-        pass
+    u"""
+    S3の読み書き
+    ・1オブジェクトをchunk_sizeごとのRange GETで並列に取得し、確保済みのバッファ/ファイルに直接書き込む
+    ・共有のS3クライアント(ClientPool.s3_client)を使うのでスレッド間で接続プールを再利用する
+    ・cp/syncはawsコマンドを起動せずにプロセス内で転送する
+    ・cache(S3Cache)を指定するとget_from_s3url/open_mmapはローカルディスクのキャッシュを使う
+
+    ex)
+        aws = AWSTool().init_s3()
+        model = pickle.loads(aws.get_from_s3url('s3://bucket/model.pkl'))
+        aws.sync('s3://bucket/images/', './images/')
+    """
+
+    def __init__(self, chunk_size=8 * 1024 ** 2, workers=16, endpoint_url=None, profile=None, cache=None):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.endpoint_url = endpoint_url
+        self.profile = profile
+        self.cache = cache
+        self.region_name = None
 
     def init_s3(self, region_name='ap-northeast-1'):
-        self.s3 = boto3.resource('s3', region_name=region_name)
+        self.region_name = region_name
+        self.s3 = boto3.resource('s3', region_name=region_name, endpoint_url=self.endpoint_url)
         return self
 
-    def get_from_s3url(self, s3url):
+    @property
+    def client(self):
+        return ClientPool.s3_client(self.region_name, self.profile, max(self.workers * 2, 10), self.endpoint_url)
+
+    @staticmethod
+    def parse_s3url(s3url):
         p = s3url.split('/')
-        bucket, key = p[2], '/'.join(p[3:])
-        binary = self.s3.Bucket(bucket).Object(key).get()['Body'].read()
-        return binary
+        return p[2], '/'.join(p[3:])
+
+    def head(self, s3url):
+        bucket, key = self.parse_s3url(s3url)
+        return self.client.head_object(Bucket=bucket, Key=key)
+
+    def get_from_s3url(self, s3url):
+        """
+        オブジェクト全体をbytes(chunk_sizeを超える場合はbytearray)で返す
+        chunk_sizeを超える場合はRange GETで並列に取得する(download_bytes参照)
+        """
+        if self.cache is not None:
+            return self.cache.read(s3url, self)
+        return self.download_bytes(s3url)
+
+    def open_mmap(self, s3url):
+        """キャッシュしたファイルを読み取り専用でメモリマップする(with文で使う。cacheの指定が必要)"""
+        if self.cache is None:
+            raise ValueError('open_mmap requires cache')
+        return self.cache.open_mmap(s3url, self)
+
+    def warm_cache(self, s3urls):
+        """複数のオブジェクトを並列にキャッシュし、{s3url: ローカルのパス}を返す(cacheの指定が必要)"""
+        if self.cache is None:
+            raise ValueError('warm_cache requires cache')
+        return self.cache.prefetch(s3urls, self)
+
+    def download_bytes(self, s3url):
+        """
+        先頭のRange GETでサイズを取得し(HEADは使わない)、chunk_size以下ならそのままbytesで返す
+        超える場合は確保済みのbytearrayに残りの各Rangeを直接書き込み、コピーせずにbytearrayのまま返す
+        (bytesに変換すると全体をコピーしてメモリのピークが2倍になるため。
+         pickle.loads, io.BytesIO, decodeなどはそのまま使える。hashableなbytesが必要な場合は呼び出し側で変換する)
+        """
+        bucket, key = self.parse_s3url(s3url)
+        head, first = self._get_first(bucket, key)
+        size = head['ContentLength']
+        if len(first) >= size:
+            return first
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        view[:len(first)] = first
+
+        def write(offset, chunk):
+            view[offset:offset + len(chunk)] = chunk
+
+        self._get_ranges(bucket, key, head['ETag'], len(first), size, write)
+        view.release()
+        return buffer
+
+    def download_file(self, s3url, filename, head=None):
+        """
+        ファイルを先にオブジェクトのサイズで確保し、各Rangeを該当位置に並列に書き込む
+        head: head_objectの結果(ContentLength, ETag, LastModified)。省略時は先頭のRange GETから取得する
+        完了後に置き換えるので、途中で失敗しても既存のファイルは壊れない
+        """
+        bucket, key = self.parse_s3url(s3url)
+        first = b''
+        if head is None:
+            head, first = self._get_first(bucket, key)
+        size = head['ContentLength']
+        dirname = os.path.dirname(filename)
+        if dirname != '':
+            os.makedirs(dirname, exist_ok=True)
+        tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            if len(first) > 0:
+                os.pwrite(fd, first, 0)
+
+            def write(offset, chunk):
+                os.pwrite(fd, chunk, offset)
+
+            self._get_ranges(bucket, key, head['ETag'], len(first), size, write)
+        except Exception:
+            os.close(fd)
+            os.remove(tmp)
+            raise
+        os.close(fd)
+        os.replace(tmp, filename)
+        # syncで更新日時を比較できるようにS3の更新日時に揃える
+        mtime = head['LastModified'].timestamp()
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def iter_chunks(self, s3url, chunk_size=None):
+        """オブジェクトの内容を全体を読み込まずにchunk_sizeごとに返す"""
+        bucket, key = self.parse_s3url(s3url)
+        body = self.client.get_object(Bucket=bucket, Key=key)['Body']
+        try:
+            yield from body.iter_chunks(chunk_size or 1024 ** 2)
+        finally:
+            body.close()
+
+    def iter_lines(self, s3url, encoding='utf-8'):
+        bucket, key = self.parse_s3url(s3url)
+        body = self.client.get_object(Bucket=bucket, Key=key)['Body']
+        try:
+            for line in body.iter_lines():
+                yield line.decode(encoding)
+        finally:
+            body.close()
+
+    def prefetch(self, s3urls, dest_dir=None):
+        """
+        複数のオブジェクトをworkers並列で取得する
+        dest_dirを指定した場合はファイルに保存して{s3url: ファイル名}、省略時は{s3url: bytes}を返す
+        """
+        def fetch(s3url):
+            if dest_dir is None:
+                # 小さいオブジェクトが多いので、ここではRange分割せずに1回で取得する
+                bucket, key = self.parse_s3url(s3url)
+                return self.client.get_object(Bucket=bucket, Key=key)['Body'].read()
+            return self.download_file(s3url, os.path.join(dest_dir, self.parse_s3url(s3url)[1]))
+
+        s3urls = list(s3urls)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(s3urls, executor.map(fetch, s3urls)))
+
+    def upload_file(self, filename, s3url):
+        from boto3.s3.transfer import TransferConfig
+
+        bucket, key = self.parse_s3url(s3url)
+        config = TransferConfig(multipart_threshold=self.chunk_size, multipart_chunksize=self.chunk_size,
+                                max_concurrency=self.workers)
+        self.client.upload_file(filename, bucket, key, Config=config)
+        return s3url
+
+    def cp(self, src, dest):
+        """
+        aws s3 cp相当。src/destはs3://〜かローカルパス
+        destが/で終わるかディレクトリの場合は、その下にsrcと同じファイル名で保存する
+        """
+        if dest.endswith('/') or (not self._is_s3(dest) and os.path.isdir(dest)):
+            dest = dest.rstrip('/') + '/' + os.path.basename(src.rstrip('/'))
+        if self._is_s3(src) and self._is_s3(dest):
+            bucket, key = self.parse_s3url(src)
+            dest_bucket, dest_key = self.parse_s3url(dest)
+            self.client.copy({'Bucket': bucket, 'Key': key}, dest_bucket, dest_key)
+            return dest
+        if self._is_s3(src):
+            return self.download_file(src, dest)
+        return self.upload_file(src, dest)
+
+    def sync(self, src, dest, delete=False):
+        """
+        aws s3 sync相当。dest側にない、サイズが違う、srcの方が新しいファイルをworkers並列でコピーする
+        delete=Trueの場合はsrc側にないファイルをdestから削除する。戻り値はコピーしたファイルの相対パス
+        """
+        src_files = self._list(src)
+        dest_files = self._list(dest)
+        targets = [
+            x for x, (size, mtime) in src_files.items()
+            if x not in dest_files or dest_files[x][0] != size or dest_files[x][1] < mtime
+        ]
+
+        def copy(x):
+            self.cp(self._join(src, x), self._join(dest, x))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(copy, targets))
+        if delete:
+            for x in set(dest_files) - set(src_files):
+                self._remove(self._join(dest, x))
+        return sorted(targets)
+
+    def _get_first(self, bucket, key):
+        """
+        先頭のchunk_sizeをGETし、(ContentLength(全体のサイズ)・ETag・LastModifiedの辞書, 先頭の内容)を返す
+        小さいオブジェクトはこの1回で取得が終わる
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            res = self.client.get_object(Bucket=bucket, Key=key, Range=f'bytes=0-{self.chunk_size - 1}')
+        except ClientError as e:
+            # 空のオブジェクトはRangeを指定できない(416)
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            res = self.client.get_object(Bucket=bucket, Key=key)
+        data = res['Body'].read()
+        content_range = res.get('ContentRange')
+        size = int(content_range.rsplit('/', 1)[1]) if content_range else len(data)
+        return {'ContentLength': size, 'ETag': res['ETag'], 'LastModified': res['LastModified']}, data
+
+    def _get_ranges(self, bucket, key, etag, start, size, write):
+        """
+        start以降をchunk_sizeごとのRange GETで並列に取得し、write(位置, 内容)で書き込む
+        IfMatchでETagを指定するので、途中でオブジェクトが上書きされた場合は新旧が混ざらずにエラー(412)になる
+        """
+        def fetch(begin, end):
+            offset = begin
+            for chunk in self._get_range(bucket, key, begin, end, etag):
+                write(offset, chunk)
+                offset += len(chunk)
+
+        self._run_ranges(start, size, fetch)
+
+    def _get_range(self, bucket, key, start, end, etag):
+        body = self.client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end - 1}', IfMatch=etag)['Body']
+        try:
+            yield from body.iter_chunks(1024 ** 2)
+        finally:
+            body.close()
+
+    def _run_ranges(self, start, size, fetch):
+        ranges = [(x, min(x + self.chunk_size, size)) for x in range(start, size, self.chunk_size)]
+        if len(ranges) <= 1:
+            for begin, end in ranges:
+                fetch(begin, end)
+            return
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(ranges))) as executor:
+            for f in [executor.submit(fetch, begin, end) for begin, end in ranges]:
+                f.result()
+
+    def _list(self, path):
+        """{相対パス: (サイズ, 更新日時(epoch秒))}"""
+        files = {}
+        if self._is_s3(path):
+            bucket, prefix = self.parse_s3url(path)
+            prefix = prefix.rstrip('/') + '/' if prefix != '' else ''
+            for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+                for x in page.get('Contents', []):
+                    if not x['Key'].endswith('/'):
+                        files[x['Key'][len(prefix):]] = (x['Size'], x['LastModified'].timestamp())
+            return files
+        for root, _, names in os.walk(path):
+            for name in names:
+                filename = os.path.join(root, name)
+                stat = os.stat(filename)
+                files[os.path.relpath(filename, path).replace(os.sep, '/')] = (stat.st_size, stat.st_mtime)
+        return files
+
+    def _remove(self, path):
+        if self._is_s3(path):
+            bucket, key = self.parse_s3url(path)
+            self.client.delete_object(Bucket=bucket, Key=key)
+        else:
+            os.remove(path)
+
+    @staticmethod
+    def _join(path, name):
+        return path.rstrip('/') + '/' + name
 
+    @staticmethod
+    def _is_s3(path):
+        return path.startswith('s3://')
@@ -1,12 +1,19 @@
-import json
 import pdb
+import io
+import itertools
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 
 import pandas as pd
-from google.oauth2 import service_account
-import boto3
-import os
 from google.cloud import bigquery
+from .client_pool import ClientPool
 from .config_abc import BaseConfig
+from .sampling import HashSampler
 
 
 class BigQuery:
@@ -14,43 +21,350 @@ class BigQuery:
     Google BigQuery接続クラス
     """
 
-    def __init__(self, conf: BaseConfig):
+    def __init__(self, conf: BaseConfig, use_storage=False, client=None, bqstorage_client=None, cache=None,
+                 max_job_stats=1000):
+        """
+        use_storage: Trueの場合、read_gbq/queryの結果取得にBigQuery Storage Read APIを利用する
+        client, bqstorage_client: 接続済みのクライアントを使う場合(テスト用のfakeなど)に指定する
+        cache: QueryCacheを指定するとread_gbqの結果をキャッシュする
+        max_job_stats: job_statsに残す直近のjobの数(古いものから捨てる。clear_stats()で空にできる)
+        """
         self.conf = conf
+        self.use_storage = use_storage
+        self.cache = cache
         self.account_type = self.conf.account_type
         self.project_id = self.conf.project_id if hasattr(self.conf, 'project_id') else None
         self.json_key = self.conf.json_key if hasattr(self.conf, 'json_key') else None
         self.region = self.conf.aws_region if hasattr(self.conf, 'aws_region') else None
         self._cred = None
-        self.client = None
+        self.client = client
+        self.bqstorage_client = bqstorage_client
+        # 実行したjobの統計(slot_millis, total_bytes_processed, cache_hit, durationなど)
+        self.job_stats = deque(maxlen=max_job_stats)
 
     def read_gbq(self, query, args={}):
         query = query.format(**args)
+        if self.cache is not None:
+            return self.cache.fetch(query, lambda: self._read_gbq(query), args=args,
+                                    identity=('bigquery', self.project_id), last_modified=self.last_modified)
+        return self._read_gbq(query)
+
+    def _read_gbq(self, query):
+        if self.use_storage:
+            return self._read_storage(query)
         if self.conf.is_debug: print(query)
         df = pd.read_gbq(query, project_id=self.project_id, dialect='standard', credentials=self.cred())
         return df
 
-    def write_gbq(self, df, tablename, table_schema=None, location=None, if_exists='replace'):
+    def write_gbq(self, df, tablename, table_schema=None, location=None, if_exists='replace', method='pandas'):
+        """
+        method: 'pandas': DataFrame.to_gbqで書き込む
+                'load': parquetのload jobで書き込む(load_gbq参照)
+        """
+        if method == 'load':
+            self.load_gbq(df, tablename, table_schema=table_schema, location=location, if_exists=if_exists)
+            return df
         df.to_gbq(tablename, project_id=self.project_id, if_exists=if_exists,
                   credentials=self.cred(), table_schema=table_schema, location=location)
         return df
 
+    def load_gbq(self, data, tablename, table_schema=None, location=None, if_exists='replace', max_jobs=4,
+                 schema_chunks=4):
+        """
+        DataFrameをスキーマに合わせてparquetに変換し、load jobでbigqueryに書き込む
+        チャンク分割時は全チャンクを一時テーブルに読み込み、全て成功した場合だけ書き込み先にコピーする
+        (途中のチャンクで失敗した場合、書き込み先は変更されない)
+        data: DataFrame、またはDataFrameのiterable(pd.read_csv(chunksize=)など、メモリに載らないデータ用)
+        table_schema: to_gbqと同じ形式のスキーマ [{'name': .., 'type': .., 'mode': ..}, ...]
+                      if_exists='append'で既存のテーブルがある場合は、指定のない列はテーブルのスキーマを使う。
+                      それ以外の列はdtypeから決める
+        schema_chunks: チャンク分割時、dtypeから型を決めるために先読みするチャンク数。
+                       チャンクごとに型が違う列は広い型(INTEGERとFLOATはFLOAT、それ以外はSTRING)に、
+                       先読みした範囲で全て欠損値の列はSTRINGにする
+        max_jobs: 2チャンク目以降で同時に実行するload jobの数
+        戻り値: 行数・バイト数・秒間処理量の辞書
+        """
+        table_schema = list(table_schema or [])
+        if if_exists == 'append':
+            given = {x['name'] for x in table_schema}
+            table_schema += [x for x in self._table_schema(tablename) if x['name'] not in given]
+        if isinstance(data, pd.DataFrame):
+            schema, chunks = self._load_schema(data, table_schema), [data]
+        else:
+            schema, chunks = self._chunk_schema(data, table_schema, schema_chunks)
+        dispositions = {
+            'replace': bigquery.WriteDisposition.WRITE_TRUNCATE,
+            'append': bigquery.WriteDisposition.WRITE_APPEND,
+            'fail': bigquery.WriteDisposition.WRITE_EMPTY,
+        }
+        location = location if location is not None else self.conf.gbq_location
+        client = self.get_client()
+        stats = {'rows': 0, 'bytes': 0}
+        start = time.perf_counter()
+        if isinstance(data, pd.DataFrame):
+            self._load_chunks(client, chunks, tablename, schema, dispositions[if_exists], location, max_jobs, stats)
+        else:
+            # 途中のチャンクで失敗しても書き込み先が途中までの状態にならないよう、
+            # 全チャンクを一時テーブルに読み込んでから書き込み先にコピーする
+            staging = f'{tablename}_load_{uuid.uuid4().hex[:12]}'
+            try:
+                n = self._load_chunks(client, chunks, staging, schema, bigquery.WriteDisposition.WRITE_EMPTY,
+                                      location, max_jobs, stats)
+                if n == 0:
+                    return self._finish_stats(tablename, stats, start)
+                job_config = bigquery.CopyJobConfig(write_disposition=dispositions[if_exists])
+                client.copy_table(staging, tablename, job_config=job_config, location=location).result()
+            finally:
+                client.delete_table(staging, not_found_ok=True)
+
+        return self._finish_stats(tablename, stats, start)
+
+    def _finish_stats(self, tablename, stats, start):
+        stats['seconds'] = time.perf_counter() - start
+        stats['rows_per_sec'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0
+        stats['bytes_per_sec'] = stats['bytes'] / stats['seconds'] if stats['seconds'] > 0 else 0
+        if self.conf.is_debug: print(tablename, stats)
+        return stats
+
+    def _load_chunks(self, client, chunks, tablename, schema, disposition, location, max_jobs, stats):
+        """
+        チャンクごとにload jobを実行する。1チャンク目はdisposition、2チャンク目以降は追記で並列に実行する
+        戻り値: チャンク数
+        """
+        jobs = deque()
+        i = -1
+        for i, df in enumerate(chunks):
+            buf = self._to_parquet(df, schema)
+            stats['rows'] += len(df)
+            stats['bytes'] += buf.getbuffer().nbytes
+            job_config = bigquery.LoadJobConfig(
+                source_format=bigquery.SourceFormat.PARQUET,
+                schema=[bigquery.SchemaField(x['name'], x['type'], mode=x['mode']) for x in schema],
+                write_disposition=disposition if i == 0 else bigquery.WriteDisposition.WRITE_APPEND,
+            )
+            job = client.load_table_from_file(buf, tablename, job_config=job_config, location=location)
+            # 1チャンク目はテーブル作成/置換が終わるまで待つ
+            if i == 0:
+                job.result()
+                continue
+            jobs.append(job)
+            if len(jobs) >= max_jobs:
+                jobs.popleft().result()
+        for job in jobs:
+            job.result()
+        return i + 1
+
+    def _table_schema(self, tablename):
+        """既存テーブルのスキーマ(to_gbq形式)。テーブルがない場合は空のlist"""
+        from google.api_core.exceptions import NotFound
+
+        try:
+            table = self.get_client().get_table(tablename)
+        except NotFound:
+            return []
+        return [{'name': x.name, 'type': x.field_type, 'mode': x.mode} for x in table.schema]
+
+    def _chunk_schema(self, chunks, table_schema, schema_chunks):
+        """先頭のschema_chunks個のチャンクからスキーマを決め、(スキーマ, 全チャンクのiterator)を返す"""
+        chunks = iter(chunks)
+        head = list(itertools.islice(chunks, max(schema_chunks, 1)))
+        if len(head) == 0:
+            return [], head
+        given = {x['name'] for x in table_schema}
+        types = {}
+        for df in head:
+            for name, dtype in df.dtypes.items():
+                if name in given or df[name].isna().all():
+                    continue
+                bq_type = self._dtype_to_bq(dtype)
+                current = types.setdefault(name, bq_type)
+                if current != bq_type:
+                    types[name] = 'FLOAT' if {current, bq_type} <= {'INTEGER', 'FLOAT'} else 'STRING'
+        inferred = [
+            {'name': x, 'type': types.get(x, 'STRING'), 'mode': 'NULLABLE'} for x in head[0].columns if x not in given
+        ]
+        return self._load_schema(head[0], table_schema + inferred), itertools.chain(head, chunks)
+
+    def _load_schema(self, df, table_schema=None):
+        """to_gbq形式のスキーマを正規化し、指定のない列はdtypeから型を決める"""
+        type_dic = {'bool': 'BOOLEAN', 'string': 'STRING', 'int': 'INTEGER', 'float': 'FLOAT', 'integer': 'INTEGER',
+                    'int64': 'INTEGER', 'float64': 'FLOAT', 'boolean': 'BOOLEAN'}
+        given = {x['name']: x for x in table_schema} if table_schema is not None else {}
+        schema = []
+        for name, dtype in df.dtypes.items():
+            if name in given:
+                bq_type = given[name]['type']
+                bq_type = type_dic.get(bq_type.lower(), bq_type.upper())
+                mode = given[name].get('mode') or 'NULLABLE'
+            else:
+                bq_type, mode = self._dtype_to_bq(dtype), 'NULLABLE'
+            schema.append({'name': name, 'type': bq_type, 'mode': mode})
+        return schema
+
+    @staticmethod
+    def _dtype_to_bq(dtype):
+        if pd.api.types.is_bool_dtype(dtype):
+            return 'BOOLEAN'
+        if pd.api.types.is_integer_dtype(dtype):
+            return 'INTEGER'
+        if pd.api.types.is_float_dtype(dtype):
+            return 'FLOAT'
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            return 'TIMESTAMP'
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            return 'DATETIME'
+        return 'STRING'
+
+    @staticmethod
+    def _to_parquet(df, schema):
+        """スキーマの型に合わせたArrow型でparquetに変換する"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow_types = {
+            'STRING': pa.string(), 'INTEGER': pa.int64(), 'INT64': pa.int64(),
+            'FLOAT': pa.float64(), 'FLOAT64': pa.float64(), 'BOOLEAN': pa.bool_(), 'BOOL': pa.bool_(),
+            'NUMERIC': pa.decimal128(38, 9), 'BIGNUMERIC': pa.decimal256(76, 38),
+            'TIMESTAMP': pa.timestamp('us', tz='UTC'), 'DATETIME': pa.timestamp('us'),
+            'DATE': pa.date32(), 'TIME': pa.time64('us'), 'BYTES': pa.binary(),
+        }
+        columns = {}
+        for x in schema:
+            s = df[x['name']]
+            if x['type'] == 'STRING' and not pd.api.types.is_string_dtype(s.dtype):
+                s = s.astype(str).where(s.notna(), None)
+            elif x['type'] in ('NUMERIC', 'BIGNUMERIC'):
+                s = s.map(lambda v: Decimal(str(v)) if pd.notna(v) else None)
+            columns[x['name']] = s
+        arrow_schema = pa.schema([(x['name'], arrow_types.get(x['type'], pa.string())) for x in schema])
+        try:
+            table = pa.Table.from_pandas(pd.DataFrame(columns), schema=arrow_schema, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f'スキーマの型に変換できない値があります。table_schemaで列の型を指定してください: {e}') from e
+        buf = io.BytesIO()
+        pq.write_table(table, buf)
+        buf.seek(0)
+        return buf
+
     def cred(self):
-        if self._cred is not None:
-            return self._cred
-        if self.account_type == 'file':
-            self._cred = service_account.Credentials.from_service_account_file(self.json_key)
-        elif self.account_type == 'ssm':
-            session = boto3.Session(profile_name=self.conf.aws_profile, region_name=self.conf.aws_region)
-            param_json = session.client('ssm').get_parameter(
-                Name=self.json_key, WithDecryption=True)['Parameter']['Value']
-            json_key = json.loads(param_json)
-            self._cred = service_account.Credentials.from_service_account_info(json_key)
-        elif self.account_type == 'env':
-            self._cred = service_account.Credentials.from_service_account_file(
-                os.getenv('GOOGLE_APPLICATION_CREDENTIALS'))
-        self.client = bigquery.Client(project=self.project_id, credentials=self._cred)
+        """認証情報とクライアントはClientPoolでプロセス内共有する"""
+        args = (self.account_type, self.json_key, self.region, self.conf.aws_profile)
+        if self._cred is None:
+            self._cred = ClientPool.credentials(*args)
+        if self.client is None:
+            self.client = ClientPool.bigquery_client(self.project_id, *args)
         return self._cred
 
+    def last_modified(self, tables):
+        """
+        テーブルの最終更新日時(epoch秒)の最大値を返す
+        取得できない名前(INFORMATION_SCHEMA、テーブル関数、権限のないテーブルなど)は更新日時不明として除く
+        """
+        from google.api_core.exceptions import BadRequest, Forbidden, NotFound
+
+        modified = []
+        for x in tables:
+            try:
+                modified.append(self.get_client().get_table(x).modified)
+            except (NotFound, BadRequest, Forbidden, ValueError):
+                continue
+        modified = [x.timestamp() for x in modified if x is not None]
+        return max(modified) if len(modified) > 0 else None
+
+    def get_client(self):
+        if self.client is None:
+            self.cred()
+        return self.client
+
+    def get_bqstorage_client(self):
+        if self.bqstorage_client is None:
+            from google.cloud import bigquery_storage
+            self.bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=self.cred())
+        return self.bqstorage_client
+
+    def read_storage(self, query, args={}, output='dataframe', max_streams=0, workers=4):
+        """
+        BigQuery Storage Read APIでクエリ結果を取得する。結果テーブルを複数ストリームに分割してArrow形式で並列に読み込む
+        ストリームを並列に読むため、order byの順序は保持されない
+
+        query: read_gbqと同様にargsでformatする(queryから呼んだ場合はformatしない)
+        output: 'dataframe': pandas.DataFrame
+                'arrow': pyarrow.Table
+                'chunks': ページ単位のDataFrameを返すgenerator(メモリに全件載せない)
+        max_streams: 最大ストリーム数(0はサーバ側で決定)
+        workers: 並列に読み込むストリーム数
+        """
+        return self._read_storage(query.format(**args), output, max_streams, workers)
+
+    def _read_storage(self, query, output='dataframe', max_streams=0, workers=4):
+        """queryはformatせずにそのまま実行する(read_gbq/queryからはこちらを呼ぶ)"""
+        import pyarrow as pa
+
+        job = self.submit(query)
+        self.wait([job])
+        session = self._read_session(job.destination, max_streams)
+        schema = pa.ipc.read_schema(pa.py_buffer(session.arrow_schema.serialized_schema))
+
+        if output == 'chunks':
+            return self._iter_chunks(session, workers)
+
+        with ThreadPoolExecutor(max_workers=workers) as exe:
+            batches = list(exe.map(lambda x: self._read_stream(session, x), session.streams))
+        table = pa.Table.from_batches([y for x in batches for y in x], schema=schema)
+        return table if output == 'arrow' else table.to_pandas()
+
+    def _read_session(self, table, max_streams):
+        from google.cloud.bigquery_storage import types
+        requested = types.ReadSession(
+            table=f'projects/{table.project}/datasets/{table.dataset_id}/tables/{table.table_id}',
+            data_format=types.DataFormat.ARROW,
+        )
+        return self.get_bqstorage_client().create_read_session(
+            parent=f'projects/{self.project_id}', read_session=requested, max_stream_count=max_streams)
+
+    def _read_stream(self, session, stream):
+        reader = self.get_bqstorage_client().read_rows(stream.name)
+        return [page.to_arrow() for page in reader.rows(session).pages]
+
+    def _iter_chunks(self, session, workers):
+        """ストリームを並列に読み、読めたページから順にDataFrameで返す(キューで先読み量を制限)"""
+        buffer = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+        done = object()
+
+        def put(x):
+            while not stop.is_set():
+                try:
+                    buffer.put(x, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce(stream):
+            try:
+                reader = self.get_bqstorage_client().read_rows(stream.name)
+                for page in reader.rows(session).pages:
+                    if stop.is_set(): return
+                    put(page.to_arrow())
+            finally:
+                put(done)
+
+        exe = ThreadPoolExecutor(max_workers=workers)
+        futures = [exe.submit(produce, x) for x in session.streams]
+        remain = len(futures)
+        try:
+            while remain > 0:
+                x = buffer.get()
+                if x is done:
+                    remain -= 1
+                    continue
+                yield x.to_pandas()
+            for x in futures:
+                x.result()
+        finally:
+            stop.set()
+            exe.shutdown(wait=False, cancel_futures=True)
+
     def jsoncolumn_to_df(self, data, prefix=None):
         lst = data.values.tolist()
         json_str = '[' + ','.join(lst) + ']'
@@ -64,51 +378,107 @@ class BigQuery:
         """
         DBレベルでの不均衡データアンダーサンプリング。posのデータ数のratio倍のnegデータをランダムに抽出する。
         ここではnegativeを5-10倍出してコード側でSMOTEENNを掛けるなどの操作を推奨
+        件数の集計1回と、farm_fingerprintのハッシュバケットで絞り込んだ取得1回で行う(HashSampler参照)
 
         base_query: SQL文字列でwhere句に{separater}変数を、order by句の位置に{orderby}変数を指定すること
         ex) pos = "status = 'win'"
             neg = "status = 'lose'"
             unique_key = "users.id"
             base_query = "select * from users where deleted_at is null and {separator} {orderby}"
-
-         ->(ok) select * from users where deleted_at is null and status = 'win'
-         ->(ng) select * from users where deleted_at is null and status = 'lose' order by farm_fingerprint(users.id) limit 2000
+        limit: posの最大件数(-1は全件)
         """
-        # positiveを取得
-        orderby = 'order by farm_fingerprint({}) limit {}'.format(unique_key, str(limit)) if limit > 0 else ''
-        query = base_query.format(separater=pos, orderby=orderby, **args)
-        positive = self.read_gbq(query)
-        pos_num = len(positive)
-        if self.conf.is_debug:
-            print('positive num:', pos_num)
-
-        # negativeをpositiveのrate倍取得
-        limit = round(pos_num * ratio)
-        orderby = 'order by farm_fingerprint({}) limit {}'.format(unique_key, str(limit))
-        query = base_query.format(separater=neg, orderby=orderby, **args)
-        negative = self.read_gbq(query)
-        print('negative num:', str(len(negative)))
+        sizes = {'pos': limit} if limit > 0 else {}
+        df = self.sampling(base_query, {'neg': neg, 'pos': pos}, unique_key,
+                           sizes=sizes, ratios={'neg': ratio}, base='pos', args=args)
+        print('num:', str(len(df)))
+        return df.reset_index(drop=True)
 
-        df = pd.concat([negative, positive], ignore_index=True)
-        return df
+    def sampling(self, base_query, classes, unique_key, **kwargs):
+        """
+        ハッシュバケットによる層別サンプリング(多クラス対応)
+        classes: {ラベル: 条件式}
+        kwargs: sizes, ratios, base, label_column, args (HashSampler.sample参照)
+        """
+        sampler = HashSampler('bigquery')
+        return sampler.sample(self.read_gbq, base_query, classes, unique_key, is_debug=self.conf.is_debug, **kwargs)
 
-    def nosampling(self, base_query, condition=' 1=1 '):
+    def nosampling(self, base_query, condition=' 1=1 ', output='dataframe'):
+        """
+        output: 'dataframe'以外('arrow', 'chunks')を指定した場合はStorage Read APIで取得する(read_storage参照)
+        """
         query = base_query.format(separater=condition, orderby='')
+        if output != 'dataframe':
+            return self._read_storage(query, output=output)
         df = self.read_gbq(query)
         if self.conf.is_debug:
             print('num:', len(df))
         return df
 
-    def upload_csv(self, filename, tablename, **kwarg):
-        df = pd.read_csv(filename, **kwarg)
-        self.write_gbq(df, tablename)
+    def upload_csv(self, filename, tablename, chunksize=100000, table_schema=None, **kwarg):
+        """csvをchunksize行ずつ読み込んでload jobで書き込む(スキーマはload_gbq参照)"""
+        chunks = pd.read_csv(filename, chunksize=chunksize, **kwarg)
+        return self.load_gbq(chunks, tablename, table_schema=table_schema)
 
     def query_with_noreturn(self, sql):
-        self.cred()
-        if self.conf.is_debug: print(sql)
-        self.client.query(sql).result()
+        """sqlにlistを渡した場合は1つのスクリプトjobとしてまとめて実行する"""
+        self.wait([self.submit(sql)])
 
     def query(self, sql):
-        self.cred()
+        if self.use_storage:
+            return self._read_storage(sql)
+        job = self.submit(sql)
+        df = job.to_dataframe()
+        self._record_stats(job)
+        return df
+
+    def submit(self, sql, job_config=None):
+        """
+        クエリjobを投入し、完了を待たずにjobを返す。完了待ちはwait()で行う
+        sqlにlistを渡した場合は1つのスクリプトjobにまとめる
+        """
+        if isinstance(sql, (list, tuple)):
+            sql = self.script(sql)
         if self.conf.is_debug: print(sql)
-        return self.client.query(sql).to_dataframe()
+        return self.get_client().query(sql, job_config=job_config)
+
+    def submit_all(self, sqls):
+        """複数のクエリを待たずに投入してjobのlistを返す"""
+        return [self.submit(x) for x in sqls]
+
+    def wait(self, jobs):
+        """全jobの完了を待って統計を記録する。失敗したjobがあれば全jobの終了後に最初のエラーを送出する"""
+        error = None
+        for job in jobs:
+            try:
+                job.result()
+            except Exception as e:
+                error = e if error is None else error
+            self._record_stats(job)
+        if error is not None:
+            raise error
+        return jobs
+
+    @staticmethod
+    def script(statements):
+        """複数のSQL文を1つのスクリプトにまとめる"""
+        return ';\n'.join(x.strip().rstrip(';') for x in statements if x.strip() != '') + ';'
+
+    def clear_stats(self):
+        """job_statsを空にする"""
+        self.job_stats.clear()
+
+    def _record_stats(self, job):
+        duration = (job.ended - job.started).total_seconds() if job.ended is not None and job.started is not None else None
+        stats = {
+            'job_id': job.job_id,
+            'statement_type': getattr(job, 'statement_type', None),
+            'slot_millis': getattr(job, 'slot_millis', None),
+            'total_bytes_processed': getattr(job, 'total_bytes_processed', None),
+            'total_bytes_billed': getattr(job, 'total_bytes_billed', None),
+            'cache_hit': getattr(job, 'cache_hit', None),
+            'duration': duration,
+            'query': getattr(job, 'query', '')[:200],
+        }
+        self.job_stats.append(stats)
+        if self.conf.is_debug: print(stats)
+        return stats
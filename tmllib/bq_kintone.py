@@ -1,9 +1,9 @@
 
 import json
-import boto3
 import pandas as pd
 import hashlib
 from google.api_core.exceptions import NotFound, Conflict
+from .client_pool import ClientPool
 from .config_abc import BaseConfig
 from .etltool import EtlHelper
 from .bigquery import BigQuery
@@ -13,12 +13,20 @@ import datetime
 
 class BQKintone:
 
-    def __init__(self, conf: BaseConfig, tables):
+    def __init__(self, conf: BaseConfig, tables, apps=None, subtable='string'):
+        """
+        apps: kintoneアプリ情報の辞書。省略時はconf.app_listのSSMパラメータから取得する
+        subtable: SUBTABLEフィールドの転送方法
+            'string': 文字列のまま転送する(従来通り)
+            'table': 子テーブル({tablename}_{フィールドコード})に1行ずつ展開して転送する
+            'record': REPEATED RECORD(ARRAY<STRUCT>)列に変換する
+        """
         self.conf = conf
-        session = boto3.Session(region_name=self.conf.aws_region)
-        param_json = session.client('ssm').get_parameter(
-            Name=self.conf.app_list, WithDecryption=True)['Parameter']['Value']
-        self.apps = json.loads(param_json)
+        self.subtable = subtable
+        if apps is None:
+            param_json = ClientPool.ssm_value(self.conf.app_list, region=self.conf.aws_region)
+            apps = json.loads(param_json)
+        self.apps = apps
         self.db = BigQuery(conf)
         self.helper = EtlHelper()
         self.schema_type = 'type'
@@ -59,9 +67,15 @@ class BQKintone:
         self, app_name,
         id: pd.Series,
         values: pd.DataFrame,
-        field_codes=None
+        field_codes=None,
+        workers=4,
+        validate=True,
+        store=None,
     ):
-        """kintone側の情報を更新する"""
+        """
+        kintone側の情報を更新する
+        storeにRecordHashStoreを渡すと値が変わっていないレコードは送信しない
+        """
         # fields_codeとpandas.columnsの対応表を作成
         col_dic = (
             {x: y for x, y in zip(values.columns, field_codes)}
@@ -70,17 +84,16 @@ class BQKintone:
 
         # kintone apiのrecordsオブジェクトを作成
         # ref: https://cybozu.dev/ja/kintone/docs/rest-api/records/update-records/
-        t = values.T
+        # 転置(values.T)せずに列単位でlist化してから行を組み立てる
+        codes = [col_dic[x] for x in values.columns]
+        columns = [values[x].tolist() for x in values.columns]
         records = [
-            {'id': int(x),
-             'record': {col_dic[y]: {'value': x} for x, y in zip(t[i], t[i].index)}
-             }
-            for i, x in enumerate(id)
+            {'id': int(x), 'record': {c: {'value': v} for c, v in zip(codes, row)}}
+            for x, row in zip(id, zip(*columns))
         ]
 
-        info = self.apps[app_name]
-        app = Kintone(info['api_token'], info['sub_domain'], info['app_id'])
-        res = app.update(records)
+        app = self._kintone(app_name)
+        res = app.update(records, workers=workers, validate=validate, store=store)
         return res
 
     def etl(self, tablename, appname, where):
@@ -96,6 +109,28 @@ class BQKintone:
             print(appname, 'to', tablename, ':', len(df))
             return
 
+        # サブテーブルの変換
+        children = []
+        for label, field in self._subtables(df, fields):
+            if self.subtable == 'table':
+                child, child_fields = self._subtable_frame(df, label, field)
+                children.append((self._subtable_name(tablename, field), child, child_fields))
+                df = df.drop(columns=label)
+            elif self.subtable == 'record':
+                df[label] = df[label].map(lambda x: json.dumps(x, ensure_ascii=False, default=str))
+
+        num = len(df)
+        self._load(tablename, df, fields)
+        for child_name, child, child_fields in children:
+            if len(child) > 0:
+                self._load(child_name, child, child_fields)
+
+        # report
+        print(appname, 'to', tablename, ':', num)
+
+    def _load(self, tablename, df, fields):
+        """dataframeをtmpテーブル経由でbigqueryのtablenameに追加する"""
+
         # フィールド名をMD5に変換し、辞書を保存。
         col_utf8, fields_md5 = self._hash_fields(df, fields)
 
@@ -136,8 +171,33 @@ class BQKintone:
         sql = f"drop table {tablename}_tmp; drop table {tablename}_tmp2"
         self.db.query_with_noreturn(sql)
 
-        # report
-        print(appname, 'to', tablename, ':', len(df))
+    def _subtables(self, df, fields):
+        """dataframeに含まれるSUBTABLEフィールドの(ラベル, フィールド定義)一覧"""
+        return [(k, fields[k]) for k in df.columns if k in fields and fields[k]['type'] == 'SUBTABLE']
+
+    def _subtable_name(self, tablename, field):
+        return f"{tablename}_{field['code'].translate(self.ng_fields)}"
+
+    def _subtable_frame(self, df, label, field):
+        """
+        SUBTABLEフィールドを子テーブル用のframe(1行=サブテーブルの1行)に展開する
+        id: サブテーブル行のid, revision: 親レコードのrevision, parent_id: 親レコードのid
+        """
+        rows = df[label].explode().dropna()
+        sub = pd.DataFrame(rows.tolist(), index=rows.index)
+        child = pd.DataFrame({
+            '$id': sub['id'] if 'id' in sub else pd.Series(dtype=object),
+            '$revision': df.loc[rows.index, '$revision'],
+            'parent_id': df.loc[rows.index, '$id'],
+        })
+        child_fields = {
+            k: {'type': 'NUMBER', 'code': k, 'label': k, 'required': 'True'}
+            for k in ('$id', '$revision', 'parent_id')
+        }
+        for code, prop in field.get('fields', {}).items():
+            child[prop['label']] = sub[code] if code in sub else None
+            child_fields[prop['label']] = prop
+        return child.reset_index(drop=True), child_fields
 
     def _drop_duplicated(self, tablename):
         """id,revisionが同じレコードは削除"""
@@ -244,9 +304,10 @@ class BQKintone:
             "_tmp as select * except({0}), {1} from " +
             tablename + "_tmp2;"
         )
+        targets = ('RECORD_NUMBER', 'NUMBER', 'DATETIME') + (('SUBTABLE',) if self.subtable == 'record' else ())
         excepts = ', '.join([
             f"`{k}`" for k, x in fields.items()
-            if x['type'] in ('RECORD_NUMBER', 'NUMBER', 'DATETIME')
+            if x['type'] in targets
         ])
         casts = "safe_cast(`{0}` as {1}) as `{0}`"
 
@@ -256,11 +317,31 @@ class BQKintone:
             'DATETIME': 'Timestamp',
         }
         casts = ', '.join([
-            casts.format(k, type_dic_bq[x['type']]) for k, x in fields.items()
-            if x['type'] in ('RECORD_NUMBER', 'NUMBER', 'DATETIME')
+            casts.format(k, type_dic_bq[x['type']]) if x['type'] != 'SUBTABLE' else self._subtable_cast(k, x)
+            for k, x in fields.items()
+            if x['type'] in targets
         ])
         self.db.query_with_noreturn(tmpl.format(excepts, casts))
 
+    def _subtable_cast(self, column, field):
+        """JSON文字列で転送したSUBTABLEをARRAY<STRUCT>に変換するSQL"""
+        type_dic_bq = {
+            'NUMBER': 'Numeric',
+            'DATE': 'Date',
+            'DATETIME': 'Timestamp',
+        }
+        members = ["safe_cast(json_value(x, '$.id') as Int64) as id"]
+        for code, prop in field.get('fields', {}).items():
+            name = self._clean_fieldname([prop['label']])[0]
+            if prop['type'] in type_dic_bq:
+                value = f"""safe_cast(json_value(x, '$."{code}"') as {type_dic_bq[prop['type']]})"""
+            elif prop['type'] in ('CHECK_BOX', 'MULTI_SELECT'):
+                value = f"""json_value_array(x, '$."{code}"')"""
+            else:
+                value = f"""coalesce(json_value(x, '$."{code}"'), json_query(x, '$."{code}"'))"""
+            members.append(f"{value} as `{name}`")
+        return f"array(select as struct {', '.join(members)} from unnest(json_query_array(`{column}`)) x) as `{column}`"
+
     def _rename_sql(self, table_name, old_names, new_name):
         """bigqueryのフィールド名を一括変換する"""
         cmd = f'alter table {table_name} '
@@ -268,13 +349,16 @@ class BQKintone:
         sql = cmd + ', '.join(rename) + ';'
         return sql
 
-    def _select(self, app_name, where=None, fields=None, limit=None):
+    def _select(self, app_name, where=None, fields=None, limit=None, store=None):
         """kintoneの情報を取得する"""
-        info = self.apps[app_name]
-        app = Kintone(info['api_token'], info['sub_domain'], info['app_id'])
-        res = app.select_all(where, fields, hard_limit=limit)
+        app = self._kintone(app_name)
+        res = app.select_all(where, fields, hard_limit=limit, store=store)
         return pd.DataFrame(res), app.fields
 
+    def _kintone(self, app_name):
+        info = self.apps[app_name]
+        return Kintone(info['api_token'], info['sub_domain'], info['app_id'], base_url=info.get('base_url'))
+
     def _create_schema(self, df, fields):
         '''
         フィールド定義からbiqrueryのスキーマを生成する
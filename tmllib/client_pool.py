@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import boto3
+
+
+class ClientPool:
+    u"""
+    プロセス内で共有する認証情報・クライアントのキャッシュ(スレッドセーフ)
+    SSM・S3クライアント、SSMパラメータ、Googleのサービスアカウント認証情報、bigquery.Clientをキー単位で1つだけ作成する。
+    認証情報を登録するとバックグラウンドスレッドで期限切れ前にトークンを更新する
+    """
+
+    refresh_interval = 60  # トークンの期限確認間隔(sec)
+    refresh_margin = 300  # 期限のこの秒数前になったら更新する
+
+    _lock = threading.RLock()
+    _ssm_clients = {}
+    _s3_clients = {}
+    _parameters = {}
+    _credentials = {}
+    _clients = {}
+    _refresher = None
+
+    @classmethod
+    def ssm_client(cls, region=None, profile=None):
+        with cls._lock:
+            key = (region, profile)
+            if key not in cls._ssm_clients:
+                session = boto3.Session(profile_name=profile, region_name=region)
+                cls._ssm_clients[key] = session.client('ssm')
+            return cls._ssm_clients[key]
+
+    @classmethod
+    def s3_client(cls, region=None, profile=None, max_pool_connections=32, endpoint_url=None):
+        """スレッド間で共有するS3クライアント(boto3のclientはスレッドセーフ)"""
+        from botocore.config import Config
+
+        key = (region, profile, max_pool_connections, endpoint_url)
+        with cls._lock:
+            if key not in cls._s3_clients:
+                session = boto3.Session(profile_name=profile, region_name=region)
+                config = Config(max_pool_connections=max_pool_connections, retries={'mode': 'adaptive'})
+                cls._s3_clients[key] = session.client('s3', config=config, endpoint_url=endpoint_url)
+            return cls._s3_clients[key]
+
+    @classmethod
+    def get_parameter(cls, name, region=None, profile=None):
+        """SSMのget_parameter(WithDecryption=True)のレスポンスをキャッシュして返す"""
+        key = (name, region, profile)
+        with cls._lock:
+            if key in cls._parameters:
+                return cls._parameters[key]
+        response = cls.ssm_client(region, profile).get_parameter(Name=name, WithDecryption=True)
+        with cls._lock:
+            return cls._parameters.setdefault(key, response)
+
+    @classmethod
+    def ssm_value(cls, name, region=None, profile=None):
+        return cls.get_parameter(name, region, profile)['Parameter']['Value']
+
+    @classmethod
+    def credentials(cls, account_type, json_key=None, region=None, profile=None):
+        """
+        サービスアカウントの認証情報を返す
+        account_type: 'file'(json_keyはファイルパス), 'ssm'(json_keyはSSMパラメータ名),
+                      'env'(GOOGLE_APPLICATION_CREDENTIALSのファイル)
+        """
+        from google.oauth2 import service_account
+
+        if account_type == 'env':
+            json_key = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+        key = cls._credential_key(account_type, json_key, region, profile)
+        with cls._lock:
+            if key in cls._credentials:
+                return cls._credentials[key]
+            if account_type == 'ssm':
+                info = json.loads(cls.ssm_value(json_key, region, profile))
+                cred = service_account.Credentials.from_service_account_info(info)
+            elif account_type in ('file', 'env'):
+                cred = service_account.Credentials.from_service_account_file(json_key)
+            else:
+                raise ValueError(f'unknown account_type: {account_type}')
+            cred = cred.with_scopes(['https://www.googleapis.com/auth/cloud-platform'])
+            cls._credentials[key] = cred
+            cls._start_refresher()
+            return cred
+
+    @classmethod
+    def bigquery_client(cls, project_id, account_type, json_key=None, region=None, profile=None):
+        from google.cloud import bigquery
+
+        cred = cls.credentials(account_type, json_key, region, profile)
+        if account_type == 'env':
+            json_key = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+        key = (project_id, cls._credential_key(account_type, json_key, region, profile))
+        with cls._lock:
+            if key not in cls._clients:
+                cls._clients[key] = bigquery.Client(project=project_id, credentials=cred)
+            return cls._clients[key]
+
+    @classmethod
+    def refresh(cls):
+        """期限切れ間近(または未取得)のトークンを更新する"""
+        from google.auth.transport.requests import Request
+
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        with cls._lock:
+            creds = list(cls._credentials.values())
+        for cred in creds:
+            if cred.token is not None and cred.expiry is not None \
+                    and (cred.expiry - now).total_seconds() > cls.refresh_margin:
+                continue
+            try:
+                cred.refresh(Request())
+            except Exception as e:
+                print(f'[WARNING] credential refresh failed: {type(e).__name__}: {e}')
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._ssm_clients = {}
+            cls._s3_clients = {}
+            cls._parameters = {}
+            cls._credentials = {}
+            cls._clients = {}
+
+    @classmethod
+    def _start_refresher(cls):
+        if cls._refresher is not None:
+            return
+        cls._refresher = threading.Thread(target=cls._refresh_loop, daemon=True)
+        cls._refresher.start()
+
+    @classmethod
+    def _refresh_loop(cls):
+        # 登録直後に1回取得し、以降はrefresh_intervalごとに期限を確認する
+        while True:
+            cls.refresh()
+            time.sleep(cls.refresh_interval)
+
+    @staticmethod
+    def _credential_key(account_type, json_key, region, profile):
+        account_type = getattr(account_type, 'value', account_type)
+        # file/envはファイルパスで識別できるのでregion, profileは使わない
+        if account_type in ('file', 'env'):
+            return ('file', json_key)
+        return (account_type, json_key, region, profile)
@@ -1,49 +1,596 @@
+import hashlib
+import io
+import json
 import pdb
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 import pandas as pd
 import redis
 
+
+class PickleCodec:
+    """1行(dict)をpickleでbytesに変換する"""
+
+    def encode_rows(self, df):
+        return [pickle.dumps(x, protocol=4) for x in df.to_dict('records')]
+
+    def decode_rows(self, values):
+        return pd.DataFrame.from_records([pickle.loads(x) for x in values])
+
+
+class JsonCodec:
+    """1行(dict)をjsonでbytesに変換する"""
+
+    def encode_rows(self, df):
+        return [json.dumps(x, ensure_ascii=False, default=str).encode() for x in df.to_dict('records')]
+
+    def decode_rows(self, values):
+        return pd.DataFrame.from_records([json.loads(x) for x in values])
+
+
+class MsgpackCodec:
+    """1行(dict)をmsgpackでbytesに変換する(msgpackが必要。pip install tmllib[msgpack])"""
+
+    def encode_rows(self, df):
+        import msgpack
+        return [msgpack.packb(x, default=str) for x in df.to_dict('records')]
+
+    def decode_rows(self, values):
+        import msgpack
+        return pd.DataFrame.from_records([msgpack.unpackb(x) for x in values])
+
+
+class ArrowCodec:
+    """
+    1行をArrow IPC形式でbytesに変換する(pyarrowが必要。pip install tmllib[arrow])
+    数値・日時などのdtypeが保持される(categoryは値の型になる)。
+    frame全体を1回でArrowに変換し、1行ごとのRecordBatchのメッセージに共通のスキーマのメッセージを付けて返す
+    (行ごとにIPCストリームを作らない。pandasのメタデータは付けない)。
+    読み込み時はスキーマごとにまとめて1つのTableにする
+    """
+
+    def encode_rows(self, df):
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # 辞書型(category)は辞書のメッセージが別に必要なので値の型に戻す
+        columns = [x.cast(x.type.value_type) if pa.types.is_dictionary(x.type) else x for x in table.columns]
+        table = pa.Table.from_arrays(columns, names=table.column_names).combine_chunks()
+        schema = table.schema.serialize().to_pybytes()
+        return [schema + x.serialize().to_pybytes() for x in table.to_batches(max_chunksize=1)]
+
+    def decode_rows(self, values):
+        import pyarrow as pa
+
+        if len(values) == 0:
+            return pd.DataFrame()
+        schemas = {}
+        batches = []
+        for x in values:
+            reader = pa.ipc.MessageReader.open_stream(pa.py_buffer(x))
+            header, body = reader.read_next_message(), reader.read_next_message()
+            key = header.metadata.to_pybytes()
+            if key not in schemas:
+                schemas[key] = pa.ipc.read_schema(header)
+            batches.append(pa.ipc.read_record_batch(body, schemas[key]))
+        if len(schemas) == 1:
+            return pa.Table.from_batches(batches).to_pandas()
+        # 書き込み時期によってスキーマが違う行は、それぞれTableにしてから結合する
+        tables = [pa.Table.from_batches([x]) for x in batches]
+        return pa.concat_tables(tables, promote_options='permissive').to_pandas()
+
+
+CODECS = {
+    'pickle': PickleCodec,
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec,
+    'arrow': ArrowCodec,
+}
+
+# loaderが値を返さなかったキーの目印
+_MISSING = object()
+
+
 class Redis:
     u"""
     Redis接続クラス
+    write_frame/read_frameでDataFrameを1行1キーの特徴量ストアとして読み書きする
+    codec: 値の変換方式('pickle', 'json', 'msgpack', 'arrow')
+    cluster: ElastiCacheのクラスターモード(有効)の場合True。mget/msetはキーをハッシュスロットで
+             ノードごとに分け、ノード単位のpipelineをworkers並列で送信する(dbは0のみ)
+    接続プールは同じ接続先(host, port, db, 設定)でプロセス内共有する
     """
 
-    def __init__(self, host = '', db = 0, is_debug=False):
+    _lock = threading.Lock()
+    _pools = {}
+
+    def __init__(self, host = '', db = 0, is_debug=False, codec='pickle', batch_size=10000, port=6379,
+                 cluster=False, max_connections=50, socket_timeout=None, socket_connect_timeout=None, workers=8):
         self.is_debug = is_debug
         self.host = host
+        self.port = port
         self.__conn = None
         self.__db = db
+        self.codec = codec
+        self.batch_size = batch_size
+        self.cluster = cluster
+        self.max_connections = max_connections
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.workers = workers
+        if cluster and db not in (0, ''):
+            raise ValueError('cluster mode supports db 0 only')
 
     @property
     def conn(self):
         if self.__conn is not None:
             return self.__conn
-        self.__conn = redis.Redis(host = self.host, port = 6379, db = self.db)
+        if self.cluster:
+            from redis.cluster import RedisCluster
+            self.__conn = RedisCluster(host=self.host, port=self.port, max_connections=self.max_connections,
+                                       **self._socket_options())
+        else:
+            self.__conn = redis.Redis(connection_pool=self._pool())
         return self.__conn
 
     @property
     def db(self):
         return self.__db
-        
+
     @db.setter
     def db(self, value):
-        if value != '':
-            self.__db = value
-            self.__conn = redis.Redis(host = self.host, port = 6379, db = self.__db)
-        
-    def set(self, key, value):
-        self.conn.set(key.value)
-        return df
-    
+        if value == '' or value == self.__db:
+            return
+        if self.cluster:
+            raise ValueError('cluster mode supports db 0 only')
+        # 次にconnを使うときに新しいdbのプールから接続する
+        self.__db = value
+        self.__conn = None
+
+    def _pool(self):
+        key = (self.host, self.port, self.db, self.max_connections, self.socket_timeout, self.socket_connect_timeout)
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = redis.BlockingConnectionPool(
+                    host=self.host, port=self.port, db=self.db, max_connections=self.max_connections,
+                    **self._socket_options())
+            return self._pools[key]
+
+    def _socket_options(self):
+        return {'socket_timeout': self.socket_timeout, 'socket_connect_timeout': self.socket_connect_timeout}
+
+    def set(self, key, value, ttl=None):
+        return self.conn.set(key, value, ex=ttl)
+
     def get(self, key):
-        self.conn.get(key.value)
-        return df
-    
-    def mset(self, data):
-        return self.conn.mset(data)
-    
+        return self.conn.get(key)
+
+    def mset(self, data, ttl=None):
+        """batch_size件ずつpipelineで書き込む。ttlを指定した場合はキーごとに有効期限を付ける"""
+        if self.cluster:
+            return self._cluster_mset(data, ttl)
+        items = list(data.items())
+        for i in range(0, len(items), self.batch_size):
+            pipe = self.conn.pipeline(transaction=False)
+            self._pipe_set(pipe, items[i:i + self.batch_size], ttl)
+            pipe.execute()
+        return True
+
     def mget(self,keys):
-        return self.conn.mget(keys)
-    
+        """batch_size件ずつに分割して取得する"""
+        keys = list(keys)
+        if self.cluster:
+            return self._cluster_mget(keys)
+        values = []
+        for i in range(0, len(keys), self.batch_size):
+            values += self.conn.mget(keys[i:i + self.batch_size])
+        return values
+
     def mget_map(self,keys):
-         return dict(zip(keys, self.conn.mget(keys)))
-    
+         return dict(zip(keys, self.mget(keys)))
+
+    def write_frame(self, df, key_column, prefix='', ttl=None, codec=None):
+        """
+        dataframeを1行1キーで書き込む。キーは prefix + key_columnの値
+        batch_size件ごとにpipelineでまとめて送信する。戻り値は書き込んだ件数
+        """
+        codec = self._codec(codec)
+        keys = (prefix + df[key_column].astype(str)).tolist()
+        values = codec.encode_rows(df.drop(columns=key_column))
+        self.mset(dict(zip(keys, values)), ttl)
+        if self.is_debug: print('write_frame:', len(keys))
+        return len(keys)
+
+    def read_frame(self, ids, key_column='id', prefix='', codec=None):
+        """
+        write_frameで書き込んだ行をidsの順にdataframeで返す。存在しないキーの行は欠損値になる
+        """
+        ids = pd.Series(list(ids))
+        values = self.mget((prefix + ids.astype(str)).tolist())
+        return self._to_frame(ids, values, key_column, codec)
+
+    def _to_frame(self, ids, values, key_column, codec):
+        codec = self._codec(codec)
+        values = pd.Series(values, dtype=object)
+        found = values.notna().to_numpy()
+        df = codec.decode_rows(values[found].tolist())
+        df.index = ids.index[found]
+        df = df.reindex(ids.index)
+        df.insert(0, key_column, ids)
+        return df
+
+    def _codec(self, codec):
+        codec = codec if codec is not None else self.codec
+        return CODECS[codec]() if isinstance(codec, str) else codec
+
+    @staticmethod
+    def _pipe_set(pipe, items, ttl):
+        if ttl is None:
+            # クラスターのpipelineはmset()を使えないためコマンドで送る(itemsは同じスロット)
+            pipe.execute_command('MSET', *[x for kv in items for x in kv])
+        else:
+            for k, v in items:
+                pipe.set(k, v, ex=ttl)
+
+    def _slot_chunks(self, keys):
+        """keysの位置をハッシュスロットごとにまとめ、batch_size件ずつに分割する"""
+        slots = {}
+        for i, k in enumerate(keys):
+            slots.setdefault(self.conn.keyslot(k), []).append(i)
+        return [(slot, index[i:i + self.batch_size])
+                for slot, index in slots.items() for i in range(0, len(index), self.batch_size)]
+
+    def _by_node(self, keys):
+        """{ノード名: (ノード, [スロット内のkeysの位置])}"""
+        nodes = {}
+        for slot, index in self._slot_chunks(keys):
+            node = self.conn.nodes_manager.get_node_from_slot(slot)
+            nodes.setdefault(node.name, (node, []))[1].append(index)
+        return nodes
+
+    def _run_nodes(self, nodes, func):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(nodes)))) as executor:
+            futures = [executor.submit(func, self.conn.get_redis_connection(node), chunks)
+                       for node, chunks in nodes.values()]
+            return [f.result() for f in futures]
+
+    def _cluster_mget(self, keys):
+        values = [None] * len(keys)
+
+        def fetch(client, chunks):
+            # 同じスロットのキーはmget 1回で取得できる
+            pipe = client.pipeline(transaction=False)
+            for index in chunks:
+                pipe.mget([keys[i] for i in index])
+            for index, result in zip(chunks, pipe.execute()):
+                for i, v in zip(index, result):
+                    values[i] = v
+
+        self._run_nodes(self._by_node(keys), fetch)
+        return values
+
+    def _cluster_mset(self, data, ttl=None):
+        items = list(data.items())
+
+        def store(client, chunks):
+            pipe = client.pipeline(transaction=False)
+            for index in chunks:
+                self._pipe_set(pipe, [items[i] for i in index], ttl)
+            pipe.execute()
+
+        self._run_nodes(self._by_node([k for k, _ in items]), store)
+        return True
+
+
+class AsyncRedis(Redis):
+    u"""
+    Redis接続クラスのasyncio版(redis.asyncio)。引数はRedisと同じ
+    cluster=Trueの場合、スロット単位のコマンドをpipelineにまとめ、ノードごとに並列に送信する
+
+    ex)
+        r = AsyncRedis(host, cluster=True)
+        df = await r.read_frame(ids, prefix='feature:')
+        await r.close()
+    """
+
+    @property
+    def conn(self):
+        # 接続プールはイベントループに紐づくためインスタンスごとに作成する
+        if self._Redis__conn is not None:
+            return self._Redis__conn
+        if self.cluster:
+            from redis.asyncio.cluster import RedisCluster
+            self._Redis__conn = RedisCluster(host=self.host, port=self.port, max_connections=self.max_connections,
+                                             **self._socket_options())
+        else:
+            import redis.asyncio
+            self._Redis__conn = redis.asyncio.Redis(host=self.host, port=self.port, db=self.db,
+                                                    max_connections=self.max_connections, **self._socket_options())
+        return self._Redis__conn
+
+    async def close(self):
+        if self._Redis__conn is not None:
+            await self._Redis__conn.aclose()
+            self._Redis__conn = None
+
+    async def set(self, key, value, ttl=None):
+        return await self.conn.set(key, value, ex=ttl)
+
+    async def get(self, key):
+        return await self.conn.get(key)
+
+    async def mset(self, data, ttl=None):
+        items = list(data.items())
+        if self.cluster:
+            await self._cluster_pipeline([k for k, _ in items], lambda pipe, index:
+                                         self._pipe_set(pipe, [items[i] for i in index], ttl))
+            return True
+        for i in range(0, len(items), self.batch_size):
+            pipe = self.conn.pipeline(transaction=False)
+            self._pipe_set(pipe, items[i:i + self.batch_size], ttl)
+            await pipe.execute()
+        return True
+
+    async def mget(self, keys):
+        keys = list(keys)
+        if self.cluster:
+            values = [None] * len(keys)
+            for index, result in await self._cluster_pipeline(keys, lambda pipe, index:
+                                                              pipe.execute_command('MGET', *[keys[i] for i in index])):
+                for i, v in zip(index, result):
+                    values[i] = v
+            return values
+        values = []
+        for i in range(0, len(keys), self.batch_size):
+            values += await self.conn.mget(keys[i:i + self.batch_size])
+        return values
+
+    async def mget_map(self, keys):
+        return dict(zip(keys, await self.mget(keys)))
+
+    async def write_frame(self, df, key_column, prefix='', ttl=None, codec=None):
+        codec = self._codec(codec)
+        keys = (prefix + df[key_column].astype(str)).tolist()
+        values = codec.encode_rows(df.drop(columns=key_column))
+        await self.mset(dict(zip(keys, values)), ttl)
+        if self.is_debug: print('write_frame:', len(keys))
+        return len(keys)
+
+    async def read_frame(self, ids, key_column='id', prefix='', codec=None):
+        ids = pd.Series(list(ids))
+        values = await self.mget((prefix + ids.astype(str)).tolist())
+        return self._to_frame(ids, values, key_column, codec)
+
+    async def _cluster_pipeline(self, keys, command):
+        """
+        スロット単位にcommandを積んだpipelineを実行し、[(keysの位置, 結果)]を返す
+        クラスターのpipelineはノードごとに分けてasyncio.gatherで並列に送信される
+        """
+        chunks = [index for _, index in self._slot_chunks(keys)]
+        pipe = self.conn.pipeline()
+        for index in chunks:
+            command(pipe, index)
+        return list(zip(chunks, await pipe.execute()))
+
+
+class LRUCache:
+    """
+    プロセス内のLRUキャッシュ(スレッドセーフ)。maxsize件とttl秒で制限する
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """(見つかったか, 値)を返す"""
+        with self._lock:
+            if key not in self._data:
+                return False, None
+            expire, value = self._data[key]
+            if expire < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredCache:
+    u"""
+    プロセス内LRU → Redis → loader の2層キャッシュ(read-through / write-through)
+    ・取得できた値は上位の層に書き戻す
+    ・同じキーの同時ミスはloaderを1回だけ呼ぶ(single-flight)
+    ・invalidation=Trueの場合、Redisのkeyspace通知で他プロセスの更新をLRUから削除する
+      (ElastiCacheではパラメータグループでnotify-keyspace-eventsの設定が必要)。
+      自分が書き込んだキーの通知は、Redisの値が書き込んだ値と同じであれば無視する
+
+    redis: elasticcache.Redis
+    loader: 見つからなかったキーのlistを受け取り、{キー: 値}を返す関数(BigQuery/Auroraからの一括取得など)
+    serializer: Redisに保存する値の変換(dumps/loadsを持つもの)
+
+    ex)
+        cache = TieredCache(Redis(host), loader=lambda ids: load_features(ids), prefix='feature:')
+        values = cache.get_many(ids)
+        print(cache.stats)
+    """
+
+    def __init__(self, redis, loader=None, maxsize=10000, local_ttl=60, redis_ttl=None, prefix='',
+                 serializer=pickle, invalidation=False):
+        self.redis = redis
+        self.loader = loader
+        # LRUのキーはRedisと揃えてstrで保持する
+        self.local = LRUCache(maxsize, local_ttl)
+        self.redis_ttl = redis_ttl
+        self.prefix = prefix
+        self.serializer = serializer
+        self.stats = {
+            'local': {'hits': 0, 'misses': 0},
+            'redis': {'hits': 0, 'misses': 0},
+            'loader': {'calls': 0, 'keys': 0},
+        }
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._listener = None
+        # このインスタンスが書き込んだ値のハッシュ。keyspace通知が自分の書き込みによるものかの判定に使う
+        self._written = LRUCache(maxsize, local_ttl)
+        if invalidation:
+            self.start_invalidation()
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        """見つかったキーの{キー: 値}を返す"""
+        result = {}
+        missing = []
+        for k in keys:
+            found, value = self.local.get(str(k))
+            if found:
+                result[k] = value
+            else:
+                missing.append(k)
+        self._count('local', len(keys) - len(missing), len(missing))
+        if len(missing) == 0:
+            return result
+
+        values = self.redis.mget([self.prefix + str(k) for k in missing])
+        remain = []
+        for k, v in zip(missing, values):
+            if v is None:
+                remain.append(k)
+                continue
+            value = self.serializer.loads(v)
+            self.local.set(str(k), value)
+            result[k] = value
+        self._count('redis', len(missing) - len(remain), len(remain))
+        if len(remain) == 0 or self.loader is None:
+            return result
+
+        result |= self._load(remain)
+        return result
+
+    def set(self, key, value):
+        """Redisとプロセス内LRUの両方に書き込む"""
+        self.set_many({key: value})
+
+    def set_many(self, data):
+        encoded = {str(k): self.serializer.dumps(v) for k, v in data.items()}
+        if self._listener is not None:
+            for k, v in encoded.items():
+                self._written.set(k, self._digest(v))
+        self.redis.mset({self.prefix + k: v for k, v in encoded.items()}, ttl=self.redis_ttl)
+        for k, v in data.items():
+            self.local.set(str(k), v)
+
+    def delete(self, key):
+        self.redis.conn.delete(self.prefix + str(key))
+        self.local.delete(str(key))
+
+    def hit_ratio(self):
+        """層ごとのヒット率"""
+        return {
+            k: v['hits'] / (v['hits'] + v['misses']) if v['hits'] + v['misses'] > 0 else None
+            for k, v in self.stats.items() if 'hits' in v
+        }
+
+    def _load(self, keys):
+        # 他スレッドが取得中のキーは完了を待ち、それ以外は自分でloaderを呼ぶ
+        with self._lock:
+            mine = [k for k in keys if k not in self._inflight]
+            for k in mine:
+                self._inflight[k] = Future()
+            waiting = {k: self._inflight[k] for k in keys if k not in mine}
+
+        result = {}
+        if len(mine) > 0:
+            try:
+                loaded = self.loader(mine) or {}
+                with self._lock:
+                    self.stats['loader']['calls'] += 1
+                    self.stats['loader']['keys'] += len(mine)
+                if len(loaded) > 0:
+                    self.set_many(loaded)
+                result |= loaded
+                for k in mine:
+                    self._inflight[k].set_result(loaded.get(k, _MISSING))
+            except Exception as e:
+                for k in mine:
+                    self._inflight[k].set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    for k in mine:
+                        self._inflight.pop(k, None)
+
+        for k, future in waiting.items():
+            value = future.result()
+            if value is not _MISSING:
+                result[k] = value
+        return result
+
+    def _count(self, tier, hits, misses):
+        with self._lock:
+            self.stats[tier]['hits'] += hits
+            self.stats[tier]['misses'] += misses
+
+    def start_invalidation(self):
+        """keyspace通知を購読し、更新・削除・期限切れになったキーをLRUから削除する"""
+        if self._listener is not None:
+            return
+        try:
+            self.redis.conn.config_set('notify-keyspace-events', 'Kg$x')
+        except Exception as e:
+            # ElastiCacheなどCONFIGが使えない環境ではパラメータグループで設定する
+            if self.redis.is_debug: print('config_set failed:', e)
+        channel = f'__keyspace@{self.redis.db}__:'
+        pubsub = self.redis.conn.pubsub(ignore_subscribe_messages=True)
+
+        def invalidate(message):
+            name = message['channel']
+            name = name.decode() if isinstance(name, bytes) else name
+            key = name[len(channel) + len(self.prefix):]
+            # 自分の書き込みの通知は、Redisの値が書き込んだ値のままなら無視する(LRUに入れた値が最新)
+            found, digest = self._written.get(key)
+            if found:
+                value = self.redis.conn.get(self.prefix + key)
+                if value is not None and self._digest(value) == digest:
+                    return
+                self._written.delete(key)
+            self.local.delete(key)
+
+        pubsub.psubscribe(**{f'{channel}{self.prefix}*': invalidate})
+        self._listener = pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+    def stop_invalidation(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    @staticmethod
+    def _digest(value):
+        return hashlib.blake2b(value, digest_size=16).digest()
+
@@ -0,0 +1,122 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+
+class CategoryEncoder:
+    u"""
+    カテゴリ値をIDに変換する(学習時に作った語彙を推論時にも使う)
+    語彙はfit時の値をソートしたもので、IDはその位置(0〜len(categories)-1)。
+    語彙にない値と欠損値はunknown_id(既定はlen(categories))に変換する
+
+    ex)
+        encoder = CategoryEncoder().fit(train['tag'])
+        encoder.save('tag.pkl')
+        ...
+        encoder = CategoryEncoder.load('tag.pkl')
+        df['tag_id'] = encoder.transform(df['tag'])
+    """
+
+    def __init__(self, unknown_id=None, dtype='int32'):
+        self.unknown_id = unknown_id
+        self.dtype = dtype
+        self.categories = None
+        self._index = None
+
+    def fit(self, values):
+        uniques = pd.unique(pd.Series(values).dropna())
+        self.categories = sorted(uniques.tolist())
+        self._index = pd.Index(self.categories)
+        return self
+
+    def transform(self, values):
+        """IDのSeries(valuesがSeriesの場合は同じindex)を返す"""
+        if self._index is None:
+            raise ValueError('CategoryEncoder is not fitted')
+        index = values.index if isinstance(values, pd.Series) else None
+        # 語彙にない値は-1になる
+        codes = self._index.get_indexer(pd.Series(values).to_numpy())
+        if (codes < 0).any():
+            codes = np.where(codes < 0, self.unknown, codes)
+        return pd.Series(codes.astype(self.dtype), index=index)
+
+    def fit_transform(self, values):
+        return self.fit(values).transform(values)
+
+    def inverse_transform(self, ids):
+        """IDをカテゴリ値に戻す。unknown_idはNoneになる"""
+        ids = np.asarray(ids)
+        categories = np.array(self.categories + [None], dtype=object)
+        known = (ids >= 0) & (ids < len(self.categories))
+        return categories[np.where(known, ids, len(self.categories))]
+
+    @property
+    def unknown(self):
+        return self.unknown_id if self.unknown_id is not None else len(self.categories)
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump({'categories': self.categories, 'unknown_id': self.unknown_id, 'dtype': self.dtype}, f,
+                        protocol=4)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        encoder = cls(unknown_id=state['unknown_id'], dtype=state['dtype'])
+        encoder.categories = state['categories']
+        encoder._index = pd.Index(encoder.categories)
+        return encoder
+
+
+class FrameAligner:
+    u"""
+    dataframeのカラムを学習時の構造(frame)に揃える
+    カラムの並び・dtypeをframeから事前に計算しておき、reindexとastypeを1回ずつで変換する。
+    足りないカラムは欠損値(整数・bool型は0)で補完する
+
+    transformは新しいdataframeを返す(元のdataframeは変更しない)。その場で揃える場合はupdateを使う
+
+    ex)
+        aligner = FrameAligner(train_x.head(0))
+        x = aligner.transform(pd.get_dummies(batch))
+    """
+
+    def __init__(self, frame):
+        self.columns = frame.columns
+        self.dtypes = frame.dtypes.to_dict()
+        # 欠損値を持てないdtypeは0で補完する
+        self.zero_fill = [
+            c for c, t in self.dtypes.items() if pd.api.types.is_integer_dtype(t) or pd.api.types.is_bool_dtype(t)
+        ]
+
+    def transform(self, df, drop=True):
+        """drop=Falseの場合、frameにないカラムも残す(dfのカラムの後ろに不足カラムを追加)"""
+        missing = self.columns.difference(df.columns, sort=False)
+        columns = self.columns if drop else df.columns.append(missing)
+        result = df.reindex(columns=columns)
+        fill = [c for c in self.zero_fill if c in missing]
+        if len(fill) > 0:
+            result[fill] = 0
+        # dtypeが異なるカラムだけ変換する
+        current = result.dtypes
+        dtypes = {c: t for c, t in self.dtypes.items() if current[c] != t}
+        if len(dtypes) > 0:
+            result = result.astype(dtypes)
+        return result
+
+    def update(self, df, drop=True):
+        """
+        dfをその場で揃えて返す(transformと違いカラムの並びはdfのままで、不足カラムは末尾に追加する)
+        drop=Trueの場合、frameにないカラムは削除する
+        """
+        missing = self.columns.difference(df.columns, sort=False)
+        for c in missing:
+            df[c] = 0 if c in self.zero_fill else np.nan
+        changed = [c for c, t in self.dtypes.items() if df[c].dtype != t]
+        for c in changed:
+            df[c] = df[c].astype(self.dtypes[c])
+        if drop:
+            df.drop(columns=df.columns.difference(self.columns, sort=False), inplace=True)
+        return df
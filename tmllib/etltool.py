@@ -6,18 +6,13 @@ import pickle
 import re
 from collections import Counter
 from datetime import datetime
-import subprocess
 import concurrent.futures
 from datetime import datetime
 from shutil import move
 import glob
 
-import pandas as pd
-import numpy as np
 import pytz
-from sklearn.model_selection import train_test_split
 import itertools
-import boto3
 
 
 class EtlHelper:
@@ -37,23 +32,26 @@ class EtlHelper:
         with open(filename, 'rb') as f:
             return pickle.load(f)
 
+    # pandas, numpy, boto3, sklearnはimport時間が長いので使うメソッドの中でimportする
+    # (StopWatchやdump/loadだけを使う場合に読み込まないため)
     def s3cp(self, src, dest, s3_region=None):
-        opt = '--region={}'.format(s3_region) if s3_region is not None else ''
-        print(['aws', opt, 's3', 'cp', src, dest])
-        subprocess.call(['aws', opt, 's3', 'cp', src, dest])
+        from .awstool import AWSTool
+
+        if self.is_debug: print('s3cp:', src, dest)
+        return AWSTool().init_s3(s3_region).cp(src, dest)
 
     def s3sync(self, src, dest, s3_region=None):
-        opt = '--region={}'.format(s3_region) if s3_region is not None else ''
-        print(subprocess.call(['aws', opt, 's3', 'sync', src, dest]))
+        from .awstool import AWSTool
+
+        files = AWSTool().init_s3(s3_region).sync(src, dest)
+        if self.is_debug: print('s3sync:', len(files), 'files')
+        return files
 
     def read_ssm(self, key, region=None):
-        #TODO: regionを反映
-        client = boto3.client('ssm')
-        response = client.get_parameter(
-            Name=key,
-            WithDecryption=True,
-        )
-        return response
+        """SSMパラメータを取得する(プロセス内でキャッシュ)"""
+        from .client_pool import ClientPool
+
+        return ClientPool.get_parameter(key, region=region)
 
     # rekognition用のmanifestファイルを作成する
     def make_manifest(self, df, filename):
@@ -62,6 +60,8 @@ class EtlHelper:
         dfx[['source-ref']].to_json(filename, orient='records', force_ascii=False, lines=True)
 
     def display(self, line, *x):
+        import pandas as pd
+
         min_rows = pd.options.display.min_rows
         max_rows = pd.options.display.max_rows
         pd.options.display.min_rows = line
@@ -71,25 +71,26 @@ class EtlHelper:
         pd.options.display.max_rows = max_rows
 
     def category2id(self, categories):
-        tag_idx = sorted(set(categories))
-        tag_dic = dict(zip(tag_idx, range(len(tag_idx))))
-        return categories.map(tag_dic), tag_idx
+        """
+        カテゴリをIDに変換し、(IDのSeries, 語彙のlist)を返す
+        推論時にも同じ語彙を使う場合はCategoryEncoderをfitして保存する
+        """
+        from .encoder import CategoryEncoder
+
+        encoder = CategoryEncoder(dtype='int64').fit(categories)
+        return encoder.transform(categories), encoder.categories
 
-    def adjust_frame(self, df, frame, drop=True):
+    def adjust_frame(self, df, frame, drop=True, inplace=True):
         """
         空フレームを呼び出してカラムをtrain時の構造に一致させる(欠損しているダミーフィールドを補完)
+        inplace=True: 従来どおりdfをその場で変更して返す(カラムの並びはdfのまま、不足カラムは末尾)
+        inplace=False: dfは変更せず、frameのカラム順に並べた新しいdataframeを返す(大きいdataframeではこちらが速い)
+        推論のたびに呼ぶ場合はFrameAlignerを作っておいて使い回す
         """
-        columns_diff = set(frame.columns) - set(df.columns)
-        for x in columns_diff:
-            df[x] = frame[x]
-        for x in frame:
-            df[x] = df[x].astype(frame[x].dtype)
-
-        if drop:
-            columns_diff = set(df.columns) - set(frame.columns)
-            for x in columns_diff:
-                df.drop(x, axis=1, inplace=True)
-        return df
+        from .encoder import FrameAligner
+
+        aligner = FrameAligner(frame)
+        return aligner.update(df, drop) if inplace else aligner.transform(df, drop)
 
     def execute(self, method, filename, **kwargs):
         if self.use_cache and os.path.isfile(filename):
@@ -206,53 +207,95 @@ class EtlHelper:
                 results += self.load(x)
         return results
 
-    def train_valid_test_split(self, df, train_size, valid_size=None, stratify=None):
-        if valid_size is None:
-            valid_size = (1 - train_size) / 2
-        remain_valid_size = valid_size / (1 - train_size)
-        train, remain = train_test_split(df.copy(), train_size=train_size,
-                                         stratify=df[stratify] if stratify in df else None, random_state=13)
-        valid, test = train_test_split(remain.copy(), train_size=remain_valid_size,
-                                       stratify=remain[stratify] if stratify in df else None, random_state=13)
-        return train, valid, test
-
-    def timeline_split(self, df, train_size, valid_size=None, stratify=None, orderby=None):
+    SPLITS = ['train', 'valid', 'test']
+
+    def train_valid_test_split(self, df, train_size, valid_size=None, stratify=None, random_state=13):
+        """ランダム(stratify指定時は層別)に分割し、シャッフルした(train, valid, test)を返す"""
+        index = self.split_index(df, train_size, valid_size, stratify, random_state=random_state)
+        return tuple(df.iloc[x] for x in index)
+
+    def timeline_split(self, df, train_size, valid_size=None, stratify=None, orderby=None, random_state=0):
+        """
+        orderbyの順(省略時は行の順)に先頭からtrain, valid, testに分割し、それぞれシャッフルして返す
+        stratify(カラム名またはそのlist)を指定した場合はグループごとに分割する
+        """
+        index = self.split_index(df, train_size, valid_size, stratify, 'timeline', orderby, random_state=random_state)
+        return tuple(df.iloc[x] for x in index)
+
+    def split_index(self, df, train_size, valid_size=None, stratify=None, method='random', orderby=None,
+                    shuffle=True, random_state=13):
+        """
+        (train, valid, test)の行位置(ilocで使う整数のndarray)を返す。dfはコピーしない
+        method: 'random'(ランダム) または 'timeline'(orderbyの順、省略時は行の順に先頭から分割)
+        shuffle=Falseの場合は各分割内を元の行順で返す
+        """
+        import numpy as np
+
+        labels = self._split_codes(df, train_size, valid_size, stratify, method, orderby, random_state)
+        rng = np.random.default_rng(random_state)
+        index = []
+        for i in range(len(self.SPLITS)):
+            x = np.flatnonzero(labels == i)
+            index.append(rng.permutation(x) if shuffle else x)
+        return tuple(index)
+
+    def split_label(self, df, train_size, valid_size=None, stratify=None, method='random', orderby=None,
+                    merge_column='tvt', random_state=13):
+        """
+        分割結果('train', 'valid', 'test'のcategory型)をmerge_columnに設定してdfを返す(dfを直接変更する)
+        merge_tvtの代わりに使うと、train/valid/testの3つのdataframeを作らずに済む
+        """
+        import pandas as pd
+
+        labels = self._split_codes(df, train_size, valid_size, stratify, method, orderby, random_state)
+        df[merge_column] = pd.Categorical.from_codes(labels, self.SPLITS)
+        return df
+
+    def _split_codes(self, df, train_size, valid_size, stratify, method, orderby, random_state):
+        """行ごとの分割(0: train, 1: valid, 2: test)を返す。グループ内の順位をまとめて計算する"""
+        import numpy as np
+
         if valid_size is None:
             valid_size = (1 - train_size) / 2
-
+        n = len(df)
+        if method == 'random':
+            order = np.random.default_rng(random_state).permutation(n)
+        elif method != 'timeline':
+            raise ValueError(f'unknown method: {method}')
+        elif orderby is None:
+            order = np.arange(n)
+        else:
+            keys = [df[x].to_numpy() for x in ([orderby] if isinstance(orderby, str) else orderby)]
+            order = np.lexsort(keys[::-1])
         if stratify is not None:
-            train, valid, test = [], [], []
-            for name, group in df.groupby(stratify):
-                tr, va, te = self._split(group, train_size, valid_size, orderby)
-                train.append(tr)
-                valid.append(va)
-                test.append(te)
-            train = pd.concat(train)
-            valid = pd.concat(valid)
-            test = pd.concat(test)
+            # stratifyはカラム名かカラム名のlist。欠損値も1つのグループにする
+            groups = df.groupby(stratify, sort=False, dropna=False).ngroup().to_numpy()
+            order = order[np.argsort(groups[order], kind='stable')]
+            counts = np.bincount(groups)
+            sizes = counts[groups[order]]
+            position = np.arange(n) - (np.cumsum(counts) - counts)[groups[order]]
         else:
-            train, valid, test = self._split(df, train_size, valid_size, orderby)
-        return train, valid, test
-
-    def _split(self, dfx, train_size, valid_size, orderby):
-        if orderby is not None: df = dfx.sort_values(orderby)
-        maxlen = len(df)
-        train_max = math.ceil(maxlen * train_size)
-        valid_max = train_max + math.ceil(maxlen * valid_size)
-        train = df[0:train_max].sample(frac=1, random_state=0)
-        valid = df[train_max:valid_max].sample(frac=1, random_state=0)
-        test = df[valid_max:].sample(frac=1, random_state=0)
-        return train, valid, test
+            sizes = n
+            position = np.arange(n)
+        train_max = np.ceil(sizes * train_size)
+        valid_max = train_max + np.ceil(sizes * valid_size)
+        codes = np.empty(n, dtype=np.int8)
+        codes[order] = np.where(position < train_max, 0, np.where(position < valid_max, 1, 2))
+        return codes
 
     def merge_tvt(self, merge_column, train, valid, test):
-        train[merge_column] = 'train'
-        valid[merge_column] = 'valid'
-        test[merge_column] = 'test'
-        df = pd.concat([train, valid, test])
-        df = df.reset_index(drop=True)
+        """train, valid, testを結合し、merge_columnに分割名を設定する(引数のdataframeは変更しない)"""
+        import numpy as np
+        import pandas as pd
+
+        df = pd.concat([train, valid, test], ignore_index=True)
+        codes = np.repeat(np.arange(len(self.SPLITS), dtype=np.int8), [len(train), len(valid), len(test)])
+        df[merge_column] = pd.Categorical.from_codes(codes, self.SPLITS)
         return df
 
     def show_posneg_matrix(self, df, dependant, merge_column):
+        import pandas as pd
+
         stat = pd.DataFrame(
             {
                 'all': Counter(df[dependant]),
@@ -265,6 +308,9 @@ class EtlHelper:
         display(stat)
 
     def freq(self, data, class_width=None):
+        import numpy as np
+        import pandas as pd
+
         data = np.asarray(data)
         if class_width is None:
             class_size = int(np.log2(data.size).round()) + 1
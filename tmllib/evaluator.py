@@ -1,6 +1,8 @@
+import numpy as np
 import pandas as pd
-import sklearn.metrics as mt
-import traceback
+
+from .importance import PermutationImportance
+from .metrics import MetricsEngine, StreamingEvaluator, evaluate_partition
 
 
 class Evaluator:
@@ -38,6 +40,18 @@ class Evaluator:
     def show_importances(self, clf, test_X=None, test_y=None, pred_y=None):
         self.show_importance(clf.feature_importances_, test_X, pred_y)
 
+    def permutation_importance(self, clf, test_X, test_y, **kwargs):
+        """
+        permutation(またはmethod='drop'でdrop-column)重要度をDataFrameで返す
+        kwargsはPermutationImportanceの引数(n_repeats, max_samples, workers, batch_size, tolなど)
+        """
+        return PermutationImportance(**kwargs).fit(clf, test_X, test_y, self.train_X, self.train_y)
+
+    def show_permutation_importance(self, clf, test_X, test_y, num=20, **kwargs):
+        importance = self.permutation_importance(clf, test_X, test_y, **kwargs)
+        self.show_importance(importance['importance'].to_numpy(), test_X, num=num)
+        return importance
+
     def printfull(self, x):
         max_rows = pd.get_option('display.max_rows')
         pd.set_option('display.max_rows', None)
@@ -54,30 +68,50 @@ class Evaluator:
             except NameError:
                 print(x.head(num))
 
+    def evaluate(self, test_y, pred_y=None, prob_y=None, classes=None, n_thresholds=101):
+        """評価指標をまとめて計算してEvaluationResultを返す(MetricsEngine.evaluate)"""
+        return MetricsEngine(n_thresholds).evaluate(test_y, pred_y, prob_y, classes)
+
+    def evaluate_stream(self, chunks, classes, bins=1000, calibration_bins=10):
+        """
+        (test_y, pred_y, prob_y)のタプルを返すgeneratorを逐次集計してEvaluationResultを返す
+        pred_y, prob_yは不要ならNoneにする。ROC/PRはbins区間の近似値
+        """
+        return StreamingEvaluator(classes, bins, calibration_bins).update_all(chunks).result()
+
+    def evaluate_partitions(self, load, partitions, classes, workers=4, bins=1000, calibration_bins=10):
+        """
+        パーティションごとにプロセスを分けて集計し、結果をmergeする
+        load: パーティションを受け取り(test_y, pred_y, prob_y)のタプルを返すgenerator関数(pickleできるモジュール関数)
+        ex) partitions=['2024-01-01', '2024-01-02', ...]、loadは日付ごとにBigQuery/Auroraから読み込む
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        kwargs = {'bins': bins, 'calibration_bins': calibration_bins}
+        total = StreamingEvaluator(classes, **kwargs)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for x in executor.map(evaluate_partition, [(load, p, classes, kwargs) for p in partitions]):
+                total.merge(x)
+        return total.result()
+
     def show_valuation(self, test_y, pred_y, prob_y=None):
         print("...valuation...")
-        report = mt.classification_report(test_y, pred_y, output_dict=True)
-        df = pd.DataFrame(report).T
-        df['support'] = df['support'].astype('int')
+        result = self.evaluate(test_y, pred_y, prob_y)
         try:
-            display(df)
+            display(result.report)
         except NameError:
-            print(df)
-        print('accuracy_score: {0:.3f}'.format(mt.accuracy_score(test_y, pred_y)))
-        if prob_y is not None:
-            try:
-                print('average_precision: {0:.3f}'.format(mt.average_precision_score(test_y, prob_y)))
-                print('roc_auc: {0:.3f}'.format(mt.roc_auc_score(test_y, prob_y)))
-            except Exception as e:
-                mes = traceback.format_exception_only(type(e), e)
-                if 'multi' not in mes[0]:
-                    raise e
-        print('MCC: {0:.3f}'.format(mt.matthews_corrcoef(test_y, pred_y)))
+            print(result.report)
+        print('accuracy_score: {0:.3f}'.format(result.accuracy))
+        if result.average_precision is not None:
+            print('average_precision: {0:.3f}'.format(result.average_precision))
+            print('roc_auc: {0:.3f}'.format(result.roc_auc))
+        print('MCC: {0:.3f}'.format(result.mcc))
+        return result
 
     def show_roc(self, test_y, prob_y):
-        roc_auc = mt.roc_auc_score(test_y, prob_y)
-        fpr, tpr, thresholds = mt.roc_curve(test_y, prob_y)
-        self.plot_roc(fpr, tpr, roc_auc)
+        curve = MetricsEngine.curve_points(MetricsEngine.binary_curve(self._positive(test_y), prob_y))
+        self.plot_roc(curve['fpr'], curve['tpr'], curve['roc_auc'])
+        return curve
 
     def plot_roc(self, fpr, tpr, roc_auc, title='ROC curve'):
         import matplotlib.pyplot as plt
@@ -96,9 +130,19 @@ class Evaluator:
         plt.show()
 
     def show_roc_multiclass(self, test_ys, prob_ys):
-        for name in prob_ys:
-            test_y = test_ys[name]
-            prob_y = prob_ys[name]
-            roc_auc = mt.roc_auc_score(test_y, prob_y)
-            fpr, tpr, thresholds = mt.roc_curve(test_y, prob_y)
-            self.plot_roc(fpr, tpr, roc_auc, title=name)
+        """test_ys, prob_ys: クラス名ごとの正解(0/1)とスコア(DataFrameまたはdict)。全クラスを1回の行列演算で計算する"""
+        names = list(prob_ys.keys())
+        onehot = np.column_stack([self._positive(test_ys[name]) for name in names])
+        scores = np.column_stack([np.asarray(prob_ys[name], dtype=float) for name in names])
+        curves = MetricsEngine().ovr_curves(onehot, scores, names)
+        for name, curve in curves.items():
+            self.plot_roc(curve['fpr'], curve['tpr'], curve['roc_auc'], title=name)
+        return curves
+
+    @staticmethod
+    def _positive(test_y):
+        """2値の正解を正例(値の大きい方)かどうかのbool配列にする"""
+        test_y = np.asarray(test_y)
+        if test_y.dtype == bool:
+            return test_y
+        return test_y == max(pd.unique(test_y))
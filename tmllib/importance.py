@@ -0,0 +1,196 @@
+import numpy as np
+import pandas as pd
+
+
+class PermutationImportance:
+    u"""
+    特徴量の重要度(permutation / drop-column)
+    permutation: 1列だけシャッフルしたときのスコアの低下量。
+                 batch_size=1の場合は元のdataframeをコピーせず、シャッフルした列だけを差し替えて評価する。
+                 batch_size>1の場合はbatch_size個の特徴量のシャッフル結果を縦に積み、predictを1回で済ませる。
+                 積んだdataframeは評価するdataframeのbatch_size倍のメモリを使うので、
+                 max_batch_bytesを超えないようにbatch_sizeを小さくする
+    drop: 列を除いて学習し直したときのスコアの低下量(train_X, train_yが必要)
+
+    metric: (正解, 予測)を受け取り、大きいほど良いスコアを返す関数(省略時はaccuracy)
+    response: 'predict' または 'predict_proba'(2値分類は正例の列だけを渡す)。
+              'predict_proba'の場合はmetric(roc_aucなど)の指定が必要
+    random_state: 乱数のseed。Noneの場合はfitごとにseedを決める(使ったseedはself.seedに入る)
+    max_samples: 評価に使う行数の上限(超える場合はランダムに抽出)
+    workers: 2以上の場合はプロセスを分けて並列に評価する(モデルとデータは各プロセスに1回だけ渡す)
+    max_batch_bytes: batch_size>1の場合に積んだdataframe1つのメモリの上限(バイト)
+    tol: min_repeats回以上評価した特徴量のうち、低下量の標準誤差がtol以下のものは以降の繰り返しを省略する
+
+    ex)
+        importance = PermutationImportance(n_repeats=5, max_samples=100000, workers=8, tol=1e-4)
+        df = importance.fit(clf, test_X, test_y)
+    """
+
+    def __init__(self, metric=None, response='predict', method='permutation', n_repeats=5, max_samples=None,
+                 batch_size=1, max_batch_bytes=512 * 1024 ** 2, workers=1, min_repeats=2, tol=None,
+                 random_state=0):
+        self.metric = metric
+        self.response = response
+        self.method = method
+        self.n_repeats = n_repeats
+        self.max_samples = max_samples
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.workers = workers
+        self.min_repeats = min_repeats
+        self.tol = tol
+        self.random_state = random_state
+        self.seed = None
+        self.baseline = None
+
+    def fit(self, model, X, y, train_X=None, train_y=None):
+        """特徴量ごとの重要度(低下量の平均・標準偏差・評価回数)をXのカラム順のDataFrameで返す"""
+        if self.response == 'predict_proba' and self.metric is None:
+            # accuracyは予測クラスとの一致率なので、スコアには使えない
+            raise ValueError("response='predict_proba' requires metric (e.g. sklearn.metrics.roc_auc_score)")
+        # 各プロセス・各繰り返しで同じseedから乱数を作るため、Noneの場合もここで1つに決める
+        self.seed = self.random_state if self.random_state is not None \
+            else int(np.random.default_rng().integers(2 ** 32))
+        X, y = self._sample(X, np.asarray(y))
+        # 評価対象はfitごとに持つ(別スレッドのfitと共有せず、fitを抜けると解放される)。
+        # モジュールの_stateはプロセス並列時のworkerプロセスだけが使う
+        state = {'model': model, 'X': X, 'y': y, 'metric': self.metric, 'response': self.response,
+                 'train_X': train_X, 'train_y': None if train_y is None else np.asarray(train_y)}
+        self.baseline = state['baseline'] = _score(state, model, X, y)
+        if self.method not in ('permutation', 'drop'):
+            raise ValueError(f'unknown method: {self.method}')
+        if self.method == 'drop' and (train_X is None or train_y is None):
+            raise ValueError('drop-column importance requires train_X and train_y')
+
+        local = _prepare(state)
+        with self._pool(state) as executor:
+            if self.method == 'drop':
+                tasks = [('drop', [i], 0) for i in range(X.shape[1])]
+                drops = {i: [d] for result in self._run(tasks, executor, local) for i, d in result}
+            else:
+                drops = self._permutation(X.shape[1], executor, local, self._batch_size(X))
+
+        return pd.DataFrame({
+            'importance': [np.mean(drops[i]) for i in range(X.shape[1])],
+            'std': [np.std(drops[i]) for i in range(X.shape[1])],
+            'repeats': [len(drops[i]) for i in range(X.shape[1])],
+        }, index=pd.Index(X.columns, name='name'))
+
+    def _batch_size(self, X):
+        """積んだdataframeがmax_batch_bytesを超えないbatch_size"""
+        if self.batch_size <= 1:
+            return 1
+        size = max(int(X.memory_usage(index=False, deep=True).sum()), 1)
+        return int(max(1, min(self.batch_size, self.max_batch_bytes // size)))
+
+    def _permutation(self, n_features, executor, local, batch_size):
+        drops = {i: [] for i in range(n_features)}
+        active = list(range(n_features))
+        for repeat in range(self.n_repeats):
+            tasks = [('permutation', active[i:i + batch_size], repeat)
+                     for i in range(0, len(active), batch_size)]
+            for result in self._run(tasks, executor, local):
+                for i, d in result:
+                    drops[i].append(d)
+            if self.tol is not None and repeat + 1 >= self.min_repeats:
+                # 標準誤差が十分小さい(値が収束した)特徴量は以降の繰り返しを省略する
+                active = [i for i in active if np.std(drops[i]) / np.sqrt(len(drops[i])) > self.tol]
+            if len(active) == 0:
+                break
+        return drops
+
+    def _pool(self, state):
+        """workers=1の場合はこのプロセスで評価する(Noneを返す)"""
+        if self.workers <= 1:
+            from contextlib import nullcontext
+            return nullcontext()
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(state,))
+
+    def _run(self, tasks, executor, local):
+        tasks = [(method, features, self._seed(repeat)) for method, features, repeat in tasks]
+        if executor is None:
+            return [_evaluate(task, local) for task in tasks]
+        return list(executor.map(_evaluate, tasks))
+
+    def _seed(self, repeat):
+        return [self.seed, repeat]
+
+    def _sample(self, X, y):
+        if self.max_samples is None or len(X) <= self.max_samples:
+            return X, y
+        index = np.random.default_rng(self.seed).choice(len(X), self.max_samples, replace=False)
+        index.sort()
+        return X.iloc[index], y[index]
+
+
+# ProcessPoolExecutorのworkerプロセスの評価対象(initializerで1回だけ設定する)
+_state = {}
+
+
+def _init_worker(state):
+    _state.clear()
+    _state.update(_prepare(state))
+
+
+def _prepare(state):
+    # 列の差し替え用。シャローコピーなので元のデータはコピーされない
+    return dict(state, work=state['X'].copy(deep=False))
+
+
+def _evaluate(task, state=None):
+    """[(特徴量の位置, スコアの低下量)]を返す。stateを省略した場合はworkerプロセスの_stateを使う"""
+    state = _state if state is None else state
+    method, features, seed = task
+    model, X, y = state['model'], state['X'], state['y']
+    baseline = state['baseline']
+    if method == 'drop':
+        return [(i, baseline - _drop_score(state, i)) for i in features]
+
+    work = state['work']
+    n = len(X)
+    permuted = {}
+    for i in features:
+        rng = np.random.default_rng(seed + [i])
+        permuted[i] = X.iloc[:, i].to_numpy()[rng.permutation(n)]
+    if len(features) == 1:
+        i = features[0]
+        column = work.columns[i]
+        work[column] = permuted[i]
+        try:
+            return [(i, baseline - _score(state, model, work, y))]
+        finally:
+            work[column] = X[column]
+
+    # 特徴量ごとにシャッフルしたブロックを縦に積み、predictを1回で済ませる
+    stacked = pd.concat([X] * len(features), ignore_index=True)
+    for block, i in enumerate(features):
+        stacked.iloc[block * n:(block + 1) * n, i] = permuted[i]
+    pred = _predict(state, model, stacked)
+    return [(i, baseline - _metric(state, y, pred[block * n:(block + 1) * n])) for block, i in enumerate(features)]
+
+
+def _drop_score(state, i):
+    from sklearn.base import clone
+
+    X, train_X = state['X'], state['train_X']
+    column = X.columns[i]
+    model = clone(state['model']).fit(train_X.drop(columns=column), state['train_y'])
+    return _score(state, model, X.drop(columns=column), state['y'])
+
+
+def _score(state, model, X, y):
+    return _metric(state, y, _predict(state, model, X))
+
+
+def _predict(state, model, X):
+    if state['response'] == 'predict_proba':
+        prob = model.predict_proba(X)
+        return prob[:, 1] if prob.ndim == 2 and prob.shape[1] == 2 else prob
+    return np.asarray(model.predict(X))
+
+
+def _metric(state, y, pred):
+    if state['metric'] is None:
+        return float(np.mean(y == pred))
+    return float(state['metric'](y, pred))
@@ -1,10 +1,101 @@
 import requests
-import numpy as np
-import math
+import hashlib
 import json
+import math
+import os
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .etltool import EtlHelper
 
+
+class RateLimiter:
+    """
+    スレッドセーフなレート制限(リクエスト間の最小間隔 + 同時実行数)
+    kintoneの同時接続数制限は1ドメインあたり10なので、それ以下のconcurrencyで利用する
+    """
+
+    def __init__(self, interval=0.1, concurrency=4):
+        self.interval = interval
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc):
+        self._semaphore.release()
+
+
+class PropertyCache:
+    """
+    kintoneのフォーム設定(app/form/fields.json)のキャッシュ
+    プロセス内(メモリ)で共有し、cache_dirを指定した場合はファイルにも保存する。
+    ttl秒を過ぎたものは再取得する。前回の確認からrevalidate秒を過ぎたものは、
+    Kintone側でアプリのrevision(app/settings.json)を確認し、変わっていれば再取得する。
+    レコードに未知のフィールドがあった場合も再取得する
+    """
+
+    def __init__(self, ttl=3600, cache_dir=None, revalidate=60):
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.revalidate = revalidate
+        self.helper = EtlHelper()
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and self.cache_dir is not None:
+            filename = self._filename(key)
+            if os.path.isfile(filename):
+                entry = self.helper.load(filename)
+                with self._lock:
+                    self._entries[key] = entry
+        if entry is None or time.time() - entry['fetched_at'] > self.ttl:
+            return None
+        return entry
+
+    def set(self, key, properties, revision):
+        now = time.time()
+        entry = {'fetched_at': now, 'checked_at': now, 'revision': revision, 'properties': properties}
+        with self._lock:
+            self._entries[key] = entry
+        if self.cache_dir is not None:
+            # 他プロセスが途中の状態を読まないように一時ファイルから置き換える
+            os.makedirs(self.cache_dir, exist_ok=True)
+            filename = self._filename(key)
+            tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}'
+            self.helper.dump(entry, tmp)
+            os.replace(tmp, filename)
+        return entry
+
+    def needs_check(self, entry):
+        """前回のrevision確認からrevalidate秒を過ぎているか"""
+        return time.time() - entry.get('checked_at', entry['fetched_at']) > self.revalidate
+
+    def checked(self, entry):
+        """revisionが変わっていないことを確認した"""
+        with self._lock:
+            entry['checked_at'] = time.time()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, '{}_{}.property'.format(*key))
+
+
 class Kintone:
     """
     kintone API
@@ -13,19 +104,52 @@ class Kintone:
     """
 
     BASE_URL_TEMPLATE = 'https://{}.cybozu.com/k/v1/{}'
+    UPDATE_LIMIT = 100  # records.json PUTの1回あたりの上限件数
+    BULK_LIMIT = 20  # bulkRequest.jsonの1回あたりの上限リクエスト数
+    SELECT_LIMIT = 500  # records.json GETの1回あたりの上限件数
+
+    # ドメイン単位で共有するレート制限
+    _limiters = {}
+    _limiters_lock = threading.Lock()
 
-    def __init__(self, api_token, domain, app):
+    # 全インスタンスで共有するフォーム設定キャッシュ。ttlやcache_dirを変える場合は差し替える
+    property_cache = PropertyCache()
+
+    def __init__(self, api_token, domain, app, interval=0.1, concurrency=4, property_cache=None, base_url=None):
+        """
+        base_url: cybozu.com以外(KintoneStubなど)に接続する場合のURLテンプレート ex) 'http://127.0.0.1:8080/k/v1/{}'
+        """
         self.api_token = api_token
-        self.base_url = self.BASE_URL_TEMPLATE.format(domain, '{}')
+        self.domain = domain
+        self.base_url = base_url if base_url is not None else self.BASE_URL_TEMPLATE.format(domain, '{}')
         self.app = app
         self.headers = {
             "X-Cybozu-API-Token": self.api_token,
             'Content-Type': 'application/json'
         }
-        self.property, self.fields = self._get_property()
+        self.limiter = self._get_limiter(domain, interval, concurrency)
+        if property_cache is not None:
+            self.property_cache = property_cache
         self.helper = EtlHelper()
 
-    def select_all(self, where=None, fields=None, hard_limit=None):
+    def __getattr__(self, name):
+        # property/fieldsは初回参照時にキャッシュまたはAPIから取得する
+        if name in ('property', 'fields'):
+            self._load_property()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    @classmethod
+    def _get_limiter(cls, domain, interval, concurrency):
+        with cls._limiters_lock:
+            if domain not in cls._limiters:
+                cls._limiters[domain] = RateLimiter(interval, concurrency)
+            return cls._limiters[domain]
+
+    def select_all(self, where=None, fields=None, hard_limit=None, store=None):
+        """
+        全レコード取得。storeにRecordHashStoreを渡すと、取得したレコードのrevisionと値ハッシュを記録する
+        """
         params = {
             'app': self.app,
             'query': '',
@@ -35,6 +159,8 @@ class Kintone:
             params['fields'] = list(set(fields + ['$id', '$revision']))
 
         records = self._fetch_records_in_batches(params, where, hard_limit)
+        if store is not None:
+            store.load_records(records)
         records = self._format_records(records)
         return records
 
@@ -43,10 +169,11 @@ class Kintone:
         print(f"[DEBUG] kintone request: {method} {url}")
         try:
             # GETリクエストではparamsを使用、それ以外ではjsonを使用
-            if method == 'GET':
-                response = requests.request(method, url, params=json_data, headers={'X-Cybozu-API-Token': self.api_token})
-            else:
-                response = requests.request(method, url, json=json_data, headers=self.headers)
+            with self.limiter:
+                if method == 'GET':
+                    response = requests.request(method, url, params=json_data, headers={'X-Cybozu-API-Token': self.api_token})
+                else:
+                    response = requests.request(method, url, json=json_data, headers=self.headers)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.HTTPError as e:
@@ -60,15 +187,38 @@ class Kintone:
             print(f"[DEBUG] Exception: {type(e).__name__}: {str(e)}")
             raise
 
-    def _get_property(self):
-        params = {'app': self.app, 'lang': 'default'}
-        property = self._request_kintone('GET', 'app/form/fields.json', json_data=params)['properties']
+    def _load_property(self, refresh=False):
+        key = (self.domain, str(self.app))
+        entry = None if refresh else self.property_cache.get(key)
+        if entry is not None and self.property_cache.needs_check(entry):
+            revision = self._get_revision()
+            # 確認できない(権限がないなど)場合はttlまでキャッシュを使う
+            if revision is not None and str(revision) != str(entry['revision']):
+                entry = None
+            else:
+                self.property_cache.checked(entry)
+        if entry is None:
+            entry = self.property_cache.set(key, *self._get_property())
+        property = entry['properties']
         fields = {y['label']: y for y in property.values()}
         fields |= {
             k: {'type': 'NUMBER', 'code': k, 'label': k, 'required': 'True'}
             for k in ('$id', '$revision')
         }
-        return property, fields
+        self.property, self.fields = property, fields
+
+    def _get_property(self):
+        params = {'app': self.app, 'lang': 'default'}
+        response = self._request_kintone('GET', 'app/form/fields.json', json_data=params)
+        return response['properties'], response.get('revision')
+
+    def _get_revision(self):
+        """アプリの設定のrevision(フォームより軽いapp/settings.jsonで取得する)。取得できない場合はNone"""
+        try:
+            response = self._request_kintone('GET', 'app/settings.json', json_data={'app': self.app})
+        except requests.exceptions.HTTPError:
+            return None
+        return response.get('revision')
 
     def _fetch_records_in_batches(self, params, where, hard_limit):
         last_rec_id = '0'
@@ -93,12 +243,16 @@ class Kintone:
 
             if total_count <= 500:
                 break
-            if record_count >= hard_limit:
+            if hard_limit is not None and record_count >= hard_limit:
                 break
 
         return [record for batch in all_records for record in batch]
 
     def _format_records(self, records):
+        # キャッシュにないフィールドがあればアプリが更新されたとみなして再取得
+        codes = {k for record in records for k in record} - {'$id', '$revision'}
+        if not codes <= self.property.keys():
+            self._load_property(refresh=True)
         return [
             {self.property[field_code]['label'] if field_code not in (
                 '$id', '$revision') else field_code: self._format_field(value) for field_code, value in record.items()}
@@ -116,69 +270,127 @@ class Kintone:
         else:
             return field_value
 
-    def update(self, records: list):
-        """kintone rest apiの制限(updateは1回100件)に従って分割送信"""
-        cnt = math.ceil(len(records) / 100)
-        chunk = list(np.array_split(records, cnt))
-        # 並列処理を無効化して順次処理に変更（レート制限対応）
-        for i, c in enumerate(chunk):
-            if i > 0:
-                time.sleep(1)  # レート制限対策: 1秒待機
-            self._update_chunk(c)
-        return
-
-    def _update_chunk(self, params):
-        # paramsを正しいkintone API形式に変換
+    def update(self, records: list, workers=4, validate=True, store=None):
+        """
+        kintone rest apiの制限(updateは1回100件、bulkRequestは1回20リクエスト)に従って分割送信
+        最大2000件単位のbulkRequestをworkers並列で送信する。送信間隔・同時接続数はself.limiterで制御。
+        validate=Trueの場合は存在するidを事前に一括検索し、存在しないレコードはスキップする
+        storeにRecordHashStoreを渡すと値が変わったレコードだけをrevision付きで送信する。
+        他で更新されていた(revision不一致)レコードは除いて送信し、戻り値のconflictsにidを返す
+        """
+        records = self._to_update_records(records)
+        unchanged = 0
+        if store is not None:
+            records, unchanged = store.changed(records)
+        skipped = 0
+        if validate and len(records) > 0:
+            exists = self.existing_ids([x['id'] for x in records])
+            valid = [x for x in records if int(x['id']) in exists]
+            skipped = len(records) - len(valid)
+            if skipped > 0:
+                print(f"[WARNING] Skipping {skipped} non-existent records")
+            records = valid
+
+        step = self.UPDATE_LIMIT * self.BULK_LIMIT
+        bulks = [records[i:i + step] for i in range(0, len(records), step)]
+        conflicts = []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as exe:
+                for x in exe.map(lambda x: self._update_bulk(x, store), bulks):
+                    conflicts += x
+        finally:
+            # 失敗したbulkがあっても、成功したbulkのrevisionと値ハッシュは保存する
+            if store is not None:
+                store.save()
+        success = len(records) - len(conflicts)
+        if len(conflicts) > 0:
+            print(f"[WARNING] Skipping {len(conflicts)} records updated by others (revision conflict): {conflicts}")
+        print(f"[INFO] Update completed: success={success}, skipped={skipped}, unchanged={unchanged}, "
+              f"conflicts={len(conflicts)}")
+        return {'success': success, 'skipped': skipped, 'unchanged': unchanged, 'conflicts': conflicts}
+
+    def existing_ids(self, ids):
+        """指定したidのうちkintone上に存在するものをsetで返す"""
+        return set(self.revisions(ids))
+
+    def revisions(self, ids):
+        """指定したidのうちkintone上に存在するものの{id: revision}を返す(500件単位で$id inを検索)"""
+        ids = sorted({int(x) for x in ids})
+        found = {}
+        for i in range(0, len(ids), self.SELECT_LIMIT):
+            chunk = ids[i:i + self.SELECT_LIMIT]
+            params = {
+                'app': self.app,
+                'query': f'$id in ({", ".join(map(str, chunk))}) limit {self.SELECT_LIMIT}',
+                'fields': ['$id', '$revision'],
+            }
+            response = self._request_kintone('GET', 'records.json', json_data=params)
+            found |= {int(x['$id']['value']): int(x['$revision']['value']) for x in response['records']}
+        return found
+
+    def _to_update_records(self, params):
+        """kintone API形式({'id': id, 'record': {...}})に変換"""
         # 既に'record'キーが存在する場合はそのまま使用、ない場合は追加
         records = []
         for param in params:
-            param_copy = param.copy()
-            if 'record' in param_copy:
-                # 既にrecordキーがある場合はそのまま使用
-                records.append(param_copy)
+            if 'record' in param:
+                records.append(param)
             else:
-                # recordキーがない場合は追加
+                param_copy = param.copy()
                 record_id = param_copy.pop('id')
-                records.append({
-                    'id': record_id,
-                    'record': param_copy
-                })
-        data = {'app': int(self.app), 'records': records}
-        print(f"[DEBUG] update_chunk: app={self.app}, records_count={len(records)}")
-        if len(records) > 0:
-            print(f"[DEBUG] first record: {records[0]}")
+                records.append({'id': record_id, 'record': param_copy})
+        return records
 
+    def _update_bulk(self, records, store=None):
+        """
+        bulkRequestで最大20×100件を1回で更新する(bulkRequest内はトランザクション)
+        revisionが一致せず(GAIA_CO02)全体が取り消された場合は、他で更新されたレコードを除いて送り直す
+        戻り値: 除いたレコードのidのlist
+        """
+        if len(records) == 0:
+            return []
+        bulk = [
+            {
+                'method': 'PUT',
+                'api': '/k/v1/records.json',
+                'payload': {'app': int(self.app), 'records': records[i:i + self.UPDATE_LIMIT]},
+            }
+            for i in range(0, len(records), self.UPDATE_LIMIT)
+        ]
+        print(f"[DEBUG] update_bulk: app={self.app}, requests={len(bulk)}, records_count={len(records)}")
         try:
-            response = self._request_kintone('PUT', 'records.json', json_data=data)
-            return response
+            response = self._request_kintone('POST', 'bulkRequest.json', json_data={'requests': bulk})
         except requests.exceptions.HTTPError as e:
-            # GAIA_RE01: 指定したレコードが見つかりません
-            if e.response is not None and e.response.status_code == 404:
-                error_body = e.response.json() if e.response.text else {}
-                if error_body.get('code') == 'GAIA_RE01':
-                    # 存在しないレコードIDを特定してスキップ
-                    print(f"[WARNING] Record not found, trying individual updates...")
-                    return self._update_records_individually(records)
-            raise
+            if not self._is_conflict(e):
+                raise
+            current = self.revisions([x['id'] for x in records])
+            conflicts = {
+                int(x['id']) for x in records
+                if 'revision' in x and current.get(int(x['id'])) != int(x['revision'])
+            }
+            if len(conflicts) == 0:
+                raise
+            if store is not None:
+                # 次回は最新のrevisionで値を比較・送信する
+                store.reset({id: current[id] for id in conflicts if id in current})
+            rest = [x for x in records if int(x['id']) not in conflicts]
+            return sorted(conflicts) + self._update_bulk(rest, store)
+        if store is not None:
+            revisions = [x for res in response.get('results', []) for x in res.get('records', [])]
+            store.commit(records, revisions)
+            store.save()
+        return []
 
-    def _update_records_individually(self, records):
-        """レコードを1件ずつ更新し、存在しないレコードはスキップする"""
-        success_count = 0
-        skip_count = 0
-        for record in records:
-            data = {'app': int(self.app), 'records': [record]}
-            try:
-                self._request_kintone('PUT', 'records.json', json_data=data)
-                success_count += 1
-            except requests.exceptions.HTTPError as e:
-                if e.response is not None and e.response.status_code == 404:
-                    print(f"[WARNING] Skipping non-existent record id={record.get('id')}")
-                    skip_count += 1
-                else:
-                    raise
-            time.sleep(0.1)  # レート制限対策
-        print(f"[INFO] Individual update completed: success={success_count}, skipped={skip_count}")
-        return {'success': success_count, 'skipped': skip_count}
+    @staticmethod
+    def _is_conflict(error):
+        """revisionの不一致(GAIA_CO02)によるエラーか"""
+        try:
+            body = error.response.json()
+        except (AttributeError, ValueError):
+            return False
+        results = body.get('results', []) if isinstance(body, dict) else []
+        codes = [body.get('code')] + [x.get('code') for x in results if isinstance(x, dict)]
+        return 'GAIA_CO02' in codes
 
     @staticmethod
     def _convert_to_number(value):
@@ -202,3 +414,110 @@ class Kintone:
             formatted_subtable.append(subtable_record)
 
         return formatted_subtable
+
+
+class RecordHashStore:
+    """
+    kintoneレコードの差分検出用ストア
+    idごとにrevisionとフィールド単位の値ハッシュを保持し、値が変わったレコードだけを更新対象にする。
+    送信時は保持しているrevisionを付与するので、他で更新されていた場合はkintone側でエラー(GAIA_CO02)になる。
+    その場合Kintone.updateは該当レコードを除いて送り直し、ここには最新のrevisionを記録する(reset)。
+    filenameを指定した場合はpickleで永続化する
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.helper = EtlHelper()
+        self._lock = threading.Lock()
+        # {id: {'revision': int, 'fields': {field_code: hash}}}
+        self.records = {}
+        if filename is not None and os.path.isfile(filename):
+            self.records = self.helper.load(filename)
+
+    def save(self):
+        if self.filename is None:
+            return
+        d = os.path.dirname(self.filename)
+        if d and not os.path.isdir(d): os.makedirs(d)
+        with self._lock:
+            self.helper.dump(self.records, self.filename)
+
+    def load_records(self, records):
+        """select_allで取得した(未整形の)レコードからrevisionと値ハッシュを記録する"""
+        with self._lock:
+            for rec in records:
+                id = int(rec['$id']['value'])
+                revision = int(rec['$revision']['value'])
+                fields = {
+                    k: self.hash_value(self._typed_value(v))
+                    for k, v in rec.items() if k not in ('$id', '$revision')
+                }
+                entry = self.records.get(id)
+                if entry is not None and entry['revision'] == revision:
+                    entry['fields'].update(fields)
+                else:
+                    self.records[id] = {'revision': revision, 'fields': fields}
+
+    def changed(self, records):
+        """
+        値が変わったレコードだけを返す。既知のレコードにはrevisionを付与する
+        戻り値: (送信対象レコードのlist, 変更なしでスキップした件数)
+        """
+        targets = []
+        with self._lock:
+            for rec in records:
+                entry = self.records.get(int(rec['id']))
+                if entry is None:
+                    targets.append(rec)
+                    continue
+                if all(entry['fields'].get(k) == self.hash_value(v['value']) for k, v in rec['record'].items()):
+                    continue
+                if 'revision' not in rec:
+                    rec = {**rec, 'revision': entry['revision']}
+                targets.append(rec)
+        return targets, len(records) - len(targets)
+
+    def reset(self, revisions):
+        """
+        他で更新されたレコードを最新のrevisionで記録し直す(値ハッシュは破棄するので次回は送信対象になる)
+        revisions: {id: revision}
+        """
+        with self._lock:
+            for id, revision in revisions.items():
+                self.records[int(id)] = {'revision': int(revision), 'fields': {}}
+
+    def commit(self, records, revisions):
+        """更新成功したレコードの値ハッシュと新しいrevisionを記録する"""
+        revisions = {int(x['id']): int(x['revision']) for x in revisions}
+        with self._lock:
+            for rec in records:
+                id = int(rec['id'])
+                entry = self.records.setdefault(id, {'revision': None, 'fields': {}})
+                entry['fields'].update({k: self.hash_value(v['value']) for k, v in rec['record'].items()})
+                entry['revision'] = revisions.get(id, entry['revision'])
+
+    @staticmethod
+    def _typed_value(field_data):
+        if field_data['type'] == 'NUMBER' and field_data['value'] not in (None, ''):
+            return Kintone._convert_to_number(field_data['value'])
+        return field_data['value']
+
+    @staticmethod
+    def _normalize(value):
+        """kintoneの文字列表現とpandas由来の値が同じハッシュになるように正規化する"""
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return ''
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, (int, float)):
+            return str(int(value)) if float(value).is_integer() else repr(float(value))
+        if isinstance(value, list):
+            return [RecordHashStore._normalize(x) for x in value]
+        if isinstance(value, dict):
+            return {k: RecordHashStore._normalize(x) for k, x in value.items()}
+        return value
+
+    @staticmethod
+    def hash_value(value):
+        s = json.dumps(RecordHashStore._normalize(value), sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.md5(s.encode()).hexdigest()
@@ -0,0 +1,294 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class KintoneStub:
+    u"""
+    ローカルで動くkintone互換のスタブサーバ(テスト・ベンチマーク用。ベンチマークは benchmarks/kintone_benchmark.py)
+    対応API: app/form/fields.json(GET), app/settings.json(GET), records.json(GET/PUT), bulkRequest.json(POST),
+            records/cursor.json(POST/GET/DELETE)
+    queryは `$id > n`, `$id in (...)`, `limit n`, `offset n` のみ解釈し、その他の条件は無視する
+
+    latency: 1リクエストごとの応答遅延(sec)
+    max_concurrency: 同時処理数の上限。超えたリクエストには429を返す
+    error_rate: 指定した確率で500エラーを返す(エラー注入)
+
+    ex)
+        with KintoneStub().populate(10000) as stub:
+            app = Kintone('token', 'stub', stub.app, base_url=stub.base_url)
+            records = app.select_all()
+    """
+
+    DEFAULT_PROPERTIES = {
+        'name': {'type': 'SINGLE_LINE_TEXT', 'code': 'name', 'label': '名前', 'required': False},
+        'score': {'type': 'NUMBER', 'code': 'score', 'label': 'スコア', 'required': False},
+        'date': {'type': 'DATE', 'code': 'date', 'label': '日付', 'required': False},
+        'updated_at': {'type': 'UPDATED_TIME', 'code': 'updated_at', 'label': '更新日時', 'required': False},
+    }
+
+    def __init__(self, properties=None, app=1, latency=0.0, max_concurrency=None, error_rate=0.0, seed=0):
+        self.app = app
+        self.properties = properties if properties is not None else self.DEFAULT_PROPERTIES
+        self.revision = '1'
+        self.latency = latency
+        self.max_concurrency = max_concurrency
+        self.error_rate = error_rate
+        self.records = {}
+        self.calls = Counter()
+        self._cursors = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/k/v1/{{}}'
+
+    def start(self):
+        handler = type('Handler', (_StubHandler,), {'stub': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start() if self._server is None else self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def populate(self, n, start_id=1):
+        """propertiesの型に合わせたダミーレコードをn件生成する"""
+        for i in range(start_id, start_id + n):
+            record = {
+                '$id': {'type': '__ID__', 'value': str(i)},
+                '$revision': {'type': '__REVISION__', 'value': '1'},
+            }
+            for code, prop in self.properties.items():
+                record[code] = {'type': prop['type'], 'value': self._dummy_value(prop['type'], i)}
+            self.records[i] = record
+        return self
+
+    def reset_calls(self):
+        self.calls = Counter()
+
+    def handle(self, method, path, params):
+        """HTTPを介さずにAPIを処理する。(status, body)を返す"""
+        endpoint = path.split('/k/v1/', 1)[-1]
+        with self._lock:
+            self.calls[(method, endpoint)] += 1
+            if self.max_concurrency is not None and self._active >= self.max_concurrency:
+                return 429, self._error('CB_TO01', 'Too many concurrent requests.')
+            if self._random.random() < self.error_rate:
+                return 500, self._error('CB_IJ01', 'Injected error.')
+            self._active += 1
+        try:
+            if self.latency > 0:
+                time.sleep(self.latency)
+            return self._dispatch(method, endpoint, params)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _dispatch(self, method, endpoint, params):
+        routes = {
+            ('GET', 'app/form/fields.json'): self._get_fields,
+            ('GET', 'app/settings.json'): self._get_settings,
+            ('GET', 'records.json'): self._get_records,
+            ('PUT', 'records.json'): self._put_records,
+            ('POST', 'bulkRequest.json'): self._bulk_request,
+            ('POST', 'records/cursor.json'): self._create_cursor,
+            ('GET', 'records/cursor.json'): self._get_cursor,
+            ('DELETE', 'records/cursor.json'): self._delete_cursor,
+        }
+        if (method, endpoint) not in routes:
+            return 404, self._error('CB_NO01', f'{method} {endpoint} is not supported.')
+        return routes[(method, endpoint)](params)
+
+    def _get_fields(self, params):
+        return 200, {'properties': self.properties, 'revision': self.revision}
+
+    def _get_settings(self, params):
+        return 200, {'name': f'app{self.app}', 'description': '', 'revision': self.revision}
+
+    def _get_records(self, params):
+        query = params.get('query', '')
+        matched = self._query(query)
+        limit, offset = self._limit(query, 100), self._offset(query)
+        records = [self._project(x, params.get('fields')) for x in matched[offset:offset + limit]]
+        total = str(len(matched)) if str(params.get('totalCount', '')).lower() == 'true' else None
+        return 200, {'records': records, 'totalCount': total}
+
+    def _put_records(self, params):
+        with self._lock:
+            status, body = self._validate_update(params)
+            if status != 200:
+                return status, body
+            return 200, self._apply_update(params)
+
+    def _bulk_request(self, params):
+        requests = params.get('requests', [])
+        if len(requests) > 20:
+            return 400, self._error('CB_VA01', 'Too many requests in bulkRequest.')
+        with self._lock:
+            # トランザクション: 全リクエストを検証してから適用する
+            for x in requests:
+                if (x['method'], x['api']) != ('PUT', '/k/v1/records.json'):
+                    return 400, self._error('CB_VA01', f"{x['method']} {x['api']} is not supported in bulkRequest.")
+                status, body = self._validate_update(x['payload'])
+                if status != 200:
+                    return status, body
+            return 200, {'results': [self._apply_update(x['payload']) for x in requests]}
+
+    def _create_cursor(self, params):
+        matched = self._query(params.get('query', ''))
+        size = int(params.get('size', 100))
+        if size > 500:
+            return 400, self._error('CB_VA01', 'size must be 500 or less.')
+        with self._lock:
+            cursor_id = str(len(self._cursors) + 1) + '-' + str(self._random.getrandbits(32))
+            self._cursors[cursor_id] = {'records': matched, 'size': size, 'fields': params.get('fields')}
+        return 200, {'id': cursor_id, 'totalCount': str(len(matched))}
+
+    def _get_cursor(self, params):
+        with self._lock:
+            cursor = self._cursors.get(params.get('id'))
+            if cursor is None:
+                return 404, self._error('GAIA_CO03', 'Cursor not found.')
+            records, cursor['records'] = cursor['records'][:cursor['size']], cursor['records'][cursor['size']:]
+            has_next = len(cursor['records']) > 0
+            if not has_next:
+                del self._cursors[params.get('id')]
+        return 200, {'records': [self._project(x, cursor['fields']) for x in records], 'next': has_next}
+
+    def _delete_cursor(self, params):
+        with self._lock:
+            self._cursors.pop(params.get('id'), None)
+        return 200, {}
+
+    def _validate_update(self, payload):
+        for x in payload.get('records', []):
+            id = int(x['id'])
+            if id not in self.records:
+                return 404, self._error('GAIA_RE01', f'Record not found. id={id}')
+            revision = int(x.get('revision', -1))
+            if revision != -1 and revision != int(self.records[id]['$revision']['value']):
+                return 409, self._error('GAIA_CO02', f'Revision mismatch. id={id}')
+            unknown = set(x.get('record', {})) - set(self.properties)
+            if len(unknown) > 0:
+                return 400, self._error('CB_VA01', f'Unknown fields: {sorted(unknown)}')
+        return 200, None
+
+    def _apply_update(self, payload):
+        result = []
+        for x in payload.get('records', []):
+            record = self.records[int(x['id'])]
+            for code, value in x.get('record', {}).items():
+                record[code] = {'type': self.properties[code]['type'], 'value': self._to_kintone(value['value'])}
+            record['$revision']['value'] = str(int(record['$revision']['value']) + 1)
+            result.append({'id': str(x['id']), 'revision': record['$revision']['value']})
+        return {'records': result}
+
+    def _query(self, query):
+        with self._lock:
+            records = sorted(self.records.items())
+        m = re.search(r'\$id\s*>\s*(\d+)', query)
+        if m is not None:
+            records = [x for x in records if x[0] > int(m.group(1))]
+        m = re.search(r'\$id\s+in\s*\(([^)]*)\)', query)
+        if m is not None:
+            ids = {int(x) for x in m.group(1).split(',') if x.strip() != ''}
+            records = [x for x in records if x[0] in ids]
+        return [x[1] for x in records]
+
+    @staticmethod
+    def _limit(query, default):
+        m = re.search(r'limit\s+(\d+)', query)
+        return int(m.group(1)) if m is not None else default
+
+    @staticmethod
+    def _offset(query):
+        m = re.search(r'offset\s+(\d+)', query)
+        return int(m.group(1)) if m is not None else 0
+
+    @staticmethod
+    def _project(record, fields):
+        if fields is None:
+            return json.loads(json.dumps(record))
+        return {k: dict(v) for k, v in record.items() if k in fields}
+
+    @staticmethod
+    def _to_kintone(value):
+        """kintoneと同様に数値は文字列で保持する"""
+        if value is None:
+            return ''
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+        return value
+
+    @staticmethod
+    def _dummy_value(field_type, i):
+        if field_type == 'NUMBER':
+            return str(i % 1000)
+        if field_type == 'DATE':
+            return '2023-01-{:02d}'.format(i % 28 + 1)
+        if field_type in ('UPDATED_TIME', 'CREATED_TIME', 'DATETIME'):
+            return '2023-01-{:02d}T00:00:00Z'.format(i % 28 + 1)
+        if field_type == 'SUBTABLE':
+            return []
+        return f'name{i}'
+
+    @staticmethod
+    def _error(code, message):
+        return {'code': code, 'id': 'stub', 'message': message}
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    stub = None
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_PUT(self):
+        self._respond('PUT')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def do_DELETE(self):
+        self._respond('DELETE')
+
+    def _respond(self, method):
+        url = urlparse(self.path)
+        params = {k: v if k == 'fields' else v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > 0:
+            params |= json.loads(self.rfile.read(length))
+        status, body = self.stub.handle(method, url.path, params)
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,542 @@
+import numpy as np
+import pandas as pd
+
+
+class EvaluationResult:
+    u"""
+    MetricsEngine.evaluateの結果
+    report: classification_report相当(クラスごと + accuracy, macro avg, weighted avg)
+    confusion: 混同行列(行: 正解, 列: 予測)
+    curves: {クラス名: {'fpr', 'tpr', 'precision', 'recall', 'thresholds', 'roc_auc', 'average_precision'}}
+    sweep: 2値分類で閾値ごとの混同行列と指標(閾値の降順)
+    log_loss, calibration: StreamingEvaluatorの場合のみ
+    """
+
+    def __init__(self, classes, confusion, report, accuracy, mcc, curves=None, roc_auc=None,
+                 average_precision=None, sweep=None, log_loss=None, calibration=None):
+        self.classes = classes
+        self.confusion = confusion
+        self.report = report
+        self.accuracy = accuracy
+        self.mcc = mcc
+        self.curves = curves or {}
+        self.roc_auc = roc_auc
+        self.average_precision = average_precision
+        self.sweep = sweep
+        self.log_loss = log_loss
+        self.calibration = calibration
+
+    def summary(self):
+        return {
+            'accuracy': self.accuracy,
+            'mcc': self.mcc,
+            'roc_auc': self.roc_auc,
+            'average_precision': self.average_precision,
+            'log_loss': self.log_loss,
+        }
+
+    def __repr__(self):
+        values = ', '.join(f'{k}={v:.4f}' for k, v in self.summary().items() if v is not None)
+        return f'EvaluationResult({values})'
+
+
+class MetricsEngine:
+    u"""
+    分類の評価指標をまとめて計算する
+    ・混同行列を1回のbincountで作り、precision/recall/f1/accuracy/MCCはそこから計算する
+    ・スコアを1回ソートして累積和を取り、ROC/PR曲線・AUC・AP・閾値ごとの混同行列を計算する
+    ・多クラスのone-vs-restは(件数, クラス数)の行列で全クラス同時に計算する
+
+    n_thresholds: sweepで評価する閾値の数(スコアの分位点)。Noneの場合はsweepを計算しない
+
+    ex)
+        result = MetricsEngine().evaluate(test_y, pred_y, prob_y)
+        print(result.summary())
+        result.report, result.sweep
+    """
+
+    def __init__(self, n_thresholds=101):
+        self.n_thresholds = n_thresholds
+
+    def evaluate(self, y_true, y_pred=None, y_prob=None, classes=None):
+        """
+        y_prob: 2値分類では正例(classesの最後)のスコアの1次元配列、
+                多クラスでは(件数, クラス数)の配列かクラス名をカラムに持つDataFrame
+        y_predを省略した場合はy_probから予測する(2値: 0.5以上、多クラス: 最大スコアのクラス)
+        """
+        y_true = np.asarray(y_true)
+        if isinstance(y_prob, pd.DataFrame):
+            if classes is None:
+                classes = list(y_prob.columns)
+            y_prob = y_prob.to_numpy()
+        elif y_prob is not None:
+            y_prob = np.asarray(y_prob)
+        if classes is None:
+            values = y_true if y_pred is None else np.concatenate([y_true, np.asarray(y_pred)])
+            classes = pd.unique(values).tolist()
+            classes = sorted(classes) if len(classes) > 0 else classes
+            if y_prob is not None and y_prob.ndim == 2:
+                classes = self._prob_classes(classes, y_prob.shape[1])
+        if y_prob is not None and y_prob.ndim == 2 and y_prob.shape[1] != len(classes):
+            raise ValueError(f'y_prob has {y_prob.shape[1]} columns but {len(classes)} classes: {classes}')
+        if len(classes) == 1 and y_prob is not None and y_prob.ndim == 1:
+            # 正解が1クラスだけでも2値のスコアとして扱う
+            classes = classes + [None]
+        classes_index = pd.Index(classes)
+        true_codes = classes_index.get_indexer(y_true)
+        if y_pred is None:
+            if y_prob is None:
+                raise ValueError('y_pred or y_prob is required')
+            pred_codes = (y_prob >= 0.5).astype(np.int64) if y_prob.ndim == 1 else y_prob.argmax(axis=1)
+        else:
+            pred_codes = classes_index.get_indexer(np.asarray(y_pred))
+
+        confusion = self.confusion(true_codes, pred_codes, len(classes))
+        report, accuracy, mcc = self.report(confusion, classes)
+        result = EvaluationResult(classes, pd.DataFrame(confusion, index=classes, columns=classes), report,
+                                  accuracy, mcc)
+        if y_prob is None:
+            return result
+
+        if y_prob.ndim == 1 or len(classes) == 2:
+            scores = y_prob if y_prob.ndim == 1 else y_prob[:, 1]
+            curve = self.binary_curve(true_codes == len(classes) - 1, scores)
+            result.curves = {classes[-1]: self.curve_points(curve)}
+            result.roc_auc = result.curves[classes[-1]]['roc_auc']
+            result.average_precision = result.curves[classes[-1]]['average_precision']
+            if self.n_thresholds is not None:
+                result.sweep = self.sweep(curve, self._grid(scores))
+        else:
+            onehot = true_codes[:, None] == np.arange(len(classes))[None, :]
+            result.curves = self.ovr_curves(onehot, y_prob, classes)
+            # 正例のないクラスは平均から除く
+            valid = [x for x in result.curves.values() if not np.isnan(x['roc_auc'])]
+            result.roc_auc = float(np.mean([x['roc_auc'] for x in valid])) if valid else None
+            result.average_precision = float(np.mean([x['average_precision'] for x in valid])) if valid else None
+        return result
+
+    @staticmethod
+    def _prob_classes(observed, n_columns):
+        """
+        y_probの列数からクラスを決める。データに出てこないクラスがある場合、
+        クラスが0〜n_columns-1の整数なら列の位置をクラスとみなし、それ以外はclassesの指定を求める
+        """
+        if len(observed) == n_columns:
+            return observed
+        if all(isinstance(x, (int, np.integer)) and 0 <= x < n_columns for x in observed):
+            return list(range(n_columns))
+        raise ValueError(f'y_prob has {n_columns} columns but the data has {len(observed)} classes: {observed}. '
+                         'Specify classes or pass y_prob as a DataFrame with class columns')
+
+    @staticmethod
+    def confusion(true_codes, pred_codes, n_classes):
+        """行: 正解, 列: 予測。classesにない値(-1や範囲外)は数えない"""
+        valid = (true_codes >= 0) & (true_codes < n_classes) & (pred_codes >= 0) & (pred_codes < n_classes)
+        index = true_codes[valid] * n_classes + pred_codes[valid]
+        return np.bincount(index, minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+    @staticmethod
+    def report(confusion, classes):
+        """混同行列から(classification_report相当のDataFrame, accuracy, MCC)を計算する"""
+        tp = np.diag(confusion).astype(float)
+        support = confusion.sum(axis=1)
+        predicted = confusion.sum(axis=0)
+        total = confusion.sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.nan_to_num(tp / predicted)
+            recall = np.nan_to_num(tp / support)
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+        accuracy = tp.sum() / total if total > 0 else 0.0
+
+        report = pd.DataFrame({'precision': precision, 'recall': recall, 'f1-score': f1, 'support': support},
+                              index=[str(x) for x in classes])
+        weights = support / support.sum() if support.sum() > 0 else np.zeros(len(support))
+        report.loc['accuracy'] = [accuracy, accuracy, accuracy, total]
+        report.loc['macro avg'] = [precision.mean(), recall.mean(), f1.mean(), total]
+        report.loc['weighted avg'] = [(precision * weights).sum(), (recall * weights).sum(), (f1 * weights).sum(),
+                                      total]
+        report['support'] = report['support'].astype(int)
+
+        # 多クラスのMCC(Gorodkin)。2値の場合は通常のMCCと一致する
+        cov_tp = tp.sum() * total - np.dot(support, predicted)
+        cov_pp = float(total) ** 2 - np.dot(predicted, predicted)
+        cov_tt = float(total) ** 2 - np.dot(support, support)
+        mcc = cov_tp / np.sqrt(cov_pp * cov_tt) if cov_pp * cov_tt > 0 else 0.0
+        return report, float(accuracy), float(mcc)
+
+    @staticmethod
+    def binary_curve(y_true, scores):
+        """
+        スコアの降順に1回ソートし、各位置までの正例数の累積を返す
+        thresholds, tps, fpsは同じスコアの最後の位置(=異なる閾値)だけを取り出したもの
+        """
+        y_true = np.asarray(y_true, dtype=bool)
+        scores = np.asarray(scores)
+        order = np.argsort(-scores, kind='mergesort')
+        sorted_scores = scores[order]
+        cum_pos = np.cumsum(y_true[order], dtype=np.int64)
+        last = np.r_[np.flatnonzero(np.diff(sorted_scores)), len(scores) - 1] if len(scores) > 0 \
+            else np.array([], dtype=np.int64)
+        tps = cum_pos[last]
+        return {
+            'sorted_scores': sorted_scores,
+            'cum_pos': cum_pos,
+            'thresholds': sorted_scores[last],
+            'tps': tps,
+            'fps': last + 1 - tps,
+        }
+
+    @staticmethod
+    def curve_points(curve):
+        """binary_curveからROC/PR曲線・AUC・APを計算する"""
+        tps, fps = curve['tps'], curve['fps']
+        pos = tps[-1] if len(tps) > 0 else 0
+        neg = fps[-1] if len(fps) > 0 else 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tpr = np.r_[0, tps / pos]
+            fpr = np.r_[0, fps / neg]
+            precision = np.nan_to_num(tps / (tps + fps))
+        recall = tpr[1:]
+        roc_auc = float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)) if pos > 0 and neg > 0 else float('nan')
+        ap = float(np.sum(np.diff(tpr) * precision)) if pos > 0 else float('nan')
+        return {
+            'fpr': fpr, 'tpr': tpr, 'precision': precision, 'recall': recall,
+            'thresholds': curve['thresholds'], 'roc_auc': roc_auc, 'average_precision': ap,
+        }
+
+    def sweep(self, curve, thresholds):
+        """閾値(スコア >= 閾値を正例と予測)ごとの混同行列と指標。ソート済みの累積和を二分探索するだけで計算する"""
+        sorted_scores, cum_pos = curve['sorted_scores'], curve['cum_pos']
+        thresholds = np.sort(np.asarray(thresholds))[::-1]
+        n = len(sorted_scores)
+        pos = int(cum_pos[-1]) if n > 0 else 0
+        # スコアの降順配列で、閾値以上の件数
+        count = np.searchsorted(-sorted_scores, -thresholds, side='right')
+        tp = np.where(count > 0, cum_pos[np.maximum(count - 1, 0)], 0)
+        return self.sweep_frame(thresholds, tp, count - tp, pos, n - pos)
+
+    @staticmethod
+    def sweep_frame(thresholds, tp, fp, pos, neg):
+        """閾値ごとのtp, fpと正例・負例の件数から混同行列と指標のDataFrameを作る"""
+        fn = pos - tp
+        tn = neg - fp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.nan_to_num(tp / (tp + fp))
+            recall = np.nan_to_num(tp / (tp + fn))
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+            mcc = np.nan_to_num((tp * tn - fp * fn)
+                                / np.sqrt((tp + fp).astype(float) * (tp + fn) * (tn + fp) * (tn + fn)))
+        return pd.DataFrame({
+            'threshold': thresholds, 'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+            'precision': precision, 'recall': recall, 'f1': f1, 'mcc': mcc,
+        })
+
+    def ovr_curves(self, onehot, scores, classes):
+        """
+        多クラスのone-vs-rest。(件数, クラス数)の行列を列ごとに1回ソートし、全クラスのROC/PRを同時に計算する
+        onehot: 正解の(件数, クラス数)のbool行列、scores: 同じ形のスコア
+        """
+        n, k = scores.shape
+        order = np.argsort(-scores, axis=0, kind='stable')
+        sorted_scores = np.take_along_axis(scores, order, axis=0)
+        tps = np.cumsum(np.take_along_axis(onehot, order, axis=0), axis=0, dtype=np.int64)
+        fps = np.arange(1, n + 1)[:, None] - tps
+        pos = tps[-1]
+        neg = fps[-1]
+        # 同じスコアが続く場合は最後の位置だけを曲線の点にする
+        last = np.vstack([sorted_scores[1:] != sorted_scores[:-1], np.ones((1, k), dtype=bool)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tpr = tps / pos
+            fpr = fps / neg
+            precision = tps / (tps + fps)
+
+        # 各位置の直前の点の値(最初の点の前は0)
+        index = np.where(last, np.arange(n)[:, None], -1)
+        prev = np.vstack([np.full((1, k), -1), np.maximum.accumulate(index, axis=0)[:-1]])
+
+        def previous(values):
+            return np.where(prev >= 0, np.take_along_axis(values, np.maximum(prev, 0), axis=0), 0)
+
+        roc_auc = np.where(last, (fpr - previous(fpr)) * (tpr + previous(tpr)) / 2, 0).sum(axis=0)
+        ap = np.where(last, (tpr - previous(tpr)) * np.nan_to_num(precision), 0).sum(axis=0)
+
+        curves = {}
+        for i, name in enumerate(classes):
+            points = last[:, i]
+            valid = pos[i] > 0 and neg[i] > 0
+            curves[name] = {
+                'fpr': np.r_[0, fpr[points, i]], 'tpr': np.r_[0, tpr[points, i]],
+                'precision': np.nan_to_num(precision[points, i]), 'recall': tpr[points, i],
+                'thresholds': sorted_scores[points, i],
+                'roc_auc': float(roc_auc[i]) if valid else float('nan'),
+                'average_precision': float(ap[i]) if pos[i] > 0 else float('nan'),
+            }
+        return curves
+
+    def _grid(self, scores):
+        return np.unique(np.quantile(scores, np.linspace(0, 1, self.n_thresholds)))
+
+
+class ConfusionAccumulator:
+    u"""混同行列の逐次集計(chunkごとにupdateし、別プロセスの結果はmergeで足し合わせる)"""
+
+    def __init__(self, classes):
+        self.classes = list(classes)
+        self._index = pd.Index(self.classes)
+        self.matrix = np.zeros((len(self.classes), len(self.classes)), dtype=np.int64)
+
+    def update(self, y_true, y_pred):
+        true_codes = self._index.get_indexer(np.asarray(y_true))
+        pred_codes = self._index.get_indexer(np.asarray(y_pred))
+        self.update_codes(true_codes, pred_codes)
+        return self
+
+    def update_codes(self, true_codes, pred_codes):
+        self.matrix += MetricsEngine.confusion(true_codes, pred_codes, len(self.classes))
+        return self
+
+    def merge(self, other):
+        self.matrix += other.matrix
+        return self
+
+    def result(self):
+        """(classification_report相当のDataFrame, accuracy, MCC)"""
+        return MetricsEngine.report(self.matrix, self.classes)
+
+
+class CurveAccumulator:
+    u"""
+    スコアをbins個の区間に分けて正例・負例の件数を数え、近似のROC/PR曲線を作る
+    出力がk列(多クラスのone-vs-rest)の場合は(bins, k)の件数を持つ
+    """
+
+    def __init__(self, bins=1000, score_range=(0.0, 1.0), n_outputs=1):
+        self.bins = bins
+        self.score_range = score_range
+        self.n_outputs = n_outputs
+        self.pos = np.zeros((bins, n_outputs), dtype=np.int64)
+        self.neg = np.zeros((bins, n_outputs), dtype=np.int64)
+
+    def update(self, y_true, scores):
+        """y_true: 正例かどうか、scores: スコア。どちらも(件数,)か(件数, n_outputs)"""
+        y_true = np.asarray(y_true, dtype=bool).reshape(len(y_true), -1)
+        bins = self.bin_index(scores).reshape(len(y_true), -1)
+        # (区間, 列)を1次元にしてbincountでまとめて数える
+        cells = bins * self.n_outputs + np.arange(self.n_outputs)[None, :]
+        size = self.bins * self.n_outputs
+        self.pos += np.bincount(cells[y_true], minlength=size).reshape(self.bins, self.n_outputs)
+        self.neg += np.bincount(cells[~y_true], minlength=size).reshape(self.bins, self.n_outputs)
+        return self
+
+    def bin_index(self, scores):
+        low, high = self.score_range
+        index = np.floor((np.asarray(scores, dtype=float) - low) / (high - low) * self.bins)
+        return np.clip(index, 0, self.bins - 1).astype(np.int64)
+
+    def merge(self, other):
+        self.pos += other.pos
+        self.neg += other.neg
+        return self
+
+    def thresholds(self):
+        """各区間の下端(降順)"""
+        low, high = self.score_range
+        return (low + (high - low) * np.arange(self.bins) / self.bins)[::-1]
+
+    def curve(self, column=0):
+        """MetricsEngine.curve_pointsと同じ形式の曲線(閾値は区間の下端)"""
+        tps = np.cumsum(self.pos[::-1, column])
+        fps = np.cumsum(self.neg[::-1, column])
+        return MetricsEngine.curve_points({'thresholds': self.thresholds(), 'tps': tps, 'fps': fps})
+
+    def sweep(self, column=0):
+        tps = np.cumsum(self.pos[::-1, column])
+        fps = np.cumsum(self.neg[::-1, column])
+        return MetricsEngine.sweep_frame(self.thresholds(), tps, fps, tps[-1], fps[-1])
+
+
+class CalibrationAccumulator:
+    u"""スコアの区間ごとの平均スコアと正例率(キャリブレーション曲線)の逐次集計"""
+
+    def __init__(self, bins=10):
+        self.bins = bins
+        self.count = np.zeros(bins, dtype=np.int64)
+        self.score_sum = np.zeros(bins)
+        self.pos = np.zeros(bins, dtype=np.int64)
+
+    def update(self, y_true, scores):
+        scores = np.asarray(scores, dtype=float).ravel()
+        y_true = np.asarray(y_true, dtype=bool).ravel()
+        index = np.clip(np.floor(scores * self.bins), 0, self.bins - 1).astype(np.int64)
+        self.count += np.bincount(index, minlength=self.bins)
+        self.score_sum += np.bincount(index, weights=scores, minlength=self.bins)
+        self.pos += np.bincount(index[y_true], minlength=self.bins)
+        return self
+
+    def merge(self, other):
+        self.count += other.count
+        self.score_sum += other.score_sum
+        self.pos += other.pos
+        return self
+
+    def result(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df = pd.DataFrame({
+                'bin_lower': np.arange(self.bins) / self.bins,
+                'count': self.count,
+                'mean_score': self.score_sum / self.count,
+                'positive_rate': self.pos / self.count,
+            })
+        return df
+
+    def ece(self):
+        """Expected Calibration Error"""
+        df = self.result()
+        total = self.count.sum()
+        if total == 0:
+            return float('nan')
+        return float((df['count'] * (df['mean_score'] - df['positive_rate']).abs()).sum() / total)
+
+
+class LogLossAccumulator:
+    u"""log lossの逐次集計(合計と件数を持つ)"""
+
+    def __init__(self, eps=1e-15):
+        self.eps = eps
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, true_codes, y_prob):
+        """true_codes: 正解クラスの位置、y_prob: 2値は正例のスコアの1次元配列、多クラスは(件数, クラス数)"""
+        y_prob = np.asarray(y_prob, dtype=float)
+        true_codes = np.asarray(true_codes)
+        valid = true_codes >= 0
+        if y_prob.ndim == 1:
+            prob = np.where(true_codes == 1, y_prob, 1 - y_prob)
+        else:
+            prob = np.take_along_axis(y_prob, np.maximum(true_codes, 0)[:, None], axis=1)[:, 0]
+        prob = np.clip(prob[valid], self.eps, 1 - self.eps)
+        self.total -= float(np.log(prob).sum())
+        self.count += int(valid.sum())
+        return self
+
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+        return self
+
+    def result(self):
+        return self.total / self.count if self.count > 0 else float('nan')
+
+
+class StreamingEvaluator:
+    u"""
+    メモリに載らないデータの評価。chunkごとにupdateし、パーティションごとの結果はmergeで足し合わせる
+    ROC/PRはスコアの区間(bins)ごとの件数から計算する近似値
+    classes: 全クラス(パーティション間で揃える必要があるため最初に指定する)。2値の場合は[負例, 正例]
+
+    ex)
+        evaluator = StreamingEvaluator([0, 1])
+        for df in aurora.read_chunks(sql):
+            evaluator.update(df['label'], prob_y=df['score'])
+        result = evaluator.result()
+    """
+
+    def __init__(self, classes, bins=1000, calibration_bins=10):
+        self.classes = list(classes)
+        self._index = pd.Index(self.classes)
+        self.confusion = ConfusionAccumulator(self.classes)
+        self.curves = None
+        self.calibration = None
+        self.log_loss = LogLossAccumulator()
+        self.bins = bins
+        self.calibration_bins = calibration_bins
+
+    @property
+    def binary(self):
+        return len(self.classes) == 2
+
+    def update(self, y_true, y_pred=None, y_prob=None):
+        """
+        y_prob: 2値は正例のスコアの1次元配列、多クラスは(件数, クラス数)の配列かDataFrame
+        y_predを省略した場合はy_probから予測する(MetricsEngine.evaluateと同じ)
+        """
+        true_codes = self._index.get_indexer(np.asarray(y_true))
+        if y_prob is not None:
+            y_prob = np.asarray(y_prob, dtype=float)
+            if y_prob.ndim == 2 and y_prob.shape[1] != len(self.classes):
+                raise ValueError(f'y_prob has {y_prob.shape[1]} columns but {len(self.classes)} classes')
+            if self.binary and y_prob.ndim == 2:
+                y_prob = y_prob[:, 1]
+        if y_pred is None:
+            if y_prob is None:
+                raise ValueError('y_pred or y_prob is required')
+            pred_codes = (y_prob >= 0.5).astype(np.int64) if y_prob.ndim == 1 else y_prob.argmax(axis=1)
+        else:
+            pred_codes = self._index.get_indexer(np.asarray(y_pred))
+        self.confusion.update_codes(true_codes, pred_codes)
+        if y_prob is None:
+            return self
+
+        valid = true_codes >= 0
+        if self.binary:
+            positive = true_codes[valid] == 1
+            self._curves(1).update(positive, y_prob[valid])
+            self._calibration().update(positive, y_prob[valid])
+        else:
+            onehot = true_codes[valid][:, None] == np.arange(len(self.classes))[None, :]
+            self._curves(len(self.classes)).update(onehot, y_prob[valid])
+            # 多クラスのキャリブレーションは全クラスのスコアをまとめて集計する
+            self._calibration().update(onehot, y_prob[valid])
+        self.log_loss.update(true_codes, y_prob)
+        return self
+
+    def update_all(self, chunks):
+        """(y_true, y_pred, y_prob)のタプルを返すiterable/generatorをまとめて集計する"""
+        for chunk in chunks:
+            self.update(*chunk)
+        return self
+
+    def merge(self, other):
+        self.confusion.merge(other.confusion)
+        self.log_loss.merge(other.log_loss)
+        if other.curves is not None:
+            self._curves(other.curves.n_outputs).merge(other.curves)
+            self._calibration().merge(other.calibration)
+        return self
+
+    def result(self):
+        report, accuracy, mcc = self.confusion.result()
+        result = EvaluationResult(
+            self.classes, pd.DataFrame(self.confusion.matrix, index=self.classes, columns=self.classes),
+            report, accuracy, mcc)
+        if self.curves is None:
+            return result
+
+        if self.binary:
+            result.curves = {self.classes[-1]: self.curves.curve()}
+            result.sweep = self.curves.sweep()
+        else:
+            result.curves = {name: self.curves.curve(i) for i, name in enumerate(self.classes)}
+        valid = [x for x in result.curves.values() if not np.isnan(x['roc_auc'])]
+        result.roc_auc = float(np.mean([x['roc_auc'] for x in valid])) if valid else None
+        result.average_precision = float(np.mean([x['average_precision'] for x in valid])) if valid else None
+        result.log_loss = self.log_loss.result()
+        result.calibration = self.calibration.result()
+        return result
+
+    def _curves(self, n_outputs):
+        if self.curves is None:
+            self.curves = CurveAccumulator(self.bins, n_outputs=n_outputs)
+        return self.curves
+
+    def _calibration(self):
+        if self.calibration is None:
+            self.calibration = CalibrationAccumulator(self.calibration_bins)
+        return self.calibration
+
+
+def evaluate_partition(args):
+    """Evaluator.evaluate_partitionsの各プロセスで実行する(ProcessPoolExecutorで渡せるようにモジュール関数にしている)"""
+    load, partition, classes, kwargs = args
+    return StreamingEvaluator(classes, **kwargs).update_all(load(partition))
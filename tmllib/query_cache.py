@@ -0,0 +1,174 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCache:
+    u"""
+    クエリ結果のローカルキャッシュ(BigQuery.read_gbq / Aurora.read用)
+    正規化したSQL・引数・接続先をキーにしてparquetで保存する。
+    ttl秒を過ぎたものと、合計max_bytesを超えた分の古いもの(最終利用順)は削除する。
+    validate=Trueの場合は、クエリ中のテーブルの最終更新日時がキャッシュ作成より新しければ再取得する
+
+    ex)
+        cache = QueryCache('./cache/query', ttl=3600, validate=True)
+        bq = BigQuery(conf, cache=cache)
+        df = bq.read_gbq(sql)
+        print(cache.stats)
+    """
+
+    # 文字列リテラルと、コメント・空白の連続を照合する
+    _TOKENS = re.compile(
+        r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|((?:--[^\n]*|#[^\n]*|/\*.*?\*/|\s+)+)""",
+        re.DOTALL)
+    # 文字列リテラル(テーブル名の抽出前に空文字列に置き換える)
+    _LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|" r'"(?:[^"\\]|\\.)*"')
+    # テーブル名の抽出に使うトークン(識別子・単語・括弧)
+    _WORDS = re.compile(r'`[^`]+`|[\w.\-]+|[()]')
+    # with句で定義した名前(テーブルではないので更新日時の確認から除く)
+    _CTES = re.compile(r'(?:\bwith(?:\s+recursive)?|,)\s+(`[^`]+`|\w+)\s+as\s*\(', re.IGNORECASE)
+
+    def __init__(self, cache_dir='./cache/query', ttl=86400, max_bytes=10 * 1024 ** 3, validate=False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.validate = validate
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+        self._lock = threading.Lock()
+
+    def fetch(self, sql, loader, args={}, identity='', last_modified=None):
+        """
+        キャッシュがあれば返し、なければloader()の結果を保存して返す
+        last_modified: テーブル名のlistを受け取り、最終更新日時(epoch秒、不明ならNone)を返す関数
+        """
+        key = self.key(sql, args, identity)
+        df = self.get(key, sql, last_modified)
+        if df is not None:
+            return df
+        df = loader()
+        try:
+            self.set(key, sql, df)
+        except Exception as e:
+            # 保存に失敗(ディスク容量・権限・parquetに変換できない型など)しても取得した結果は返す
+            logger.warning('QueryCache: failed to save %s: %s', key, e)
+        return df
+
+    def key(self, sql, args={}, identity=''):
+        text = json.dumps([self.normalize(sql), args, str(identity)], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @classmethod
+    def normalize(cls, sql):
+        """コメントを除去し、文字列リテラル以外の連続する空白を1つにまとめる"""
+        def replace(m):
+            return m.group(1) if m.group(1) is not None else ' '
+        return cls._TOKENS.sub(replace, sql).strip().rstrip(';').strip()
+
+    @classmethod
+    def tables(cls, sql):
+        """
+        from/join句に出てくるテーブル名の一覧(with句の名前とunnestは除く)
+        文字列リテラルの中と、関数呼び出しの括弧の中(extract(year from ts)など)のfromは対象にしない
+        """
+        sql = cls._LITERALS.sub("''", cls.normalize(sql))
+        ctes = {x.strip('`').lower() for x in cls._CTES.findall(sql)}
+        tokens = cls._WORDS.findall(sql)
+        names = set()
+        # 括弧ごとに関数呼び出しかどうか。select/withで始まる括弧(サブクエリ)の中はテーブルを参照する
+        calls = []
+        for i, token in enumerate(tokens):
+            following = tokens[i + 1] if i + 1 < len(tokens) else ''
+            if token == '(':
+                calls.append(following.lower() not in ('select', 'with', '('))
+            elif token == ')':
+                if calls:
+                    calls.pop()
+            elif token.lower() in ('from', 'join') and not any(calls) and following not in ('', '(', ')'):
+                names.add(following.strip('`'))
+        return sorted(x for x in names if x.lower() not in ctes and x.lower() != 'unnest')
+
+    def get(self, key, sql='', last_modified=None):
+        data, meta = self._paths(key)
+        if not os.path.isfile(data) or not os.path.isfile(meta):
+            return self._miss()
+        with open(meta) as f:
+            info = json.load(f)
+        if time.time() - info['created_at'] > self.ttl:
+            return self._miss()
+        if self.validate and last_modified is not None:
+            modified = last_modified(self.tables(sql))
+            if modified is not None and modified > info['created_at']:
+                return self._miss()
+        try:
+            df = pd.read_parquet(data)
+            # 最終利用日時を更新(evictionはmtimeの古い順)
+            os.utime(data)
+        except FileNotFoundError:
+            # 他プロセスに削除された
+            return self._miss()
+        with self._lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += info['bytes']
+        return df
+
+    def set(self, key, sql, df):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data, meta = self._paths(key)
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            df.to_parquet(data + suffix)
+            with open(meta + suffix, 'w') as f:
+                json.dump({'created_at': time.time(), 'bytes': os.path.getsize(data + suffix), 'sql': sql}, f,
+                          ensure_ascii=False)
+            os.replace(data + suffix, data)
+            os.replace(meta + suffix, meta)
+        finally:
+            for x in (data + suffix, meta + suffix):
+                if os.path.exists(x):
+                    os.remove(x)
+        self.evict()
+
+    def evict(self):
+        """ttl切れと、max_bytesを超えた分を最終利用の古い順に削除する"""
+        files = []
+        for x in glob.glob(os.path.join(self.cache_dir, '*.parquet')):
+            try:
+                files.append((os.path.getmtime(x), os.path.getsize(x), x))
+            except FileNotFoundError:
+                continue
+        total = sum(x[1] for x in files)
+        now = time.time()
+        for mtime, size, x in sorted(files):
+            if total <= self.max_bytes and now - mtime <= self.ttl:
+                continue
+            self._remove(x)
+            total -= size
+
+    def clear(self):
+        for x in glob.glob(os.path.join(self.cache_dir, '*.parquet')):
+            self._remove(x)
+
+    def _remove(self, data):
+        for x in (data, data[:-len('.parquet')] + '.json'):
+            try:
+                os.remove(x)
+            except FileNotFoundError:
+                pass
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.parquet', base + '.json'
+
+    def _miss(self):
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
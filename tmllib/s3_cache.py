@@ -0,0 +1,222 @@
+import fcntl
+import glob
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+
+
+class S3Cache:
+    u"""
+    S3オブジェクトのローカルディスクキャッシュ(AWSTool.get_from_s3url用)
+    bucket/key/ETagをキーにしてファイルで保存し、合計max_bytesを超えた分を最終利用の古い順に削除する。
+    前回の確認からrevalidate秒を過ぎたものは HEAD(If-None-Match) で更新を確認し、変更があれば再取得する。
+    同じホストの複数プロセスから共有できる(キーごとのファイルロックで同じオブジェクトの同時取得を防ぐ)
+
+    ex)
+        aws = AWSTool(cache=S3Cache('./cache/s3', max_bytes=50 * 1024 ** 3)).init_s3()
+        model = pickle.loads(aws.get_from_s3url('s3://bucket/model.pkl'))
+        with aws.open_mmap('s3://bucket/embedding.npy') as m:
+            ...
+        print(aws.cache.stats)
+    """
+
+    def __init__(self, cache_dir='./cache/s3', max_bytes=10 * 1024 ** 3, revalidate=3600, workers=8):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.workers = workers
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0}
+        self._lock = threading.Lock()
+
+    def path(self, s3url, aws):
+        """
+        キャッシュしたファイルのパスを返す。なければawsで取得して保存する
+        返した後に他のプロセスのevictで削除されることがあるので、読む場合はopen_file/read/open_mmapを使う
+        """
+        with self.open_file(s3url, aws) as f:
+            return f.name
+
+    def open_file(self, s3url, aws):
+        """
+        キャッシュしたファイルを開いて返す。なければawsで取得して保存する
+        キーのロック中に開くので、その後にevictで削除されても開いたファイルは読める
+        """
+        bucket, key = aws.parse_s3url(s3url)
+        base = self._base(bucket, key)
+        with self._file_lock(base + '.lock'):
+            f = open(self._fetch(s3url, aws, base, bucket, key), 'rb')
+            # ロック中のキーはevictで削除されない(max_bytesより大きいオブジェクトでも残る)
+            self.evict()
+        return f
+
+    def _fetch(self, s3url, aws, base, bucket, key):
+        """キーのロック中に呼ぶ。キャッシュしたファイルのパスを返す"""
+        meta = self._read_meta(base)
+        if meta is not None and os.path.isfile(meta['data']):
+            if time.time() - meta['checked_at'] <= self.revalidate:
+                return self._hit(meta['data'])
+            head = self._head(aws, bucket, key, meta['etag'])
+            if head is None:
+                # 304 Not Modified
+                meta['checked_at'] = time.time()
+                self._write_meta(base, meta)
+                self._count('revalidated')
+                return self._hit(meta['data'])
+        else:
+            head = self._head(aws, bucket, key)
+        self._count('misses')
+        data = f'{base}.{hashlib.sha256(head["ETag"].encode()).hexdigest()[:16]}.bin'
+        aws.download_file(s3url, data, head=head)
+        # download_fileはS3の更新日時を設定するので、LRU用に最終利用日時にする
+        os.utime(data)
+        if meta is not None and meta['data'] != data:
+            self._remove_file(meta['data'])
+        self._write_meta(base, {
+            'bucket': bucket, 'key': key, 'etag': head['ETag'], 'data': data,
+            'size': head['ContentLength'], 'checked_at': time.time(),
+        })
+        return data
+
+    def read(self, s3url, aws):
+        with self.open_file(s3url, aws) as f:
+            return f.read()
+
+    @contextmanager
+    def open_mmap(self, s3url, aws):
+        """キャッシュしたファイルを読み取り専用でメモリマップする(空のファイルはb''を返す)"""
+        with self.open_file(s3url, aws) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b''
+                return
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield m
+            finally:
+                m.close()
+
+    def prefetch(self, s3urls, aws):
+        """複数のオブジェクトをworkers並列でキャッシュし、{s3url: パス}を返す"""
+        s3urls = list(s3urls)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(s3urls, executor.map(lambda x: self.path(x, aws), s3urls)))
+
+    def evict(self):
+        """max_bytesを超えた分を最終利用の古い順に削除する(他のスレッド・プロセスがロック中のキーは飛ばす)"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._file_lock(os.path.join(self.cache_dir, '.evict.lock')):
+            files = []
+            for x in glob.glob(os.path.join(self.cache_dir, '*.bin')):
+                try:
+                    files.append((os.path.getmtime(x), os.path.getsize(x), x))
+                except FileNotFoundError:
+                    continue
+            total = sum(x[1] for x in files)
+            for mtime, size, x in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                # 取得・確認中のキーは飛ばす。mmap中のファイルは削除後もそのプロセスからは読める
+                if self._try_remove(x):
+                    total -= size
+
+    def clear(self):
+        """全て削除する(ロック中のキーは残す)"""
+        for x in glob.glob(os.path.join(self.cache_dir, '*.bin')):
+            self._try_remove(x)
+
+    def _head(self, aws, bucket, key, etag=None):
+        """etagを指定した場合、変更がなければNoneを返す"""
+        kwargs = {'IfNoneMatch': etag} if etag is not None else {}
+        try:
+            return aws.client.head_object(Bucket=bucket, Key=key, **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return None
+            raise
+
+    def _hit(self, data):
+        # 最終利用日時を更新(evictionはmtimeの古い順)
+        os.utime(data)
+        self._count('hits')
+        return data
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _base(self, bucket, key):
+        return os.path.join(self.cache_dir, hashlib.sha256(f'{bucket}/{key}'.encode()).hexdigest())
+
+    @staticmethod
+    def _read_meta(base):
+        try:
+            with open(base + '.json') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_meta(base, meta):
+        tmp = f'{base}.json.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, base + '.json')
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _try_remove(self, data):
+        """
+        キーのロックを取れた場合はデータを削除し、メタデータとロックファイルも削除する
+        (ファイル数が増え続けないようにする)。ロック中のキーは飛ばしてFalseを返す
+        """
+        base = data.rsplit('.', 2)[0]
+        with self._file_lock(base + '.lock', blocking=False) as locked:
+            if not locked:
+                return False
+            self._remove_file(data)
+            meta = self._read_meta(base)
+            if meta is None or meta['data'] == data:
+                self._remove_file(base + '.json')
+                # ロック中に削除する。待っていた側は_file_lockで別のファイルになったことを検知して開き直す
+                self._remove_file(base + '.lock')
+        return True
+
+    @contextmanager
+    def _file_lock(self, path, blocking=True):
+        """
+        flockはプロセス間、同じプロセスのスレッド間(ファイルを別々に開くため)の両方で排他になる
+        blocking=Falseの場合は取れなければ待たずにFalseを返す
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        while True:
+            f = open(path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                f.close()
+                yield False
+                return
+            # 開いてからロックを取るまでの間に_try_removeでロックファイルが削除された場合は開き直す
+            try:
+                same = os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                same = False
+            if same:
+                break
+            f.close()
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
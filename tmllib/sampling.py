@@ -0,0 +1,92 @@
+import math
+
+import pandas as pd
+
+
+class HashSampler:
+    u"""
+    DBレベルでのハッシュバケットによる層別サンプリング
+    1. クラスごとの件数を1回の集計クエリで取得
+    2. 各クラスを hash(unique_key) mod buckets < k の条件で絞り込み、全クラスを1回のクエリ(union all)で取得
+    全件のハッシュソート(order by ... limit)をしないので、件数は目標値の近似になる。
+    同じunique_key・saltであれば毎回同じレコードが選ばれる
+
+    base_query: SQL文字列でwhere句に{separater}変数を、order by句の位置に{orderby}変数を指定すること
+    classes: {ラベル: 条件式} ex) {'pos': "status = 'win'", 'neg': "status = 'lose'"}
+    """
+
+    def __init__(self, dialect='bigquery', salt='', buckets=10000):
+        self.dialect = dialect
+        self.salt = salt
+        self.buckets = buckets
+
+    def sample(self, read, base_query, classes, unique_key, *, sizes={}, ratios={}, base=None,
+               label_column=None, args={}, is_debug=False):
+        """
+        read: SQLを受け取ってDataFrameを返す関数
+        sizes: {ラベル: 件数} 件数を直接指定するクラス
+        ratios: {ラベル: 倍率} baseクラスの件数に対する倍率(指定のないクラスは1.0)
+        base: 倍率の基準にするクラス(省略時は件数が最も少ないクラス)
+        label_column: 指定するとクラスのラベルをこの列名で付与する
+        """
+        counts = self.counts(read, base_query, classes, args)
+        if is_debug:
+            print('class counts:', counts)
+        targets = self.targets(counts, sizes, ratios, base)
+        if is_debug:
+            print('class targets:', targets)
+        query = self.sample_sql(base_query, classes, counts, targets, unique_key, label_column, args)
+        return read(query)
+
+    def counts(self, read, base_query, classes, args={}):
+        df = read(self.count_sql(base_query, classes, args))
+        counts = dict(zip(df['label'], df['n']))
+        return {k: int(counts.get(k, 0)) for k in classes}
+
+    def targets(self, counts, sizes={}, ratios={}, base=None):
+        """クラスごとの目標件数(実件数が上限)"""
+        if base is None:
+            base = min(counts, key=lambda k: counts[k])
+        base_n = min(sizes.get(base, counts[base]), counts[base])
+        return {
+            k: min(counts[k], sizes[k] if k in sizes else round(base_n * ratios.get(k, 1.0)))
+            for k in counts
+        }
+
+    def count_sql(self, base_query, classes, args={}):
+        sql = [
+            f"select {self._literal(k)} as label, count(*) as n from ({self._format(base_query, cond, args)}) t{i}"
+            for i, (k, cond) in enumerate(classes.items())
+        ]
+        return ' union all '.join(sql)
+
+    def sample_sql(self, base_query, classes, counts, targets, unique_key, label_column=None, args={}):
+        sql = []
+        for i, (k, cond) in enumerate(classes.items()):
+            if counts[k] == 0 or targets[k] == 0:
+                continue
+            bucket = math.ceil(self.buckets * targets[k] / counts[k])
+            if bucket < self.buckets:
+                cond = f"({cond}) and {self.hash_sql(unique_key)} < {bucket}"
+            label = f", {self._literal(k)} as {label_column}" if label_column is not None else ''
+            sql.append(f"select t{i}.*{label} from ({self._format(base_query, cond, args)}) t{i}")
+        if len(sql) == 0:
+            # 全クラス0件の場合も列構成を返す
+            return self._format(base_query, '1 = 0', args)
+        return ' union all '.join(sql)
+
+    def hash_sql(self, unique_key):
+        """unique_keyを0〜buckets-1に振り分けるSQL式"""
+        if self.dialect == 'mysql':
+            return (f"conv(substring(sha2(concat({unique_key}, '{self.salt}'), 224), 1, 8), 16, 10)"
+                    f" % {self.buckets}")
+        key = f"concat(cast({unique_key} as string), '{self.salt}')" if self.salt != '' else f"cast({unique_key} as string)"
+        return f"mod(mod(farm_fingerprint({key}), {self.buckets}) + {self.buckets}, {self.buckets})"
+
+    @staticmethod
+    def _format(base_query, cond, args):
+        return base_query.format(separater=cond, orderby='', **args)
+
+    @staticmethod
+    def _literal(value):
+        return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"